@@ -0,0 +1,129 @@
+# Cross worker delivery latency through the backplane broker. Starts src/backplane.py on a
+# local port, connects two workers to it and measures how long a chat logged on one takes to
+# reach the other, then the media throughput of one streamer topic.
+# Run from the repository root: python bench/backplane_latency.py [--chats 5000] [--rate 2000]
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import subprocess
+
+src_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src_folder)
+
+from backplane import SocketBackplane, media_topic, encode_media, decode_media
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("broker did not start on port %d" % port)
+
+
+async def run(port, chats, rate, blobs, blob):
+    received = {"a": [], "b": []}
+    media = []
+    done = asyncio.Event()
+
+    def on_event(name):
+        def apply(node, connection, event):
+            if event[0] == "chat":
+                received[name].append((event[2], time.perf_counter() - event[6]))
+                if len(received["b"]) == chats:
+                    done.set()
+        return apply
+
+    def on_media(topic, payload):
+        kind, keyframe, sequence, streamer_id, mime, data = decode_media(payload)
+        media.append((sequence, len(data), time.perf_counter()))
+        if len(media) == blobs:
+            done.set()
+
+    worker_a = SocketBackplane("127.0.0.1", port, "worker-a")
+    worker_b = SocketBackplane("127.0.0.1", port, "worker-b")
+    worker_a.bind(on_event("a"), on_media)
+    worker_b.bind(on_event("b"), on_media)
+    await worker_a.start()
+    await worker_b.start()
+
+    # chats are logged on worker a at a fixed rate, stamped with the send time
+    interval = 1.0 / rate if rate else 0
+    started = time.perf_counter()
+    for i in range(chats):
+        worker_a.log(["chat", "bench", None, "alice", "message %d" % i, "", time.perf_counter()])
+        if interval:
+            delay = started + (i + 1) * interval - time.perf_counter()
+            await asyncio.sleep(max(delay, 0))
+    await asyncio.wait_for(done.wait(), 60)
+    chat_seconds = time.perf_counter() - started
+    latencies = [latency for seq, latency in received["b"]]
+    seqs = [seq for seq, latency in received["b"]]
+
+    done.clear()
+    topic = media_topic("bench", "streamer")
+    worker_b.subscribe(topic)
+    await asyncio.sleep(0.1)
+    started = time.perf_counter()
+    for i in range(blobs):
+        while not worker_a.publish(topic, encode_media(1, i == 0, i + 1, "streamer", "", blob)):
+            await asyncio.sleep(0.001)
+        await asyncio.sleep(0)
+    await asyncio.wait_for(done.wait(), 60)
+    media_seconds = media[-1][2] - started
+
+    await worker_a.close()
+    await worker_b.close()
+    return {
+        "chats": chats,
+        "rate": rate,
+        "chat_seconds": chat_seconds,
+        # the broker orders every chat, the sending worker gets it back too
+        "in_order": seqs == list(range(1, chats + 1)),
+        "sender_echoes": len(received["a"]),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "p999": percentile(latencies, 0.999) * 1000,
+            "max": max(latencies) * 1000
+        },
+        "media_blobs": blobs,
+        "media_blob_bytes": len(blob),
+        "media_mb_per_second": blobs * len(blob) / media_seconds / 1e6,
+        "media_dropped_by_sender": worker_a.dropped
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--chats", type=int, default=5000)
+    argument_parser.add_argument("--rate", type=int, default=2000)
+    argument_parser.add_argument("--blobs", type=int, default=500)
+    argument_parser.add_argument("--port", type=int, default=7499)
+    arguments = argument_parser.parse_args()
+    with open(os.path.join(src_folder, "res", "chunk_mov.webm"), "rb") as f:
+        blob = f.read()
+    broker = subprocess.Popen([sys.executable, os.path.join(src_folder, "backplane.py"), "--port", str(arguments.port)])
+    try:
+        wait_for_port(arguments.port)
+        result = asyncio.run(run(arguments.port, arguments.chats, arguments.rate, arguments.blobs, blob))
+    finally:
+        broker.terminate()
+        broker.wait()
+    print(json.dumps({"benchmark": "backplane_latency", "results": [result]}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
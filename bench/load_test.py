@@ -0,0 +1,395 @@
+# Load test of the chat and video paths. Starts src/endpoint.py on a localhost port (one process,
+# or the sharded launch with --workers), books the alt names and channels over http, connects
+# the /ws_v2 clients into channels whose sizes are drawn from --channel-sizes/--weights and
+# has a random member of a random channel send at --rate for --duration seconds. Every chat
+# carries its send time so each receiving socket measures its delivery latency. Streamers push
+# res/chunk_mov.webm sized blobs to /ws_video_v2 while viewers pull /broadcast_v2.
+# Server cpu and memory are read from /proc for the server process and its children. Everything
+# runs on this host, the same --seed gives the same channels and send order.
+# --protocol msgpack has the clients negotiate the binary /ws_v2 subprotocol instead of json.
+# Run from the repository root: python bench/load_test.py [--clients 1000] [--rate 200] [--output run.json]
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import resource
+import subprocess
+import multiprocessing
+import httpx
+import websockets
+
+src_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src_folder)
+
+from codec import pack, unpack
+
+clock_ticks = os.sysconf("SC_CLK_TCK")
+page_size = os.sysconf("SC_PAGE_SIZE")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+
+def latency_summary(values):
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "p50": percentile(values, 0.5) * 1000,
+        "p99": percentile(values, 0.99) * 1000,
+        "p999": percentile(values, 0.999) * 1000,
+        "max": max(values) * 1000
+    }
+
+
+def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("server did not start on port %d" % port)
+
+
+# the process and every descendant, the sharded launch runs a broker and a process per shard
+def process_tree(pid):
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(parent, []).append(int(entry))
+    tree = [pid]
+    for member in tree:
+        tree.extend(children.get(member, ()))
+    return tree
+
+
+# (cpu seconds, resident bytes) of the server process tree
+def server_usage(pid):
+    cpu = 0.0
+    rss = 0
+    for member in process_tree(pid):
+        try:
+            with open("/proc/%d/stat" % member) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/%d/statm" % member) as f:
+                rss += int(f.read().split()[1]) * page_size
+        except OSError:
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / clock_ticks
+    return cpu, rss
+
+
+# channel sizes drawn with the weights until every client has a channel, the last one takes the rest
+def plan_channels(clients, sizes, weights, rng):
+    channels = []
+    left = clients
+    while left > 0:
+        size = min(rng.choices(sizes, weights)[0], left)
+        if size < 2 and channels:
+            channels[-1] += size
+        else:
+            channels.append(size)
+        left -= size
+    return channels
+
+
+def setup(base, channel_sizes):
+    members = max(channel_sizes)
+    names = ["bench%05d" % i for i in range(members)]
+    with httpx.Client(base_url=base, timeout=60) as client:
+        for name in names:
+            client.post("/alt_manager", json={"action": "create", "alt_login_name": name, "alt_login_pass": "benchpassword"})
+        time.sleep(0.2)
+        tokens = [client.post("/alt_manager", json={
+            "action": "link", "alt_login_name": name, "alt_login_pass": "benchpassword"}).json()["token"] for name in names]
+        channels = []
+        for size in channel_sizes:
+            channel_id = client.post("/channel_adminer", json={
+                "action": "create", "token": tokens[0], "channel_key": "bench", "open": True}).json()["channel_id"]
+            channels.append((channel_id, tokens[:size]))
+        time.sleep(0.2)
+        for channel_id, channel_tokens in channels:
+            for token in channel_tokens[1:]:
+                client.post("/channel_adminer?channel_id=%s" % channel_id, json={
+                    "action": "joiner", "channel_id": channel_id, "token": token})
+    return channels
+
+
+class ChatClient:
+
+    def __init__(self, url, channel_id, token, latencies, protocol="json"):
+        self.url = url
+        self.channel_id = channel_id
+        self.token = token
+        self.latencies = latencies
+        self.binary = protocol == "msgpack"
+        self.encode, self.decode = (pack, unpack) if self.binary else (json.dumps, json.loads)
+        self.socket = None
+        self.task = None
+        self.received = 0
+        self.received_bytes = 0
+        self.acked = 0
+
+    async def connect(self):
+        self.socket = await websockets.connect(
+            "%s/ws_v2?channel_id=%s" % (self.url, self.channel_id), max_queue=None,
+            subprotocols=["chat.msgpack"] if self.binary else None)
+        await self.socket.send(self.encode({"action": "init", "channel_id": self.channel_id, "token": self.token}))
+        reply = self.decode(await self.socket.recv())
+        if "history" not in reply:
+            raise RuntimeError("init refused: %s" % reply)
+        self.task = asyncio.get_running_loop().create_task(self._receive())
+
+    async def _receive(self):
+        try:
+            async for frame in self.socket:
+                now = time.time()
+                self.received_bytes += len(frame)
+                chats = self.decode(frame)
+                if type(chats) != list:
+                    chats = [chats]
+                for chat in chats:
+                    # the binary chats have integer keys, 2 is the message
+                    message = chat.get(2) if self.binary else chat.get("message")
+                    if message is not None:
+                        self.received += 1
+                        self.latencies.append(now - float(message))
+                    elif "ack" in chat:
+                        self.acked += 1
+        except websockets.ConnectionClosed:
+            pass
+
+    async def send(self):
+        await self.socket.send(self.encode({"action": "continue", "message": "%.6f" % time.time()}))
+
+    async def close(self):
+        await self.socket.close()
+        if self.task is not None:
+            await self.task
+
+
+async def connect_all(clients, concurrency):
+    gate = asyncio.Semaphore(concurrency)
+
+    async def connect(client):
+        async with gate:
+            await client.connect()
+
+    await asyncio.gather(*[connect(client) for client in clients])
+
+
+# one client process: its share of the channels, the sends and the latency samples
+def chat_worker(url, channels, rate, duration, start_at, seed, concurrency, protocol, results):
+    async def run():
+        latencies = []
+        clients = [[ChatClient(url, channel_id, token, latencies, protocol) for token in tokens]
+                   for channel_id, tokens in channels]
+        everyone = [client for channel in clients for client in channel]
+        await connect_all(everyone, concurrency)
+        connected = time.time()
+        await asyncio.sleep(max(0.0, start_at - time.time()))
+        rng = random.Random(seed)
+        sent = 0
+        started = time.time()
+        while time.time() - started < duration:
+            await rng.choice(rng.choice(clients)).send()
+            sent += 1
+            delay = started + sent / rate - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sending = time.time() - started
+        # the tail still in flight
+        await asyncio.sleep(2)
+        for client in everyone:
+            await client.close()
+        results.put({
+            "clients": len(everyone),
+            "sent": sent,
+            "acked": sum(client.acked for client in everyone),
+            "received": sum(client.received for client in everyone),
+            "received_bytes": sum(client.received_bytes for client in everyone),
+            "sending_seconds": sending,
+            "connected_at": connected,
+            "latencies": latencies
+        })
+
+    asyncio.run(run())
+
+
+# streamers push a blob every interval, the first carries the webm header and the others only
+# its clusters, the way a MediaRecorder sends them
+async def video_load(url, base, streamers, viewers, interval, duration, blob):
+    clusters = blob[blob.find(b"\x1f\x43\xb6\x75"):]
+    stats = {"blobs": 0, "ingested": 0, "served": [0] * viewers}
+    stop = asyncio.Event()
+
+    async def stream(index):
+        socket = await websockets.connect("%s/ws_video_v2/bench-video/streamer-%d" % (url, index), max_size=None)
+        first = True
+        while not stop.is_set():
+            data = blob if first else clusters
+            first = False
+            await socket.send(data)
+            await socket.recv()
+            stats["blobs"] += 1
+            stats["ingested"] += len(data)
+            await asyncio.sleep(interval)
+        await socket.close()
+
+    async def view(index, client):
+        try:
+            async with client.stream("GET", "/broadcast_v2/bench-video/streamer-%d" % (index % streamers)) as response:
+                async for data in response.aiter_bytes():
+                    stats["served"][index] += len(data)
+                    if stop.is_set():
+                        break
+        except httpx.HTTPError:
+            pass
+
+    tasks = [asyncio.get_running_loop().create_task(stream(i)) for i in range(streamers)]
+    await asyncio.sleep(interval)
+    async with httpx.AsyncClient(base_url=base, timeout=None,
+                                 limits=httpx.Limits(max_connections=viewers + 1)) as client:
+        tasks += [asyncio.get_running_loop().create_task(view(i, client)) for i in range(viewers)]
+        await asyncio.sleep(duration)
+        stop.set()
+        await asyncio.wait(tasks, timeout=interval + 5)
+        for task in tasks:
+            task.cancel()
+    return {
+        "streamers": streamers,
+        "viewers": viewers,
+        "blob_bytes": len(blob),
+        "blobs_sent": stats["blobs"],
+        "ingested_mb_per_second": stats["ingested"] / duration / 1e6,
+        "served_mb_per_second": sum(stats["served"]) / duration / 1e6,
+        "served_per_viewer_min_bytes": min(stats["served"]) if viewers else None
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--clients", type=int, default=1000)
+    argument_parser.add_argument("--channel-sizes", default="2,10,50,200")
+    argument_parser.add_argument("--weights", default="4,3,2,1")
+    argument_parser.add_argument("--rate", type=float, default=200, help="chats per second over all channels")
+    argument_parser.add_argument("--duration", type=float, default=10)
+    argument_parser.add_argument("--procs", type=int, default=1, help="client processes")
+    argument_parser.add_argument("--connect-concurrency", type=int, default=100)
+    argument_parser.add_argument("--protocol", choices=["json", "msgpack"], default="json", help="/ws_v2 wire format")
+    argument_parser.add_argument("--streamers", type=int, default=2)
+    argument_parser.add_argument("--viewers", type=int, default=8)
+    argument_parser.add_argument("--blob-interval", type=float, default=1.0)
+    argument_parser.add_argument("--workers", type=int, default=1, help="SERVER_WORKERS of the server")
+    argument_parser.add_argument("--port", type=int, default=8190)
+    argument_parser.add_argument("--seed", type=int, default=1)
+    argument_parser.add_argument("--output", help="also write the json result to this file")
+    argument_parser.add_argument("--server-log", default=os.devnull, help="file for the server output")
+    arguments = argument_parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    rng = random.Random(arguments.seed)
+    sizes = [int(size) for size in arguments.channel_sizes.split(",")]
+    weights = [float(weight) for weight in arguments.weights.split(",")]
+    channel_sizes = plan_channels(arguments.clients, sizes, weights, rng)
+    with open(os.path.join(src_folder, "res", "chunk_mov.webm"), "rb") as f:
+        blob = f.read()
+
+    base = "http://127.0.0.1:%d" % arguments.port
+    url = "ws://127.0.0.1:%d" % arguments.port
+    # cheap key hashing keeps booking thousands of alt names quick, it is not what is measured
+    server_log = open(arguments.server_log, "w")
+    server = subprocess.Popen([sys.executable, "endpoint.py"], cwd=src_folder, stdout=server_log, stderr=server_log, env=dict(
+        os.environ, SERVER_PORT=str(arguments.port), WSS_PORT=str(arguments.port), WSS_HOST="127.0.0.1",
+        SERVER_WORKERS=str(arguments.workers), BACKPLANE_PORT=str(arguments.port + 1),
+        ALT_KEY_HASH_ITERATIONS="1000"))
+    try:
+        wait_for_port(arguments.port)
+        time.sleep(0.5 if arguments.workers == 1 else 3)
+        idle_cpu, idle_rss = server_usage(server.pid)
+        channels = setup(base, channel_sizes)
+
+        results = multiprocessing.Queue()
+        launched = time.time()
+        start_at = launched + 5 + arguments.clients / 200.0
+        workers = [multiprocessing.Process(target=chat_worker, args=(
+            url, channels[i::arguments.procs], arguments.rate / arguments.procs, arguments.duration, start_at,
+            arguments.seed + i, arguments.connect_concurrency, arguments.protocol, results))
+            for i in range(arguments.procs)]
+        for worker in workers:
+            worker.start()
+        # connected and idle, the run starts at start_at
+        time.sleep(max(0.0, start_at - time.time() - 0.5))
+        connected_cpu, connected_rss = server_usage(server.pid)
+        time.sleep(max(0.0, start_at - time.time()))
+        video = None
+        if arguments.streamers:
+            video = asyncio.run(video_load(url, base, arguments.streamers, arguments.viewers, arguments.blob_interval,
+                                           arguments.duration, blob))
+        parts = [results.get(timeout=arguments.duration + arguments.clients + 120) for worker in workers]
+        for worker in workers:
+            worker.join()
+        run_cpu, run_rss = server_usage(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+        server_log.close()
+
+    latencies = [latency for part in parts for latency in part["latencies"]]
+    sent = sum(part["sent"] for part in parts)
+    sending = max(part["sending_seconds"] for part in parts)
+    connected = max(part["connected_at"] for part in parts)
+    connections = arguments.clients + arguments.streamers + arguments.viewers
+    result = {
+        "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=src_folder,
+                                 capture_output=True, text=True).stdout.strip() or None,
+        "clients": arguments.clients,
+        "channels": len(channel_sizes),
+        "channel_sizes": {"max": max(channel_sizes), "mean": arguments.clients / len(channel_sizes)},
+        "workers": arguments.workers,
+        "client_procs": arguments.procs,
+        "seed": arguments.seed,
+        "duration": arguments.duration,
+        "rate": arguments.rate,
+        "protocol": arguments.protocol,
+        "chats_sent": sent,
+        "chats_acked": sum(part["acked"] for part in parts),
+        "deliveries": sum(part["received"] for part in parts),
+        "chats_per_second": sent / sending,
+        "deliveries_per_second": len(latencies) / sending,
+        "delivery_latency_ms": latency_summary(latencies),
+        "received_bytes_per_delivery": sum(part["received_bytes"] for part in parts) / len(latencies) if latencies else None,
+        "connect_seconds": connected - launched,
+        "server_rss_bytes": {"idle": idle_rss, "connected": connected_rss, "after_run": run_rss},
+        "server_rss_per_connection_bytes": (connected_rss - idle_rss) / connections,
+        "server_rss_growth_during_run_bytes": run_rss - connected_rss,
+        "server_cpu_seconds_during_run": run_cpu - connected_cpu,
+        "server_cpu_percent": (run_cpu - connected_cpu) / (sending + 2) * 100,
+        "server_cpu_us_per_chat": (run_cpu - connected_cpu) / sent * 1e6 if sent else None,
+        "server_cpu_us_per_connection_second": (run_cpu - connected_cpu) / connections / (sending + 2) * 1e6,
+        "video": video
+    }
+    output = json.dumps({"benchmark": "load_test", "results": [result]}, indent=2)
+    print(output)
+    if arguments.output:
+        with open(arguments.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
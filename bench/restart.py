@@ -0,0 +1,96 @@
+# Startup time of a new server process: importing the server module, rebuilding the state by
+# replaying the journal, and loading the drain snapshot instead. A journal of --channels channels
+# with --chats chats each is written first, a process replays it and writes the snapshot the way
+# a drain does, then another process starts from the snapshot.
+# Run from the repository root: python bench/restart.py [--channels 200] [--chats 2000]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+src_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src_folder)
+
+from journal import encode_record, segment_name
+
+server_process = """
+import sys, time, asyncio
+started = time.perf_counter()
+import endpoint
+imported = time.perf_counter() - started
+endpoint.create_app()
+if sys.argv[1] == "write":
+    asyncio.run(endpoint.write_state())
+print("import_seconds", imported)
+"""
+
+
+def write_journal(directory, channels, chats, message_size, rng):
+    stamp = time.time()
+    with open(os.path.join(directory, segment_name(1)), "wb") as f:
+        names = ["member-%d" % i for i in range(50)]
+        for name in names:
+            f.write(encode_record(["alt", name, "password-%s" % name]))
+        for channel in range(channels):
+            channel_id = "channel-%d" % channel
+            f.write(encode_record(["channel", channel_id, names[0], "key", True]))
+            records = []
+            for seq in range(1, chats + 1):
+                message = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz  ") for _ in range(message_size))
+                time_str = str(datetime.datetime.fromtimestamp(stamp))
+                records.append(encode_record(["chat", channel_id, seq, rng.choice(names), message, time_str, stamp]))
+            f.write(b"".join(records))
+
+
+# the structured log records of one server process, by event name
+def run_server(directory, mode):
+    env = dict(os.environ, CHAT_JOURNAL_DIR=directory, LOG_FORMAT="json", SESSION_SECRET="bench" * 8,
+               WSS_PORT="0", WSS_HOST="localhost")
+    output = subprocess.run([sys.executable, "-c", server_process, mode], cwd=src_folder, env=env,
+                            capture_output=True, text=True, check=True).stdout
+    records = {}
+    for line in output.splitlines():
+        if line.startswith("import_seconds"):
+            records["import"] = {"seconds": float(line.split()[1])}
+        elif line.startswith("{"):
+            record = json.loads(line)
+            records[record["msg"]] = record
+    return records
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--channels", type=int, default=200)
+    argument_parser.add_argument("--chats", type=int, default=2000, help="chats per channel")
+    argument_parser.add_argument("--message-size", type=int, default=60)
+    argument_parser.add_argument("--seed", type=int, default=1)
+    arguments = argument_parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        write_journal(directory, arguments.channels, arguments.chats, arguments.message_size,
+                      random.Random(arguments.seed))
+        journal_bytes = os.path.getsize(os.path.join(directory, segment_name(1)))
+        replayed = run_server(directory, "write")
+        restored = run_server(directory, "load")
+        results = [{
+            "source": replayed["state_loaded"]["source"],
+            "import_seconds": replayed["import"]["seconds"],
+            "load_seconds": replayed["state_loaded"]["seconds"],
+            "bytes": journal_bytes
+        }, {
+            "source": restored["state_loaded"]["source"],
+            "import_seconds": restored["import"]["seconds"],
+            "load_seconds": restored["state_loaded"]["seconds"],
+            "bytes": replayed["state_written"]["bytes"],
+            "write_seconds": replayed["state_written"]["seconds"]
+        }]
+    print(json.dumps({"benchmark": "restart", "channels": arguments.channels, "chats": arguments.chats,
+                      "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+# Benchmark of the ingest WebM parser against res/chunk_mov.webm.
+# Run from the repository root: python bench/webm_parser.py [--blobs 200] [--piece 4096]
+import os
+import sys
+import json
+import time
+import argparse
+
+src_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src_folder)
+
+from webm import WebmStreamParser
+
+
+def run(blob, blobs, piece):
+    parser = WebmStreamParser()
+    units = 0
+    clusters = 0
+    keyframes = 0
+    started = time.perf_counter()
+    for _ in range(blobs):
+        # each recorder blob arrives as one message, optionally cut into smaller pieces
+        pieces = [blob] if not piece else [blob[i:i + piece] for i in range(0, len(blob), piece)]
+        for data in pieces:
+            for unit in parser.feed(data):
+                units += 1
+                if unit.kind == "cluster":
+                    clusters += 1
+                    keyframes += unit.keyframe
+    elapsed = time.perf_counter() - started
+    return {
+        "blobs": blobs,
+        "piece_bytes": piece or len(blob),
+        "seconds": elapsed,
+        "mb_per_second": parser.bytes_in / elapsed / 1e6,
+        "blobs_per_second": blobs / elapsed,
+        "units": units,
+        "clusters": clusters,
+        "keyframe_clusters": keyframes,
+        "bytes_in": parser.bytes_in,
+        "bytes_out": parser.bytes_out,
+        # what a viewer no longer downloads compared to relaying every standalone blob
+        "saved_bytes_per_viewer": parser.bytes_in - parser.bytes_out
+    }
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--blobs", type=int, default=200)
+    argument_parser.add_argument("--piece", type=int, action="append")
+    arguments = argument_parser.parse_args()
+    with open(os.path.join(src_folder, "res", "chunk_mov.webm"), "rb") as f:
+        blob = f.read()
+    results = [run(blob, arguments.blobs, piece) for piece in (arguments.piece or [0, 4096, 512])]
+    print(json.dumps({"benchmark": "webm_parser", "blob_bytes": len(blob), "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
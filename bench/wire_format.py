@@ -0,0 +1,83 @@
+# Size and cpu of the two /ws_v2 wire formats, json text frames and the "chat.msgpack" binary
+# subprotocol. Chats are built like ChatMessage does, the server side cost is encoding a chat once
+# (it is cached for every subscriber) and splicing batches, the client side cost is decoding.
+# Which json and msgpack implementations ran is part of the output, orjson and msgpack are used
+# when installed. Run from the repository root: python bench/wire_format.py [--chats 20000] [--message-size 60]
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+
+src_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src_folder)
+
+import codec
+from codec import dumps, loads, pack, unpack, join_frames, join_packed
+from chat_log import ChatMessage
+
+
+def timed(function, items):
+    started = time.perf_counter()
+    for item in items:
+        function(item)
+    return (time.perf_counter() - started) / len(items) * 1e6
+
+
+def make_chats(count, message_size, rng):
+    names = ["member-%d" % i for i in range(50)]
+    chats = []
+    stamp = time.time()
+    for seq in range(1, count + 1):
+        message = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz  ") for _ in range(message_size))
+        stamp += rng.random() / 10
+        time_str = str(datetime.datetime.fromtimestamp(stamp))
+        chats.append(ChatMessage(seq, rng.choice(names), message, time_str, stamp))
+    return chats
+
+
+def run(chats, batch):
+    frames = [chat.frame for chat in chats]
+    packed = [chat.packed for chat in chats]
+    batches = [chats[i:i + batch] for i in range(0, len(chats) - batch + 1, batch)]
+    json_batches = [join_frames([chat.frame for chat in chunk]) for chunk in batches]
+    packed_batches = [join_packed([chat.packed for chat in chunk]) for chunk in batches]
+    dicts = [chat.to_dict() for chat in chats]
+    packed_dicts = [unpack(frame) for frame in packed]
+    return [{
+        "format": "json",
+        "implementation": "orjson" if codec.orjson is not None else "json",
+        "chat_frame_bytes": sum(len(frame.encode("utf-8")) for frame in frames) / len(frames),
+        "batch_frame_bytes_per_chat": sum(len(frame.encode("utf-8")) for frame in json_batches) / len(batches) / batch,
+        "ack_frame_bytes": len(dumps({"ack": len(chats)})),
+        "encode_us_per_chat": timed(dumps, dicts),
+        "decode_us_per_chat": timed(loads, frames),
+        "decode_batch_us_per_chat": timed(loads, json_batches) / batch
+    }, {
+        "format": "msgpack",
+        "implementation": "msgpack" if codec.msgpack is not None else "codec",
+        "chat_frame_bytes": sum(len(frame) for frame in packed) / len(packed),
+        "batch_frame_bytes_per_chat": sum(len(frame) for frame in packed_batches) / len(batches) / batch,
+        "ack_frame_bytes": len(pack({"ack": len(chats)})),
+        "encode_us_per_chat": timed(pack, packed_dicts),
+        "decode_us_per_chat": timed(unpack, packed),
+        "decode_batch_us_per_chat": timed(unpack, packed_batches) / batch
+    }]
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--chats", type=int, default=20000)
+    argument_parser.add_argument("--message-size", type=int, default=60)
+    argument_parser.add_argument("--batch", type=int, default=50, help="chats per array frame")
+    argument_parser.add_argument("--seed", type=int, default=1)
+    arguments = argument_parser.parse_args()
+    chats = make_chats(arguments.chats, arguments.message_size, random.Random(arguments.seed))
+    print(json.dumps({"benchmark": "wire_format", "chats": arguments.chats, "message_size": arguments.message_size,
+                      "results": run(chats, arguments.batch)}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
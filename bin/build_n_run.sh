@@ -7,7 +7,8 @@ root_folder="$(dirname ${path})"
 cd ${root_folder}
 
 # clean up
-docker stop wss_chat || true
+# the server drains its sockets and writes its state snapshot on SIGTERM, give it the time
+docker stop -t 20 wss_chat || true
 docker rm wss_chat || true
 docker image rm tinyorb/wss_chat:3.0 || true
 
@@ -26,8 +27,15 @@ HOST_APP_DOMAIN=172.24.125.197
 SSL=true
 
 
+# chat journal lives on a named volume so channels and alt names survive the container restart
+CHAT_JOURNAL_DIR=/opt/chat_data
+
+# worker processes, channels are spread over them by a router in the container (1 is the single process server)
+SERVER_WORKERS=1
+
 # sudo docker run -d --name=wss_chat -p <host_port>:<docker_app_port>/tcp --cap-add=NET_RAW --cap-add=NET_ADMIN tinyorb/wss_chat
  sudo docker run -d --name=wss_chat -e WSS_PORT=${HOST_APP_PORT} -e WSS_HOST=${HOST_APP_DOMAIN} -e SSL=${SSL} \
+  -e CHAT_JOURNAL_DIR=${CHAT_JOURNAL_DIR} -v wss_chat_data:${CHAT_JOURNAL_DIR} -e SERVER_WORKERS=${SERVER_WORKERS} \
   -p ${HOST_APP_PORT}:8000/tcp --cap-add=NET_RAW --cap-add=NET_ADMIN tinyorb/wss_chat:3.0
 
 if [[ "${SSL}" == "true" ]]; then
@@ -0,0 +1,413 @@
+import struct
+import asyncio
+import collections
+import socket
+import logging
+import argparse
+from codec import dumps, loads
+from journal import Journal, JournalState, JournalError
+from logs import configure_logging, log_event
+
+logger = logging.getLogger("backplane")
+
+# every frame is <length of the rest><op><topic length><topic><payload>
+length_header = struct.Struct("<I")
+body_header = struct.Struct("<BH")
+op_subscribe = 1
+op_unsubscribe = 2
+op_publish = 3
+op_retain = 4
+op_log = 5
+op_sync = 6
+# actions whose outcome depends on the global order (the seq of a chat), they are applied only
+# when the log hands them back, everything else is applied where it happens and then replicated
+sequenced_actions = {"chat"}
+# live streamers are not durable state, the broker tracks them per connection
+live_actions = {"live", "offline"}
+# media payload: <kind><keyframe><sequence><streamer id length><mime length><streamer id><mime><data>
+media_header = struct.Struct("<BBQHH")
+
+
+def encode_frame(op, topic, payload):
+    topic = topic.encode("utf-8")
+    return (length_header.pack(body_header.size + len(topic) + len(payload)) +
+            body_header.pack(op, len(topic)) + topic + payload)
+
+
+async def read_frame(reader):
+    length = length_header.unpack(await reader.readexactly(length_header.size))[0]
+    body = await reader.readexactly(length)
+    op, topic_length = body_header.unpack_from(body)
+    topic_end = body_header.size + topic_length
+    return op, body[body_header.size:topic_end].decode("utf-8"), body[topic_end:]
+
+
+def media_topic(channel_id, streamer_id):
+    return "video/%s/%s" % (channel_id, streamer_id)
+
+
+def encode_media(kind, keyframe, sequence, streamer_id, mime, data):
+    streamer_id = streamer_id.encode("utf-8")
+    mime = mime.encode("utf-8")
+    return media_header.pack(kind, keyframe, sequence, len(streamer_id), len(mime)) + streamer_id + mime + data
+
+
+def decode_media(payload):
+    kind, keyframe, sequence, streamer_length, mime_length = media_header.unpack_from(payload)
+    start = media_header.size
+    streamer_id = payload[start:start + streamer_length].decode("utf-8")
+    start += streamer_length
+    mime = payload[start:start + mime_length].decode("utf-8")
+    return kind, bool(keyframe), sequence, streamer_id, mime, payload[start + mime_length:]
+
+
+# Single worker: the process is its own sequencer and has nobody to replicate to, ordered
+# actions are handed straight back and everything else is a no-op.
+class InProcessBackplane:
+    remote = False
+
+    def __init__(self, node_id="local"):
+        self.node_id = node_id
+        self.on_event = None
+        self.on_message = None
+        self.lost = 0
+
+    def bind(self, on_event, on_message):
+        self.on_event = on_event
+        self.on_message = on_message
+
+    async def start(self):
+        pass
+
+    def log(self, event, connection=None):
+        if event[0] in sequenced_actions:
+            self.on_event(self.node_id, connection, event)
+        return True
+
+    def publish(self, topic, payload):
+        return True
+
+    def retain(self, topic, payload):
+        return True
+
+    def subscribe(self, topic):
+        pass
+
+    def unsubscribe(self, topic):
+        pass
+
+    def buffered(self):
+        return 0
+
+    async def close(self):
+        pass
+
+
+# Worker side of the TCP broker below. State events go on the shared log, the broker orders
+# them and hands them to every worker including the one that sent them. Media goes on
+# per streamer topics that a worker only subscribes to while it has viewers for them.
+# When the broker goes away the worker keeps serving its local state and reconnects,
+# the broker snapshot it gets on reconnect fills in what was missed. Its own state events are
+# kept meanwhile, up to max_unsent, and sent once it is back; a chat is refused instead since
+# only the broker can order it. local_actions never leave the worker, used when every channel
+# is owned by one worker that orders its own chats.
+class SocketBackplane:
+    remote = True
+
+    def __init__(self, host, port, node_id, max_buffer=32 * 1024 * 1024, reconnect_delay=1.0, local_actions=(),
+                 max_unsent=10000):
+        self.host = host
+        self.port = port
+        self.node_id = node_id
+        self.local_actions = set(local_actions)
+        self.max_buffer = max_buffer
+        self.max_unsent = max_unsent
+        self.unsent = collections.deque()
+        # state events neither sent nor kept for later
+        self.lost = 0
+        self.reconnect_delay = reconnect_delay
+        self.on_event = None
+        self.on_message = None
+        self.topics = set()
+        self.writer = None
+        self.synced = None
+        self.task = None
+        self.closed = False
+        self.dropped = 0
+
+    def bind(self, on_event, on_message):
+        self.on_event = on_event
+        self.on_message = on_message
+
+    # returns once the broker snapshot is applied, or after timeout with only the local state
+    async def start(self, timeout=10):
+        self.synced = asyncio.Event()
+        self.task = asyncio.get_running_loop().create_task(self._run())
+        try:
+            await asyncio.wait_for(self.synced.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Backplane broker not reachable at %s:%d, serving local state", self.host, self.port)
+
+    async def _run(self):
+        while not self.closed:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.writer = writer
+                writer.write(encode_frame(op_sync, "", self.node_id.encode("utf-8")))
+                # after the snapshot the broker sends back, the worker has these applied already
+                while self.unsent:
+                    writer.write(encode_frame(op_log, "", self.unsent.popleft()))
+                for topic in self.topics:
+                    writer.write(encode_frame(op_subscribe, topic, b""))
+                while True:
+                    op, topic, payload = await read_frame(reader)
+                    self._dispatch(op, topic, payload)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, asyncio.IncompleteReadError) as rrr:
+                log_event(logger, logging.WARNING, "backplane_connection_lost", error=repr(rrr))
+            finally:
+                if self.writer is not None:
+                    self.writer.close()
+                    self.writer = None
+            if not self.closed:
+                await asyncio.sleep(self.reconnect_delay)
+
+    def _dispatch(self, op, topic, payload):
+        try:
+            if op == op_log:
+                node, connection, event = loads(payload)
+                # this worker applied its own unordered events when they happened
+                if node == self.node_id and event[0] not in sequenced_actions:
+                    return
+                self.on_event(node, connection, event)
+            elif op == op_publish:
+                self.on_message(topic, payload)
+            elif op == op_sync:
+                self.synced.set()
+        except Exception:
+            logger.exception("Exception capture on backplane message")
+
+    def _write(self, op, topic, payload):
+        if self.writer is None:
+            return False
+        self.writer.write(encode_frame(op, topic, payload))
+        return True
+
+    def log(self, event, connection=None):
+        if event[0] in self.local_actions:
+            if event[0] in sequenced_actions:
+                self.on_event(self.node_id, connection, event)
+            return True
+        payload = dumps([self.node_id, connection, event]).encode("utf-8")
+        if self._write(op_log, "", payload):
+            return True
+        if event[0] in sequenced_actions:
+            return False
+        if event[0] in live_actions or len(self.unsent) >= self.max_unsent:
+            self.lost += 1
+            return False
+        self.unsent.append(payload)
+        return True
+
+    # media is dropped rather than queued without bound when the broker can not keep up
+    def publish(self, topic, payload):
+        if self.writer is None or self.writer.transport.get_write_buffer_size() > self.max_buffer:
+            self.dropped += 1
+            return False
+        return self._write(op_publish, topic, payload)
+
+    # bytes written and not yet taken by the broker
+    def buffered(self):
+        if self.writer is None:
+            return 0
+        return self.writer.transport.get_write_buffer_size()
+
+    # kept by the broker and given to every later subscriber of the topic, empty payload clears it
+    def retain(self, topic, payload):
+        return self._write(op_retain, topic, payload)
+
+    def subscribe(self, topic):
+        self.topics.add(topic)
+        self._write(op_subscribe, topic, b"")
+
+    def unsubscribe(self, topic):
+        self.topics.discard(topic)
+        self._write(op_unsubscribe, topic, b"")
+
+    async def close(self):
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class BrokerState(JournalState):
+
+    def __init__(self, max_count=0):
+        super().__init__(max_count)
+        self.next_seq = {}
+
+    # the broker is the sequencer, a chat gets its seq here
+    def apply(self, event):
+        if event[0] == "chat":
+            if event[2] is None:
+                event[2] = self.next_seq.get(event[1], 1)
+            self.next_seq[event[1]] = max(self.next_seq.get(event[1], 1), event[2] + 1)
+        super().apply(event)
+
+
+# Small bundled broker. Log frames are applied to a folded copy of the state, given a seq
+# when they are ordered ones and sent to every worker in one order. A worker that connects
+# first gets that folded state as a snapshot. Topic frames are forwarded as they are to the
+# other subscribers, and dropped for a subscriber whose socket buffer is over max_buffer.
+class BackplaneBroker:
+
+    def __init__(self, journal=None, max_count=0, max_buffer=64 * 1024 * 1024):
+        self.state = BrokerState(max_count)
+        self.journal = journal
+        self.max_buffer = max_buffer
+        self.topics = {}
+        # topic -> (publish frame, owner)
+        self.retained = {}
+        self.log_members = set()
+        # (channel, streamer) -> (owner, node)
+        self.live = {}
+        self.nodes = {}
+        if journal is not None:
+            journal.replay(self.state.apply)
+            journal.start()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                op, topic, payload = await read_frame(reader)
+                if op == op_log:
+                    self._log(writer, payload)
+                elif op == op_publish:
+                    self._publish(writer, topic, encode_frame(op_publish, topic, payload))
+                elif op == op_retain:
+                    self._retain(writer, topic, payload)
+                elif op == op_subscribe:
+                    self.topics.setdefault(topic, set()).add(writer)
+                    if self.retained.get(topic) is not None:
+                        self._send(writer, self.retained[topic][0], True)
+                elif op == op_unsubscribe:
+                    self._unsubscribe(writer, topic)
+                elif op == op_sync:
+                    self.nodes[writer] = payload.decode("utf-8")
+                    self._sync(writer)
+        except asyncio.IncompleteReadError:
+            # the worker went away
+            pass
+        except OSError as rrr:
+            log_event(logger, logging.WARNING, "broker_connection_lost", error=repr(rrr))
+        finally:
+            self._drop(writer)
+
+    def _send(self, writer, frame, droppable):
+        if writer.transport.is_closing():
+            return
+        if writer.transport.get_write_buffer_size() > self.max_buffer:
+            if not droppable:
+                # a worker that can not keep up with the log resyncs when it reconnects
+                writer.close()
+            return
+        writer.write(frame)
+
+    def _sync(self, writer):
+        for event in self.state.events():
+            self._send(writer, encode_frame(op_log, "", dumps([None, None, event]).encode("utf-8")), False)
+        for (channel_id, streamer_id), (owner, node) in self.live.items():
+            self._send(writer, encode_frame(op_log, "", dumps(
+                [node, None, ["live", channel_id, streamer_id]]).encode("utf-8")), False)
+        self._send(writer, encode_frame(op_sync, "", b""), False)
+        self.log_members.add(writer)
+
+    def _log(self, writer, payload):
+        envelope = loads(payload)
+        event = envelope[2]
+        if event[0] == "live":
+            self.live[(event[1], event[2])] = (writer, envelope[0])
+        elif event[0] == "offline":
+            self.live.pop((event[1], event[2]), None)
+        else:
+            if self.journal is not None and not self.journal.healthy():
+                # not kept, so no worker gets it either
+                log_event(logger, logging.ERROR, "journal_append_refused", action=event[0],
+                          error=repr(self.journal.error))
+                return
+            self.state.apply(event)
+            if self.journal is not None:
+                try:
+                    self.journal.append(event)
+                except JournalError as rrr:
+                    log_event(logger, logging.ERROR, "journal_append_failed", action=event[0], error=str(rrr))
+            if event[0] in sequenced_actions:
+                payload = dumps(envelope).encode("utf-8")
+        self._broadcast(encode_frame(op_log, "", payload))
+
+    def _broadcast(self, frame):
+        for member in list(self.log_members):
+            self._send(member, frame, False)
+
+    def _publish(self, writer, topic, frame):
+        for subscriber in list(self.topics.get(topic, ())):
+            if subscriber is not writer:
+                self._send(subscriber, frame, True)
+
+    def _retain(self, writer, topic, payload):
+        if not payload:
+            self.retained.pop(topic, None)
+            return
+        frame = encode_frame(op_publish, topic, payload)
+        self.retained[topic] = (frame, writer)
+        self._publish(writer, topic, frame)
+
+    def _unsubscribe(self, writer, topic):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(writer)
+            if not subscribers:
+                del self.topics[topic]
+
+    # whatever a worker left behind goes away with it, its streamers go offline everywhere
+    def _drop(self, writer):
+        self.log_members.discard(writer)
+        for topic in list(self.topics):
+            self._unsubscribe(writer, topic)
+        for topic in [topic for topic, retained in self.retained.items() if retained[1] is writer]:
+            del self.retained[topic]
+        for key in [key for key, live in self.live.items() if live[0] is writer]:
+            owner, node = self.live.pop(key)
+            self._broadcast(encode_frame(op_log, "", dumps([node, None, ["offline", key[0], key[1]]]).encode("utf-8")))
+        self.nodes.pop(writer, None)
+        writer.close()
+
+
+def main():
+    argument_parser = argparse.ArgumentParser()
+    argument_parser.add_argument("--host", default="127.0.0.1")
+    argument_parser.add_argument("--port", type=int, default=7400)
+    # the broker holds the state of every worker, in multi worker mode the journal lives here
+    argument_parser.add_argument("--journal-dir")
+    argument_parser.add_argument("--max-count", type=int, default=10000)
+    arguments = argument_parser.parse_args()
+    configure_logging()
+    journal = None
+    if arguments.journal_dir:
+        journal = Journal(arguments.journal_dir, max_count=arguments.max_count)
+    asyncio.run(BackplaneBroker(journal, arguments.max_count).serve(arguments.host, arguments.port))
+
+
+if __name__ == "__main__":
+    main()
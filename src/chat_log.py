@@ -0,0 +1,261 @@
+import time
+from collections import deque
+from codec import dumps, pack
+
+# rough fixed cost of one record besides its strings, used for the byte budget, and of the
+# field names and punctuation of its json frame
+record_overhead = 120
+frame_overhead = 50
+# the binary protocol names the chat fields by these integers and sends time as epoch ms
+packed_keys = {"seq": 0, "sender": 1, "message": 2, "time": 3, "edited": 4, "deleted": 5, "deleted_by": 6,
+               "redacted": 7}
+
+
+def packed_fields(message_dict):
+    return {packed_keys[key]: value for key, value in message_dict.items()}
+
+
+class ChatMessage:
+    __slots__ = ("seq", "sender", "message", "time", "stamp", "edited", "deleted", "deleted_by", "redacted",
+                 "size", "_frame", "_packed")
+
+    def __init__(self, seq, sender, message, time_str, stamp):
+        self.seq = seq
+        self.sender = sender
+        self.message = message
+        self.time = time_str
+        self.stamp = stamp
+        self.edited = False
+        self.deleted = False
+        self.deleted_by = ""
+        self.redacted = False
+        self.size = record_overhead + frame_overhead + len(sender) + len(message) + len(time_str)
+        self._frame = None
+        self._packed = None
+
+    def to_dict(self):
+        message_dict = {
+            "seq": self.seq,
+            "sender": self.sender,
+            "message": self.message,
+            "time": self.time
+        }
+        if self.edited:
+            message_dict["edited"] = True
+        if self.deleted:
+            message_dict["deleted"] = True
+            message_dict["deleted_by"] = self.deleted_by
+        if self.redacted:
+            message_dict["redacted"] = True
+        return message_dict
+
+    # what edit, delete and redact can change, sent to the subscribers as a delta frame
+    def delta(self):
+        message_dict = self.to_dict()
+        del message_dict["sender"]
+        del message_dict["time"]
+        return message_dict
+
+    # the compact form a spilled channel is written in, see ChannelLog.restore
+    def row(self):
+        return [self.seq, self.sender, self.message, self.time, self.stamp, self.edited, self.deleted,
+                self.deleted_by, self.redacted]
+
+    # called again after every mutation so the cached frames never go stale, they are encoded
+    # the first time they are sent so a replayed history that nobody reads is never encoded
+    def encode(self):
+        self.size = (record_overhead + frame_overhead + len(self.sender) + len(self.message) + len(self.time) +
+                     len(self.deleted_by))
+        self._frame = None
+        self._packed = None
+
+    @property
+    def frame(self):
+        if self._frame is None:
+            self._frame = dumps(self.to_dict())
+        return self._frame
+
+    # the frame of the binary protocol, encoded the first time a binary socket needs it
+    @property
+    def packed(self):
+        if self._packed is None:
+            message_dict = self.to_dict()
+            message_dict["time"] = int(self.stamp * 1000)
+            self._packed = pack(packed_fields(message_dict))
+        return self._packed
+
+
+# Per channel history addressed by monotonically increasing sequence id (first is 1).
+# Records live in fixed size segments, the segment of a seq is found by arithmetic so
+# append and lookup are O(1). Retention trims from the head by count, bytes or age, the
+# segments are a deque so dropping the oldest one does not move the others.
+# A seq the log skipped, e.g. a chat this worker never got, holds None and is never returned.
+class ChannelLog:
+
+    def __init__(self, max_count=0, max_bytes=0, max_age=0, segment_size=1024):
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.segment_size = segment_size
+        self.segments = deque()
+        # seq of segments[0][0], and how many records at the start of segments[0] are evicted
+        self.base_seq = 1
+        self.head = 0
+        self.next_seq = 1
+        # slots from first_seq to next_seq, missing of them are skipped seqs
+        self.count = 0
+        self.missing = 0
+        self.bytes = 0
+
+    def __len__(self):
+        return self.count - self.missing
+
+    def first_seq(self):
+        return self.next_seq - self.count
+
+    def last_seq(self):
+        return self.next_seq - 1
+
+    # seq is given when the chat was numbered elsewhere, the seqs skipped up to it stay empty
+    def append(self, sender, message, time_str, stamp=None, seq=None):
+        if stamp is None:
+            stamp = time.time()
+        if seq is not None and seq > self.next_seq:
+            if self.count == 0:
+                self.segments = deque()
+                self.base_seq = seq
+                self.head = 0
+                self.next_seq = seq
+            else:
+                self._skip(seq)
+        record = ChatMessage(self.next_seq, sender, message, time_str, stamp)
+        self._slot(record)
+        self.bytes += record.size
+        self.trim(stamp)
+        return record
+
+    def _slot(self, record):
+        if not self.segments or len(self.segments[-1]) == self.segment_size:
+            self.segments.append([])
+        self.segments[-1].append(record)
+        self.next_seq += 1
+        self.count += 1
+
+    def _skip(self, seq):
+        while self.next_seq < seq:
+            self._slot(None)
+            self.missing += 1
+
+    # (seq, sender, message, time, stamp) rows of a journal replay appended at once and trimmed
+    # once at the end, a row whose seq is not the next one goes through append
+    def extend(self, rows):
+        segment_size = self.segment_size
+        segments = self.segments
+        for seq, sender, message, time_str, stamp in rows:
+            if seq is not None and seq != self.next_seq:
+                self.append(sender, message, time_str, stamp, seq)
+                segments = self.segments
+                continue
+            record = ChatMessage(self.next_seq, sender, message, time_str, stamp)
+            if not segments or len(segments[-1]) == segment_size:
+                segments.append([])
+            segments[-1].append(record)
+            self.next_seq += 1
+            self.count += 1
+            self.bytes += record.size
+        if rows:
+            self.trim(rows[-1][4])
+
+    # rebuild from ChatMessage.row lists, next_seq is kept when none of them is left
+    def restore(self, rows, next_seq):
+        for seq, sender, message, time_str, stamp, edited, deleted, deleted_by, redacted in rows:
+            record = self.append(sender, message, time_str, stamp, seq)
+            if edited or deleted or redacted:
+                record.edited = edited
+                record.deleted = deleted
+                record.deleted_by = deleted_by
+                record.redacted = redacted
+                self.update(record)
+        if self.count == 0 and next_seq > self.next_seq:
+            self.segments = deque()
+            self.base_seq = next_seq
+            self.head = 0
+            self.next_seq = next_seq
+
+    def get(self, seq):
+        if seq < self.first_seq() or seq >= self.next_seq:
+            return None
+        offset = seq - self.base_seq
+        return self.segments[offset // self.segment_size][offset % self.segment_size]
+
+    # first seq stored at or after stamp, next_seq when there is none, stamps grow with the seqs
+    def seq_at_time(self, stamp):
+        low = self.first_seq()
+        high = self.next_seq
+        while low < high:
+            middle = (low + high) // 2
+            # the newest seq is never skipped
+            probe = middle
+            while self.get(probe) is None:
+                probe += 1
+            if self.get(probe).stamp < stamp:
+                low = probe + 1
+            else:
+                high = middle
+        return low
+
+    # records with seq greater than the given one, oldest first
+    def since(self, seq=0, limit=None):
+        start = max(seq + 1, self.first_seq())
+        stop = self.next_seq
+        if limit is not None:
+            stop = min(stop, start + limit)
+        return self.range(start, stop)
+
+    # records with seq in [start, stop), skipped seqs left out
+    def range(self, start, stop):
+        start = max(start, self.first_seq())
+        stop = min(stop, self.next_seq)
+        records = []
+        while start < stop:
+            offset = start - self.base_seq
+            segment = self.segments[offset // self.segment_size]
+            position = offset % self.segment_size
+            chunk = segment[position:position + stop - start]
+            records.extend(chunk)
+            start += len(chunk)
+        if self.missing:
+            return [record for record in records if record is not None]
+        return records
+
+    def update(self, record):
+        self.bytes -= record.size
+        record.encode()
+        self.bytes += record.size
+
+    def trim(self, now=None):
+        if now is None:
+            now = time.time()
+        while self.count > 0:
+            oldest = self.segments[0][self.head]
+            # the log never starts with a skipped seq
+            if oldest is None:
+                self.missing -= 1
+                self._evict_head(oldest)
+            elif ((self.max_count and self.count - self.missing > self.max_count) or
+                    (self.max_bytes and self.bytes > self.max_bytes) or
+                    (self.max_age and now - oldest.stamp > self.max_age)):
+                self._evict_head(oldest)
+            else:
+                break
+
+    def _evict_head(self, oldest):
+        self.segments[0][self.head] = None
+        self.head += 1
+        self.count -= 1
+        if oldest is not None:
+            self.bytes -= oldest.size
+        if self.head == self.segment_size:
+            self.segments.popleft()
+            self.base_seq += self.segment_size
+            self.head = 0
@@ -0,0 +1,215 @@
+import json
+import struct
+
+# orjson and msgpack are optional, they are used when installed and the pure python
+# implementations are the fallback
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default).decode("utf-8")
+
+    loads = orjson.loads
+else:
+    def dumps(obj):
+        return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=_default)
+
+    loads = json.loads
+
+
+def _default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    raise TypeError("Type is not JSON serializable: %s" % type(obj).__name__)
+
+
+# already encoded json frames are spliced, never decoded again
+def join_frames(frames):
+    return "[" + ",".join(frames) + "]"
+
+
+# ============== MessagePack, the binary encoding of the /ws_v2 "chat.msgpack" subprotocol
+# msgpack is optional as well, the fallback below covers the types the chat frames use
+
+def array_header(length):
+    if length < 16:
+        return bytes((0x90 | length,))
+    if length < 0x10000:
+        return b"\xdc" + struct.pack(">H", length)
+    return b"\xdd" + struct.pack(">I", length)
+
+
+def map_header(length):
+    if length < 16:
+        return bytes((0x80 | length,))
+    if length < 0x10000:
+        return b"\xde" + struct.pack(">H", length)
+    return b"\xdf" + struct.pack(">I", length)
+
+
+def _pack_into(obj, out):
+    kind = type(obj)
+    if obj is None:
+        out.append(0xc0)
+    elif kind is bool:
+        out.append(0xc3 if obj else 0xc2)
+    elif kind is int:
+        if 0 <= obj < 0x80:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj >= 0:
+            for marker, code, limit in ((0xcc, ">B", 0x100), (0xcd, ">H", 0x10000), (0xce, ">I", 0x100000000)):
+                if obj < limit:
+                    out.append(marker)
+                    out += struct.pack(code, obj)
+                    return
+            out.append(0xcf)
+            out += struct.pack(">Q", obj)
+        else:
+            for marker, code, limit in ((0xd0, ">b", 0x80), (0xd1, ">h", 0x8000), (0xd2, ">i", 0x80000000)):
+                if obj >= -limit:
+                    out.append(marker)
+                    out += struct.pack(code, obj)
+                    return
+            out.append(0xd3)
+            out += struct.pack(">q", obj)
+    elif kind is float:
+        out.append(0xcb)
+        out += struct.pack(">d", obj)
+    elif kind is str:
+        data = obj.encode("utf-8")
+        length = len(data)
+        if length < 32:
+            out.append(0xa0 | length)
+        elif length < 0x100:
+            out += bytes((0xd9, length))
+        elif length < 0x10000:
+            out.append(0xda)
+            out += struct.pack(">H", length)
+        else:
+            out.append(0xdb)
+            out += struct.pack(">I", length)
+        out += data
+    elif kind in (bytes, bytearray):
+        length = len(obj)
+        if length < 0x100:
+            out += bytes((0xc4, length))
+        elif length < 0x10000:
+            out.append(0xc5)
+            out += struct.pack(">H", length)
+        else:
+            out.append(0xc6)
+            out += struct.pack(">I", length)
+        out += obj
+    elif kind in (list, tuple, set, frozenset):
+        out += array_header(len(obj))
+        for item in obj:
+            _pack_into(item, out)
+    elif kind is dict:
+        out += map_header(len(obj))
+        for key, value in obj.items():
+            _pack_into(key, out)
+            _pack_into(value, out)
+    else:
+        raise TypeError("Type is not MessagePack serializable: %s" % kind.__name__)
+
+
+# fixed size markers -> (struct format, size)
+_unpack_fixed = {
+    0xca: (">f", 4), 0xcb: (">d", 8),
+    0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+    0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8)
+}
+# str, bin, array and map markers with a length prefix -> (kind, struct format of the length, size)
+_unpack_sized = {
+    0xd9: ("str", ">B", 1), 0xda: ("str", ">H", 2), 0xdb: ("str", ">I", 4),
+    0xc4: ("bin", ">B", 1), 0xc5: ("bin", ">H", 2), 0xc6: ("bin", ">I", 4),
+    0xdc: ("array", ">H", 2), 0xdd: ("array", ">I", 4),
+    0xde: ("map", ">H", 2), 0xdf: ("map", ">I", 4)
+}
+
+
+def _unpack_from(data, position):
+    marker = data[position]
+    position += 1
+    if marker < 0x80:
+        return marker, position
+    if marker >= 0xe0:
+        return marker - 0x100, position
+    if marker == 0xc0:
+        return None, position
+    if marker in (0xc2, 0xc3):
+        return marker == 0xc3, position
+    if 0xa0 <= marker < 0xc0:
+        kind, length = "str", marker & 0x1f
+    elif 0x90 <= marker < 0xa0:
+        kind, length = "array", marker & 0x0f
+    elif 0x80 <= marker < 0x90:
+        kind, length = "map", marker & 0x0f
+    elif marker in _unpack_fixed:
+        code, size = _unpack_fixed[marker]
+        return struct.unpack_from(code, data, position)[0], position + size
+    elif marker in _unpack_sized:
+        kind, code, size = _unpack_sized[marker]
+        length = struct.unpack_from(code, data, position)[0]
+        position += size
+    else:
+        raise ValueError("unsupported MessagePack marker 0x%02x" % marker)
+    if kind == "str":
+        end = position + length
+        if end > len(data):
+            raise ValueError("truncated MessagePack data")
+        return bytes(data[position:end]).decode("utf-8"), end
+    if kind == "bin":
+        end = position + length
+        if end > len(data):
+            raise ValueError("truncated MessagePack data")
+        return bytes(data[position:end]), end
+    if kind == "array":
+        items = []
+        for _ in range(length):
+            item, position = _unpack_from(data, position)
+            items.append(item)
+        return items, position
+    items = {}
+    for _ in range(length):
+        key, position = _unpack_from(data, position)
+        items[key], position = _unpack_from(data, position)
+    return items, position
+
+
+if msgpack is not None:
+    def pack(obj):
+        return msgpack.packb(obj, default=_default)
+
+    def unpack(data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+else:
+    def pack(obj):
+        out = bytearray()
+        _pack_into(obj, out)
+        return bytes(out)
+
+    def unpack(data):
+        try:
+            obj, position = _unpack_from(data, 0)
+        except (IndexError, struct.error) as rrr:
+            raise ValueError("truncated MessagePack data") from rrr
+        if position != len(data):
+            raise ValueError("extra data after MessagePack value")
+        return obj
+
+
+# the binary counterpart of join_frames, packed frames are spliced into one array
+def join_packed(frames):
+    return array_header(len(frames)) + b"".join(frames)
@@ -1,24 +1,179 @@
 import os
 import uuid
+import secrets
 import time
 import asyncio
+import atexit
+import gc
+import collections
+import logging
+import contextlib
+import functools
+import itertools
+import operator
+import random
+import tempfile
 import datetime
-import json
 import uvicorn
 import threading
+import anyio.to_thread
 from fastapi import FastAPI, Body, Header, Response, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import HTMLResponse, PlainTextResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from websockets.exceptions import ConnectionClosed
-from jinja2 import Template
-from starlette.concurrency import run_in_threadpool
-import imageio.v3 as iio
-
-app = FastAPI()
+from fanout import ChannelFanout
+from codec import dumps, loads, join_frames, pack, unpack, join_packed, map_header
+from chat_log import ChannelLog, packed_fields
+from journal import Journal, JournalError
+from stream_buffer import (StreamPublication, StreamBudget, ViewerQueue, viewer_frame_init, viewer_frame_cluster,
+                           max_streamer_id_bytes)
+from webm import WebmStreamParser, WebmError
+from backplane import (InProcessBackplane, SocketBackplane, live_actions, media_topic, encode_media,
+                       decode_media)
+from sharding import ShardRing, DrainingServer, run_sharded, run_shard_worker
+from page_cache import PageCache
+from sessions import SessionTokens, hash_key, verify_key
+from metrics import MetricRegistry, FanoutDelivery, watch_loop_lag
+from receipts import ChannelReceipts, receipt_kinds
+from search import ChannelSearchIndex, tokenize
+from spill import ChannelSpill, encode_history
+from media import MediaPipeline, preview_boundary, missing_decoders
+from snapshot import write_snapshot, read_snapshot
+from logs import configure_logging, log_event
+
+
+# the backplane is created further down with the managers, it connects once the server runs
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    await backplane.start()
+    loop_watcher = None
+    if metrics_enabled:
+        loop_watcher = asyncio.get_running_loop().create_task(
+            watch_loop_lag(event_loop_lag_metric, event_loop_lag_last_metric, metrics_loop_interval))
+    channel_sweeper = None
+    if channel_memory_budget or channel_idle_seconds:
+        channel_sweeper = asyncio.get_running_loop().create_task(sweep_channels())
+    yield
+    if loop_watcher is not None:
+        loop_watcher.cancel()
+    if channel_sweeper is not None:
+        channel_sweeper.cancel()
+    media_pipeline.close()
+    await backplane.close()
+    # nothing changes the state any more, the next process starts from it
+    await write_state()
+
+
+app = FastAPI(lifespan=lifespan)
+logger = logging.getLogger("endpoint")
 
 ws_protocol = "ws"
 if os.environ.get("SSL") == "true":
     ws_protocol = "wss"
 
+chat_outbound_queue_size = int(os.environ.get("CHAT_OUTBOUND_QUEUE_SIZE", "256"))
+chat_slow_consumer_policy = os.environ.get("CHAT_SLOW_CONSUMER_POLICY", "drop_oldest")
+chat_coalesce_max = int(os.environ.get("CHAT_COALESCE_MAX", str(4 * chat_outbound_queue_size)))
+# init sends at most a page of history as array frames of a batch of chats each
+chat_history_page_size = int(os.environ.get("CHAT_HISTORY_PAGE_SIZE", "200"))
+chat_history_batch = int(os.environ.get("CHAT_HISTORY_BATCH", "50"))
+# opt-in micro-batching: chats of a channel stored within the window (or until the cap) go out
+# as one array frame per subscriber, 0 sends every chat on its own
+chat_batch_window = float(os.environ.get("CHAT_BATCH_WINDOW_MS", "0")) / 1000
+chat_batch_max = int(os.environ.get("CHAT_BATCH_MAX", "64"))
+# /ws_v2 subprotocol of the MessagePack frames, chats have integer keys and an epoch ms time,
+# a client not asking for it gets json
+chat_binary_subprotocol = "chat.msgpack"
+# /ws_v2 actions and journal events that change a stored chat, subscribers get them as deltas
+chat_correction_actions = ("edit", "delete", "redact")
+# corrections kept per channel for clients resuming with since, older ones are not replayed
+chat_revision_log = int(os.environ.get("CHAT_REVISION_LOG", "1024"))
+# per channel search index, postings kept before the oldest are dropped, candidates checked by
+# one query before it returns a next_before cursor instead, results per page
+chat_search_max_postings = int(os.environ.get("CHAT_SEARCH_MAX_POSTINGS", "2000000"))
+chat_search_max_scan = int(os.environ.get("CHAT_SEARCH_MAX_SCAN", "5000"))
+chat_search_page_size = int(os.environ.get("CHAT_SEARCH_PAGE_SIZE", "50"))
+# bytes of chat history and search index this process keeps in memory, the least recently used
+# channels past it are spilled to disk, as are the ones unused for CHANNEL_IDLE_SECONDS (0 is no limit)
+channel_memory_budget = int(os.environ.get("CHANNEL_MEMORY_BUDGET", str(512 * 1024 * 1024)))
+channel_idle_seconds = int(os.environ.get("CHANNEL_IDLE_SECONDS", "3600"))
+channel_sweep_interval = float(os.environ.get("CHANNEL_SWEEP_SECONDS", "5"))
+channel_spill_dir = os.environ.get("CHANNEL_SPILL_DIR") or tempfile.gettempdir()
+# spilled channels the sweep writes out at once, the rest waits for the next sweep
+channel_spill_batch = int(os.environ.get("CHANNEL_SPILL_BATCH", "64"))
+
+# receipt acks of a channel are broadcast and journaled together, at most once per interval
+chat_receipt_interval = float(os.environ.get("CHAT_RECEIPT_INTERVAL_MS", "1000")) / 1000
+# channel history retention, 0 means no limit (age is in seconds)
+chat_log_max_count = int(os.environ.get("CHAT_LOG_MAX_COUNT", "10000"))
+chat_log_max_bytes = int(os.environ.get("CHAT_LOG_MAX_BYTES", "0"))
+chat_log_max_age = int(os.environ.get("CHAT_LOG_MAX_AGE", "0"))
+# optional on disk journal, persistence is off when no directory is given
+chat_journal_dir = os.environ.get("CHAT_JOURNAL_DIR")
+chat_journal_commit_ms = int(os.environ.get("CHAT_JOURNAL_COMMIT_MS", "5"))
+chat_journal_segment_bytes = int(os.environ.get("CHAT_JOURNAL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+chat_journal_compact_segments = int(os.environ.get("CHAT_JOURNAL_COMPACT_SEGMENTS", "4"))
+# a segment is also closed once it is this old, so a quiet journal still gets compacted
+chat_journal_segment_seconds = int(os.environ.get("CHAT_JOURNAL_SEGMENT_SECONDS", "3600"))
+# chats are refused while the writer is this far behind or after it failed
+chat_journal_max_pending_bytes = int(os.environ.get("CHAT_JOURNAL_MAX_PENDING_BYTES", str(64 * 1024 * 1024)))
+chat_journal_replay_batch = 4096
+# recent segments kept per streamer for viewers, bounded per streamer and for the whole process
+stream_ring_bytes = int(os.environ.get("STREAM_RING_BYTES", str(8 * 1024 * 1024)))
+stream_ring_segments = int(os.environ.get("STREAM_RING_SEGMENTS", "64"))
+stream_ring_max_age = int(os.environ.get("STREAM_RING_MAX_AGE", "30"))
+stream_process_bytes = int(os.environ.get("STREAM_PROCESS_BYTES", str(256 * 1024 * 1024)))
+# a streamer sending a larger webm element, or more bytes of one element still incomplete, is rejected
+stream_max_element = int(os.environ.get("STREAM_MAX_ELEMENT_BYTES", str(16 * 1024 * 1024)))
+stream_max_pending = int(os.environ.get("STREAM_MAX_PENDING_BYTES", str(32 * 1024 * 1024)))
+# send queue of each /ws_video_view_v2 viewer
+stream_viewer_segments = int(os.environ.get("STREAM_VIEWER_SEGMENTS", "32"))
+stream_viewer_bytes = int(os.environ.get("STREAM_VIEWER_BYTES", str(4 * 1024 * 1024)))
+# "socket" shares chat and video channels with the other workers through the backplane broker
+# on SIGTERM the sockets get DRAIN_TIMEOUT seconds to take what is queued for them, the clients are
+# told to reconnect at a random point of DRAIN_RECONNECT_SPREAD_MS so they do not all come back at once
+drain_timeout = float(os.environ.get("DRAIN_TIMEOUT", "5"))
+drain_reconnect_spread = int(os.environ.get("DRAIN_RECONNECT_SPREAD_MS", "3000"))
+# the state written on drain and loaded by the next process, next to the journal unless set
+state_snapshot_dir = os.environ.get("STATE_SNAPSHOT_DIR")
+
+# thumbnails and MJPEG previews of live streams, decoded by MEDIA_WORKERS processes (0 turns them
+# off) at most once every MEDIA_PREVIEW_INTERVAL seconds per streamer watched in the last MEDIA_PREVIEW_IDLE
+media_workers = int(os.environ.get("MEDIA_WORKERS", "1"))
+media_preview_interval = float(os.environ.get("MEDIA_PREVIEW_INTERVAL", "1"))
+media_preview_width = int(os.environ.get("MEDIA_PREVIEW_WIDTH", "320"))
+media_preview_quality = int(os.environ.get("MEDIA_PREVIEW_QUALITY", "70"))
+media_preview_idle = int(os.environ.get("MEDIA_PREVIEW_IDLE", "30"))
+media_queue_streamers = int(os.environ.get("MEDIA_QUEUE_STREAMERS", "64"))
+media_frame_max_age = float(os.environ.get("MEDIA_FRAME_MAX_AGE", "5"))
+# forkserver imports the server module once for every media worker, spawn once per worker
+media_start_method = os.environ.get("MEDIA_START_METHOD", "forkserver")
+
+backplane_mode = os.environ.get("BACKPLANE", "inprocess")
+backplane_host = os.environ.get("BACKPLANE_HOST", "127.0.0.1")
+backplane_port = int(os.environ.get("BACKPLANE_PORT", "7400"))
+backplane_node_id = os.environ.get("BACKPLANE_NODE_ID") or uuid.uuid4().hex[:12]
+# state events kept while the broker is away, more are lost and counted
+backplane_max_unsent = int(os.environ.get("BACKPLANE_MAX_UNSENT", "10000"))
+server_port = int(os.environ.get("SERVER_PORT", "8000"))
+# templates are re-read when they change on disk, for working on the ui
+template_dev_mode = os.environ.get("TEMPLATE_DEV_MODE") == "true"
+# more than one worker starts a router plus one process per shard, a channel lives on one shard
+server_workers = int(os.environ.get("SERVER_WORKERS", "1"))
+# set by the launcher in each shard process
+shard_index = os.environ.get("SHARD_INDEX")
+shard_ring = ShardRing(server_workers) if shard_index is not None else None
+# alt keys are kept hashed, a login gets a session token signed with a secret all workers share,
+# shards inherit the one of the launcher, workers started on their own need SESSION_SECRET set
+alt_key_hash_iterations = int(os.environ.get("ALT_KEY_HASH_ITERATIONS", "100000"))
+session_ttl = int(os.environ.get("SESSION_TTL", "86400"))
+if not os.environ.get("SESSION_SECRET"):
+    os.environ["SESSION_SECRET"] = secrets.token_hex(32)
+session_secret = os.environ["SESSION_SECRET"]
+# /metrics in prometheus text format, "false" also takes the instrumentation off the hot paths
+metrics_enabled = os.environ.get("METRICS_ENABLED", "true") == "true"
+metrics_loop_interval = float(os.environ.get("METRICS_LOOP_INTERVAL", "0.5"))
+
 lock_1 = threading.Lock()
 
 
@@ -28,6 +183,49 @@ def load_empty_chunk():
 
 
 empty_chunk = load_empty_chunk()
+ui_pages = PageCache("ui", template_dev_mode)
+
+# recorded on the hot paths, the gauges read at scrape time are registered with the managers below
+metric_registry = MetricRegistry()
+chat_messages_metric = metric_registry.counter("chat_messages_total", "Chats stored, per channel", ("channel",))
+chat_fanout_metric = metric_registry.histogram(
+    "chat_fanout_latency_seconds", "Time from store_chat to the last subscriber socket sending the chat")
+chat_batch_size_metric = metric_registry.histogram(
+    "chat_batch_chats", "Chats in each micro-batch sent to a channel", (1, 2, 4, 8, 16, 32, 64, 128, 256))
+chat_batch_wait_metric = metric_registry.histogram(
+    "chat_batch_wait_seconds", "Time from the first chat of a micro-batch to its send")
+stream_ingested_metric = metric_registry.counter(
+    "stream_ingested_bytes_total", "Bytes received from each streamer", ("channel", "streamer"))
+stream_served_metric = metric_registry.counter(
+    "stream_served_bytes_total", "Bytes of each streamer sent to viewers", ("streamer", "transport"))
+media_render_metric = metric_registry.histogram(
+    "media_thumbnail_seconds", "From a keyframe being taken to its thumbnail being ready")
+event_loop_lag_metric = metric_registry.histogram(
+    "event_loop_lag_seconds", "How late the event loop wakes up from a timer")
+event_loop_lag_last_metric = metric_registry.gauge("event_loop_lag_last_seconds", "Latest event loop lag sample")
+
+
+def owns_channel(channel_id):
+    return shard_ring is None or shard_ring.shard(channel_id) == int(shard_index)
+
+
+# a channel created here gets an id that hashes to this shard, so its traffic stays here
+def new_channel_id():
+    while True:
+        channel_id = str(uuid.uuid4())
+        if owns_channel(channel_id):
+            return channel_id
+
+
+# what an index rebuilt from the state has that the maintained one lacks and the other way round
+def index_differences(name, expected, index):
+    problems = []
+    for key in set(expected) | set(index):
+        missing = set(expected.get(key, ())) - set(index.get(key, ()))
+        extra = set(index.get(key, ())) - set(expected.get(key, ()))
+        if missing or extra:
+            problems.append("%s index of %r: missing %r, extra %r" % (name, key, list(missing), list(extra)))
+    return problems
 
 
 class ChatManager:
@@ -44,14 +242,188 @@ class ChatManager:
         "deleted": "boolean",
         "edited": "boolean",
         "deleted_by": "",
+        # kept per member in the channel "receipts", see receipts.ChannelReceipts
         "seen_by": [],
         "received_by": []
     }
-
-    def book_alt_name(self, alt_name, alt_key):
-        if len(alt_name) >= 3 and type(alt_name) == str and type(alt_key) and len(alt_key) >= 8:
+    journal = None
+    backplane = None
+    sessions = None
+    spill = None
+    # admin -> channel ids and member -> channel ids, only changed by _add_channel and _add_member
+    channels_by_admin = {}
+    channels_by_member = {}
+
+    # replay is False when the state was restored from a drain snapshot taken where the journal ends,
+    # apply gets the events in batches
+    def attach_journal(self, journal, apply=None, replay=True):
+        if replay:
+            journal.replay(apply or self.apply_events, chat_journal_replay_batch)
+        journal.start()
+        self.journal = journal
+
+    # False while a journal is attached that refuses appends, see Journal.healthy
+    def writable(self):
+        return self.journal is None or self.journal.healthy()
+
+    # a mutation already applied here, written to the journal and replicated to the other workers.
+    # Mutators check writable first, the journal can still fail in between.
+    def _journal(self, *event):
+        event = list(event)
+        if self.journal is not None:
+            try:
+                self.journal.append(event)
+            except JournalError as e:
+                log_event(logger, logging.ERROR, "journal_append_failed", action=event[0], channel=event[1], error=str(e))
+        if not self.backplane.log(event):
+            log_event(logger, logging.ERROR, "state_event_lost", action=event[0], channel=event[1])
+
+    # a chat comes back from the backplane with its seq, or without one from the in process
+    # backplane and is numbered by the log. The stored record is returned once.
+    def record_chat(self, event):
+        chat = self.apply_event(event)
+        if chat is None:
+            return None
+        if event[2] is None:
+            event[2] = chat.seq
+        # the other workers have it already, it is delivered here as well
+        if self.journal is not None:
+            try:
+                self.journal.append(event)
+            except JournalError as e:
+                log_event(logger, logging.ERROR, "journal_append_failed", action=event[0], channel=event[1], error=str(e))
+        return chat
+
+    # rebuild state from a journal event, credentials were checked when it was written
+    def apply_event(self, event):
+        action = event[0]
+        if action == "alt":
+            # the key is hashed, plain in journals written before keys were hashed
+            self.alt_member_list[event[1]] = {"key": event[2], "name": event[1]}
+            return
+        if action == "channel":
+            if self.non_persistence_message_buffer.get(event[1]) is not None:
+                return
+            self._add_channel(event[1], event[2], event[3], event[4])
+            return
+        channel = self.non_persistence_message_buffer.get(event[1])
+        if channel is None:
+            return
+        if action == "member":
+            self._add_member(event[1], event[2])
+        elif action == "open":
+            channel["open_for_all"] = True
+        elif action == "close":
+            channel["closed"] = True
+        elif action == "chat":
+            self.resident(event[1], channel)
+            # already seen, e.g. in the snapshot of a reconnect
+            if event[2] is not None and event[2] < channel["chats"].next_seq:
+                return None
+            chat = channel["chats"].append(event[3], event[4], event[5], event[6], event[2])
+            channel["version"] += 1
+            if channel["search"] is not None:
+                channel["search"].add(chat, channel["chats"].first_seq())
+            return chat
+        elif action == "receipts":
+            channel["receipts"].restore(event[2])
+        elif action in chat_correction_actions:
+            chat = self.resident(event[1], channel)["chats"].get(event[2])
+            if chat is None:
+                return None
+            channel["version"] += 1
+            # out of the index with the text it had, back in with the new one unless it is gone
+            if channel["search"] is not None:
+                channel["search"].remove(chat)
+            if action == "edit":
+                chat.edited = True
+                chat.message = event[3]
+            elif action == "delete":
+                chat.deleted = True
+                chat.deleted_by = event[3]
+            else:
+                chat.redacted = True
+                chat.message = ""
+            channel["chats"].update(chat)
+            if channel["search"] is not None:
+                channel["search"].add(chat)
+            # the newest seq at the time of the change, see revised_since
+            channel["revisions"].append((channel["chats"].last_seq(), chat.seq))
+            return chat
+
+    # journal replay, a run of chats of one channel goes into its log without the checks of
+    # apply_event for every chat
+    def apply_events(self, events):
+        for (action, channel_id), run in itertools.groupby(events, key=operator.itemgetter(0, 1)):
+            if action == "chat":
+                self.apply_chats(channel_id, run)
+            else:
+                for event in run:
+                    self.apply_event(event)
+
+    def apply_chats(self, channel_id, events):
+        channel = self.non_persistence_message_buffer.get(channel_id)
+        if channel is None:
+            return
+        chats = self.resident(channel_id, channel)["chats"]
+        # already seen, e.g. in the snapshot of a reconnect
+        rows = [event[2:] for event in events if event[2] is None or event[2] >= chats.next_seq]
+        start = chats.next_seq
+        chats.extend(rows)
+        channel["version"] += len(rows)
+        if channel["search"] is not None:
+            for chat in chats.range(start, chats.next_seq):
+                channel["search"].add(chat, chats.first_seq())
+
+    # The chats as the drain snapshot holds them, metadata and the history of every channel as the
+    # blob its spill file has. Histories in memory are only referenced here, they are encoded by
+    # the thread writing the snapshot.
+    def snapshot_state(self):
+        channels = {}
+        histories = {}
+        for channel_id, channel in self.non_persistence_message_buffer.items():
+            channels[channel_id] = {
+                "admin": channel["admin"],
+                "channel_key": channel["channel_key"],
+                "open_for_all": channel["open_for_all"],
+                "closed": channel["closed"],
+                "members": list(channel["members"]),
+                "receipts": channel["receipts"].snapshot()
+            }
+            chats = channel["chats"]
+            if chats is None:
+                histories[channel_id] = functools.partial(self.spill.blob, channel_id)
+            else:
+                histories[channel_id] = functools.partial(
+                    encode_history, chats.range(chats.first_seq(), chats.next_seq), chats.next_seq,
+                    list(channel["revisions"]))
+        alts = {alt_name: alt["key"] for alt_name, alt in self.alt_member_list.items()}
+        return {"alts": alts, "channels": channels}, histories
+
+    # every channel of a drain snapshot starts spilled, its history blob becomes its spill file
+    # and is only decoded when the channel is used
+    def restore_state(self, metadata, history):
+        for alt_name, key in metadata["alts"].items():
+            self.alt_member_list[alt_name] = {"key": key, "name": alt_name}
+        for channel_id, saved in metadata["channels"].items():
+            self._add_channel(channel_id, saved["admin"], saved["channel_key"], saved["open_for_all"])
+            channel = self.non_persistence_message_buffer[channel_id]
+            channel["closed"] = saved["closed"]
+            for member in saved["members"]:
+                self._add_member(channel_id, member)
+            channel["receipts"].restore(saved["receipts"])
+            self.spill.install(channel_id, history(channel_id))
+            channel["chats"] = channel["search"] = channel["revisions"] = None
+
+    # key_hash is the key already hashed off the event loop, see /alt_manager
+    def book_alt_name(self, alt_name, alt_key, key_hash=None):
+        if not self.writable():
+            return False
+        if type(alt_name) == str and len(alt_name) >= 3 and type(alt_key) == str and len(alt_key) >= 8:
             if self.alt_member_list.get(alt_name) is None:
-                self.alt_member_list[alt_name] = {"key": alt_key, "name": alt_name}
+                key_hash = key_hash or hash_key(alt_key, alt_key_hash_iterations)
+                self.alt_member_list[alt_name] = {"key": key_hash, "name": alt_name}
+                self._journal("alt", alt_name, key_hash)
                 return True
             else:
                 return False
@@ -61,106 +433,347 @@ class ChatManager:
     def verify_alt_name(self, alt_name, alt_key):
         if self.alt_member_list.get(alt_name) is None:
             return False
-        elif self.alt_member_list[alt_name]["key"] == alt_key:
-            return True
         else:
-            return False
+            return verify_key(alt_key, self.alt_member_list[alt_name]["key"])
 
     # channel_key is required to join the channel
     def new_channel(self, admin, admin_alt_key, channel_key, open_for_all=False):
-        channel_id = str(uuid.uuid4())
-        self.non_persistence_message_buffer[channel_id] = {}
-        if self.alt_member_list.get(admin) is not None and self.alt_member_list[admin]["key"] == admin_alt_key:
-            self.non_persistence_message_buffer[channel_id]["admin"] = admin
-            self.non_persistence_message_buffer[channel_id]["channel_key"] = channel_key
-            self.non_persistence_message_buffer[channel_id]["chats"] = []
-            self.non_persistence_message_buffer[channel_id]["members"] = set()
-            self.non_persistence_message_buffer[channel_id]["open_for_all"] = open_for_all
-            self.non_persistence_message_buffer[channel_id]["closed"] = False
-            self.non_persistence_message_buffer[channel_id]["tracker_publish"] = False
-            self.non_persistence_message_buffer[channel_id]["members"].add(admin)
+        if not self.writable():
+            return None
+        if self.authenticate_alt_member(admin, admin_alt_key):
+            channel_id = new_channel_id()
+            self._add_channel(channel_id, admin, channel_key, open_for_all)
+            self._journal("channel", channel_id, admin, channel_key, open_for_all)
             return channel_id
         else:
             return None
 
-    def store_chat(self, channel_id, sender_alt, sender_alt_key, message):
-        if self.non_persistence_message_buffer.get(channel_id) is None:
+    # the channel and member maps and their indexes change together, here and in _add_member
+    def _add_channel(self, channel_id, admin, channel_key, open_for_all):
+        self.non_persistence_message_buffer[channel_id] = {
+            "admin": admin,
+            "channel_key": channel_key,
+            "chats": ChannelLog(chat_log_max_count, chat_log_max_bytes, chat_log_max_age),
+            "members": set(),
+            "receipts": ChannelReceipts(),
+            # built on the first search, again after the channel was spilled, then kept up to date
+            "search": None,
+            # (last seq when it happened, seq) of the latest edits, deletes and redactions
+            "revisions": collections.deque(maxlen=chat_revision_log),
+            # counts the changes to chats, search and revisions, the three are None while spilled
+            "version": 0,
+            "open_for_all": open_for_all,
+            "closed": False,
+            "tracker_publish": False
+        }
+        self.channels_by_admin.setdefault(admin, {})[channel_id] = True
+        self._add_member(channel_id, admin)
+        # a channel nobody uses after it was created or restored still goes cold
+        self.spill.touch(channel_id)
+
+    def _add_member(self, channel_id, member):
+        self.non_persistence_message_buffer[channel_id]["members"].add(member)
+        self.non_persistence_message_buffer[channel_id]["receipts"].add_member(member)
+        self.channels_by_member.setdefault(member, {})[channel_id] = True
+
+    def is_channel_member(self, channel_id, alt_name, alt_key):
+        channel = self.non_persistence_message_buffer.get(channel_id)
+        return (channel is not None and alt_name in channel["members"] and
+                self.authenticate_alt_member(alt_name, alt_key))
+
+    # the chat is ordered by the backplane and stored when it comes back through record_chat,
+    # connection is the sending socket so it can be acked
+    def store_chat(self, channel_id, sender_alt, sender_alt_key, message, connection=None):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.post_chat(channel_id, sender_alt, message, connection)
+        else:
+            return False
+
+    # the sender was verified before, e.g. when its websocket was bound to the channel at init
+    def post_chat(self, channel_id, sender_alt, message, connection=None):
+        if not self.writable():
             return False
+        return self.backplane.log(
+            ["chat", channel_id, None, sender_alt, message, str(datetime.datetime.now()), time.time()], connection)
 
-        if (self.alt_member_list.get(sender_alt) is not None and
-                self.alt_member_list[sender_alt]["key"] == sender_alt_key and
-                sender_alt in self.non_persistence_message_buffer[channel_id]["members"]):
-            format_message = {
-                "sender": sender_alt,
-                "message": message,
-                "time": str(datetime.datetime.now())
-            }
-            self.non_persistence_message_buffer[channel_id]["chats"].append(format_message)
-            return True
+    # index is a sequence id, chats after it are returned
+    def get_chat_list(self, channel_id, sender_alt, sender_alt_key, index=0):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return [chat.to_dict() for chat in self.chat_log(channel_id).since(index)]
         else:
             return False
 
-    def get_chat_list(self, channel_id, sender_alt, sender_alt_key, index=0):
-        if (self.alt_member_list.get(sender_alt) is not None and
-                self.alt_member_list[sender_alt]["key"] == sender_alt_key and
-                sender_alt in self.non_persistence_message_buffer[channel_id]["members"]):
-            return self.non_persistence_message_buffer[channel_id]["chats"][index:]
+    def chat_log(self, channel_id):
+        return self.resident(channel_id)["chats"]
+
+    # The channel with its history in memory, faulted back in from its spill file when it was
+    # written out. Every access counts for the recency of the channel.
+    def resident(self, channel_id, channel=None):
+        if channel is None:
+            channel = self.non_persistence_message_buffer[channel_id]
+        if channel["chats"] is None:
+            self._install(channel, self.load_history(channel_id))
+        self.spill.touch(channel_id)
+        return channel
+
+    # the history in the spill file as a new log and revisions, safe to run in the threadpool
+    def load_history(self, channel_id):
+        history = self.spill.read(channel_id)
+        chats = ChannelLog(chat_log_max_count, chat_log_max_bytes, chat_log_max_age)
+        chats.restore(history["rows"], history["next_seq"])
+        revisions = collections.deque((tuple(revision) for revision in history["revisions"]), maxlen=chat_revision_log)
+        return chats, revisions
+
+    def _install(self, channel, history):
+        channel["chats"], channel["revisions"] = history
+        self.spill.faults += 1
+
+    def is_spilled(self, channel_id):
+        channel = self.non_persistence_message_buffer.get(channel_id)
+        return channel is not None and channel["chats"] is None
+
+    # the fault of resident done in the threadpool, every caller on the event loop awaits it
+    # before it uses the history
+    async def fault_in(self, channel_id):
+        channel = self.non_persistence_message_buffer.get(channel_id)
+        if channel is None or channel["chats"] is not None:
+            return
+        history = await run_in_threadpool(self.load_history, channel_id)
+        # faulted in by a sync caller meanwhile
+        if channel["chats"] is None:
+            self._install(channel, history)
+
+    # The spill file of the channel cannot be read and its history is gone. The new log goes on
+    # after the newest chat a member received, the chats still to come keep seqs of their own.
+    def lose_history(self, channel_id):
+        channel = self.non_persistence_message_buffer[channel_id]
+        chats = ChannelLog(chat_log_max_count, chat_log_max_bytes, chat_log_max_age)
+        chats.restore([], max(channel["receipts"].marks["received"], default=0) + 1)
+        channel["chats"], channel["revisions"] = chats, collections.deque(maxlen=chat_revision_log)
+        channel["search"] = None
+        channel["version"] += 1
+
+    def search_index(self, channel_id):
+        channel = self.resident(channel_id)
+        if channel["search"] is None:
+            chats = channel["chats"]
+            channel["search"] = ChannelSearchIndex(chat_search_max_postings)
+            for chat in chats.range(chats.first_seq(), chats.next_seq):
+                channel["search"].add(chat, chats.first_seq())
+        return channel["search"]
+
+    @staticmethod
+    def resident_bytes(channel):
+        return channel["chats"].bytes + (channel["search"].footprint() if channel["search"] is not None else 0)
+
+    # resident and spilled channels and their bytes, spilled bytes being the size on disk
+    def history_usage(self):
+        usage = {"resident": [0, 0], "spilled": [0, self.spill.disk_bytes]}
+        for channel in self.non_persistence_message_buffer.values():
+            if channel["chats"] is None:
+                usage["spilled"][0] += 1
+            else:
+                usage["resident"][0] += 1
+                usage["resident"][1] += self.resident_bytes(channel)
+        return usage
+
+    # Writes the cold channels out and drops their history from memory, see ChannelSpill.cold.
+    # Files are written in the threadpool, a channel changed or used meanwhile stays in memory.
+    # A channel whose file is still current is dropped without writing.
+    async def spill_channels(self, pinned=()):
+        sizes = {channel_id: self.resident_bytes(channel)
+                 for channel_id, channel in self.non_persistence_message_buffer.items() if channel["chats"] is not None}
+        cold = self.spill.cold(sizes, channel_memory_budget, channel_idle_seconds, pinned)
+        spilled = 0
+        for channel_id in cold[:channel_spill_batch]:
+            channel = self.non_persistence_message_buffer[channel_id]
+            version = channel["version"]
+            accessed = self.spill.recency.get(channel_id)
+            if not self.spill.is_current(channel_id, version):
+                chats = channel["chats"]
+                size = await run_in_threadpool(self.spill.write, channel_id, chats.range(chats.first_seq(), chats.next_seq),
+                                               chats.next_seq, list(channel["revisions"]))
+                if channel["version"] != version:
+                    continue
+                self.spill.stored(channel_id, version, size)
+            if channel["chats"] is None or self.spill.recency.get(channel_id) != accessed:
+                continue
+            channel["chats"] = channel["search"] = channel["revisions"] = None
+            self.spill.evicted(channel_id)
+            spilled += 1
+        if spilled:
+            log_event(logger, logging.INFO, "channels_spilled", channels=spilled,
+                      resident_bytes=sum(sizes.values()), disk_bytes=self.spill.disk_bytes)
+
+    def receipts(self, channel_id):
+        return self.non_persistence_message_buffer[channel_id]["receipts"]
+
+    # chats after the since cursor, only the newest limit of them when more are missing
+    def chat_page(self, channel_id, since=0, limit=0):
+        chats = self.chat_log(channel_id)
+        start = since + 1
+        if limit:
+            start = max(start, chats.next_seq - limit)
+        return chats.range(start, chats.next_seq)
+
+    def get_chat_page(self, channel_id, sender_alt, sender_alt_key, since=0, limit=0):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.chat_page(channel_id, since, limit)
+        else:
+            return False
+
+    # chats right before the given seq, used for scroll back
+    def older_chats(self, channel_id, before, limit):
+        return self.chat_log(channel_id).range(before - limit, before)
+
+    def get_older_chats(self, channel_id, sender_alt, sender_alt_key, before, limit):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.older_chats(channel_id, before, limit)
+        else:
+            return False
+
+    # acks past the newest chat are cut to it, returns whether a receipt moved
+    def acknowledge(self, channel_id, member, received=0, seen=0, seen_seqs=()):
+        if not self.writable():
+            return False
+        last_seq = self.chat_log(channel_id).last_seq()
+        return self.receipts(channel_id).acknowledge(
+            member, min(received, last_seq), min(seen, last_seq), [seq for seq in seen_seqs if seq <= last_seq])
+
+    # the receipts acknowledged since the last call, journaled as one event
+    def take_receipts(self, channel_id):
+        channel = self.non_persistence_message_buffer.get(channel_id)
+        # what moved stays changed until the journal takes it again
+        if channel is None or not self.writable():
+            return {}
+        states = channel["receipts"].take_changed()
+        if states:
+            self._journal("receipts", channel_id, states)
+        return states
+
+    def receipts_of(self, channel_id, seq):
+        receipts = self.receipts(channel_id)
+        return {"seq": seq, **{kind + "_by": receipts.acked_by(kind, seq) for kind in receipt_kinds}}
+
+    def get_receipts_of(self, channel_id, sender_alt, sender_alt_key, seq):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.receipts_of(channel_id, seq)
+        else:
+            return False
+
+    # Chats holding every word of query as a prefix, from sender and stored in [after, until)
+    # (epoch seconds), newest first. A page ends before the seq next_before, indexed_from is the
+    # oldest seq the index still covers.
+    def search_chats(self, channel_id, query="", sender=None, after=None, until=None, before=None, limit=20):
+        chats = self.chat_log(channel_id)
+        index = self.search_index(channel_id)
+        low = chats.seq_at_time(after) if after is not None else 1
+        if until is not None:
+            before = min(before or chats.next_seq, chats.seq_at_time(until))
+        results, next_before = index.search(chats, tokenize(query or ""), sender, low, before,
+                                            max(1, min(limit, chat_search_page_size)), chat_search_max_scan)
+        return {"results": [chat.to_dict() for chat in results], "next_before": next_before,
+                "indexed_from": max(index.floor, chats.first_seq())}
+
+    def get_search_chats(self, channel_id, sender_alt, sender_alt_key, **query):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.search_chats(channel_id, **query)
+        else:
+            return False
+
+    def chat_first_index(self, channel_id, sender_alt, sender_alt_key):
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.chat_log(channel_id).first_seq()
         else:
             return False
 
     def chat_last_index(self, channel_id, sender_alt, sender_alt_key):
-        if (self.alt_member_list.get(sender_alt) is not None and
-                self.alt_member_list[sender_alt]["key"] == sender_alt_key and
-                sender_alt in self.non_persistence_message_buffer[channel_id]["members"]):
-            return len(self.non_persistence_message_buffer[channel_id]["chats"])
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            return self.chat_log(channel_id).last_seq()
         else:
             return False
 
     def get_chat_by_index(self, channel_id, sender_alt, sender_alt_key, index):
-        if (self.alt_member_list.get(sender_alt) is not None and
-                self.alt_member_list[sender_alt]["key"] == sender_alt_key and
-                sender_alt in self.non_persistence_message_buffer[channel_id]["members"]):
-            return self.non_persistence_message_buffer[channel_id]["chats"][index]
+        if self.is_channel_member(channel_id, sender_alt, sender_alt_key):
+            chat = self.chat_log(channel_id).get(index)
+            if chat is None:
+                return False
+            return chat.to_dict()
+        else:
+            return False
+
+    # Edit, delete or redact of the chat with message_seq by actor, who is already authenticated.
+    # Only the sender edits, the sender or the channel admin delete and redact, a redacted chat
+    # stays as it is. Returns the changed chat, None when it is not allowed.
+    def correct_chat(self, channel_id, action, actor, message_seq, message=None):
+        channel = self.non_persistence_message_buffer.get(channel_id)
+        if channel is None or not self.writable():
+            return None
+        chat = self.resident(channel_id, channel)["chats"].get(message_seq)
+        if chat is None or chat.redacted:
+            return None
+        if action == "edit":
+            allowed = actor == chat.sender and type(message) == str
+        else:
+            allowed = actor == chat.sender or actor == channel["admin"]
+        if not allowed:
+            return None
+        event = [action, channel_id, message_seq, message if action == "edit" else actor]
+        chat = self.apply_event(event)
+        self._journal(*event)
+        return chat
+
+    def delete_chat(self, channel_id, sender_alt, sender_alt_key, message_seq):
+        if self.authenticate_alt_member(sender_alt, sender_alt_key):
+            return self.correct_chat(channel_id, "delete", sender_alt, message_seq) is not None
+        else:
+            return False
+
+    # only chat owner can edit chat
+    def edit_chat(self, channel_id, sender_alt, sender_alt_key, message_seq, message):
+        if self.authenticate_alt_member(sender_alt, sender_alt_key):
+            return self.correct_chat(channel_id, "edit", sender_alt, message_seq, message) is not None
         else:
             return False
 
-    # only chat owner and channel admin can delete chat
-    def delete_chat(self, channel_id, sender_alt, sender_alt_key, message_index, deleter):
-        if (self.alt_member_list.get(sender_alt) is not None and
-                self.alt_member_list[sender_alt]["key"] == sender_alt_key and
-                (sender_alt == self.non_persistence_message_buffer[channel_id]["chats"][message_index]["sender"] or
-                 sender_alt == self.non_persistence_message_buffer[channel_id]["admin"])):
-            self.non_persistence_message_buffer[channel_id]["chats"][message_index]["deleted"] = True
-            self.non_persistence_message_buffer[channel_id]["chats"][message_index]["deleted_by"] = deleter
+    # the text is removed for good, from the journal snapshots as well
+    def redact_chat(self, channel_id, sender_alt, sender_alt_key, message_seq):
+        if self.authenticate_alt_member(sender_alt, sender_alt_key):
+            return self.correct_chat(channel_id, "redact", sender_alt, message_seq) is not None
         else:
             return False
 
-    #
-    def edit_chat(self, channel_id, sender_alt, sender_alt_key, message_index, message, editor):
-        if (self.alt_member_list.get(sender_alt) is not None and
-                self.alt_member_list[sender_alt]["key"] == sender_alt_key and
-                sender_alt == self.non_persistence_message_buffer[channel_id]["chats"][message_index]["sender"]):
-            if editor == self.non_persistence_message_buffer[channel_id][message_index]["sender"]:
-                self.non_persistence_message_buffer[channel_id][message_index]["edited"] = True
-                self.non_persistence_message_buffer[channel_id][message_index]["message"] = message
+    # chats up to since that were corrected once since was the newest chat, i.e. the ones a
+    # client resuming from since may have missed the delta of
+    def revised_since(self, channel_id, since):
+        chats = self.chat_log(channel_id)
+        revised = {}
+        for at_seq, seq in reversed(self.resident(channel_id)["revisions"]):
+            if at_seq < since:
+                break
+            if seq <= since:
+                revised[seq] = True
+        return [chat for chat in (chats.get(seq) for seq in sorted(revised)) if chat is not None]
 
     def add_member_to_channel(self, channel_id, new_member, new_member_key=None, admin=None, admin_key=None):
-        if self.non_persistence_message_buffer.get(channel_id) is None:
+        if self.non_persistence_message_buffer.get(channel_id) is None or not self.writable():
             return False
 
-        if new_member is self.non_persistence_message_buffer[channel_id]["members"]:
+        if new_member in self.non_persistence_message_buffer[channel_id]["members"]:
             return True
 
         if new_member not in self.alt_member_list.keys():
             return False
 
         if (self.non_persistence_message_buffer[channel_id]["open_for_all"] and
-                self.alt_member_list[new_member]["key"] == new_member_key):
-            self.non_persistence_message_buffer[channel_id]["members"].add(new_member)
+                self.authenticate_alt_member(new_member, new_member_key)):
+            self._add_member(channel_id, new_member)
+            self._journal("member", channel_id, new_member)
             return True
         elif (self.non_persistence_message_buffer[channel_id]["admin"] == admin and
-              self.alt_member_list[admin]["key"] == admin_key):
-            self.non_persistence_message_buffer[channel_id]["members"].add(new_member)
+              self.authenticate_alt_member(admin, admin_key)):
+            self._add_member(channel_id, new_member)
+            self._journal("member", channel_id, new_member)
             return True
         else:
             return False
@@ -169,48 +782,66 @@ class ChatManager:
         return self.alt_member_list.keys()
 
     def open_channel_for_all(self, channel_id, admin, admin_key):
-        if self.non_persistence_message_buffer.get(channel_id) is None:
+        if self.non_persistence_message_buffer.get(channel_id) is None or not self.writable():
             return False
 
         if (self.non_persistence_message_buffer[channel_id]["admin"] == admin and
-                self.alt_member_list.get(admin) is not None and self.alt_member_list[admin]["key"] == admin_key):
+                self.authenticate_alt_member(admin, admin_key)):
             self.non_persistence_message_buffer[channel_id]["open_for_all"] = True
+            self._journal("open", channel_id)
             return True
         else:
             return False
 
     def close_the_channel(self, channel_id, admin, admin_key):
-        if self.non_persistence_message_buffer.get(channel_id) is None:
+        if self.non_persistence_message_buffer.get(channel_id) is None or not self.writable():
             return False
 
         if (self.non_persistence_message_buffer[channel_id]["admin"] == admin and
-                self.alt_member_list.get(admin) is not None and self.alt_member_list[admin]["key"] == admin_key):
+                self.authenticate_alt_member(admin, admin_key)):
             self.non_persistence_message_buffer[channel_id]["closed"] = True
+            self._journal("close", channel_id)
+            # its history leaves memory at the next sweep unless it is read again
+            self.spill.expire(channel_id)
             return True
         else:
             return False
 
     def get_admin_all_channel(self, admin, admin_key):
         admin_channels = []
-        print(self.non_persistence_message_buffer, self.alt_member_list, admin, admin_key)
-        for channel_id in self.non_persistence_message_buffer.keys():
-            if (self.non_persistence_message_buffer[channel_id]["admin"] == admin and
-                    self.alt_member_list.get(admin) is not None and self.alt_member_list[admin]["key"] == admin_key):
-                print(channel_id)
-                admin_channels.append({
-                    "channel": channel_id,
-                    "open_for_all": self.non_persistence_message_buffer[channel_id]["open_for_all"],
-                    "closed": self.non_persistence_message_buffer[channel_id]["closed"],
-                    "members": self.non_persistence_message_buffer[channel_id]["members"]
-                })
-        print(admin_channels)
+        if not self.authenticate_alt_member(admin, admin_key):
+            return admin_channels
+        for channel_id in self.channels_by_admin.get(admin, ()):
+            admin_channels.append({
+                "channel": channel_id,
+                "open_for_all": self.non_persistence_message_buffer[channel_id]["open_for_all"],
+                "closed": self.non_persistence_message_buffer[channel_id]["closed"],
+                "members": self.non_persistence_message_buffer[channel_id]["members"]
+            })
         return admin_channels
 
+    def get_member_all_channel(self, alt_name, alt_key):
+        if not self.authenticate_alt_member(alt_name, alt_key):
+            return []
+        return list(self.channels_by_member.get(alt_name, ()))
+
+    # indexes rebuilt from the channels, the differences to the maintained ones
+    def index_problems(self):
+        channels_by_admin = {}
+        channels_by_member = {}
+        for channel_id, channel in self.non_persistence_message_buffer.items():
+            channels_by_admin.setdefault(channel["admin"], {})[channel_id] = True
+            for member in channel["members"]:
+                channels_by_member.setdefault(member, {})[channel_id] = True
+        return (index_differences("chat admin", channels_by_admin, self.channels_by_admin) +
+                index_differences("chat member", channels_by_member, self.channels_by_member))
+
+    # alt_key is a session token issued to alt_name, a raw key was swapped for one by caller
+    # in the threadpool so the key hash never runs on the event loop
     def authenticate_alt_member(self, alt_name, alt_key):
-        if self.alt_member_list.get(alt_name) is not None and self.alt_member_list[alt_name]["key"] == alt_key:
-            return True
-        else:
+        if self.alt_member_list.get(alt_name) is None:
             return False
+        return self.sessions.verify(alt_key) == alt_name
 
 
 class WebsocketManager:
@@ -218,62 +849,259 @@ class WebsocketManager:
     def __init__(self, cm):
         self.active_connection = {}
         self.chat_manager = cm
-
-    def connect(self, websocket):
-        self.active_connection[websocket] = {}
-
-    async def sync_chat(self, websocket, channel_id, alt_name, alt_pass, init, message=""):
-        if init:
-            till_now_chats = self.chat_manager.get_chat_list(channel_id, alt_name, alt_pass)
-            self.active_connection[websocket]["index"] = len(till_now_chats)
-            self.active_connection[websocket]["channel_id"] = channel_id
-            for chat_by_one in till_now_chats:
-                await websocket.send_json(chat_by_one)
+        self.fanout = ChannelFanout(chat_outbound_queue_size, chat_slow_consumer_policy, chat_coalesce_max)
+        # connection id -> websocket, chats coming back from the backplane name their sender by id
+        self.connections = {}
+        self.connection_ids = itertools.count(1)
+        # channel id -> [window start, [(frame, exclude, delivery, packed)], flush timer] while a micro-batch is open
+        self.batches = {}
+        # channel id -> timer of the next receipts broadcast
+        self.receipt_timers = {}
+
+    def connect(self, websocket, binary=False):
+        connection = next(self.connection_ids)
+        self.active_connection[websocket] = {"connection": connection}
+        self.connections[connection] = websocket
+        self.fanout.connect(websocket, binary)
+
+    def send(self, websocket, message):
+        if self.fanout.is_binary(websocket):
+            return self.fanout.send(websocket, pack(message))
+        return self.fanout.send(websocket, dumps(message))
+
+    # history goes out as array frames of at most chat_history_batch chats
+    def send_history(self, websocket, chats):
+        binary = self.fanout.is_binary(websocket)
+        for i in range(0, len(chats), chat_history_batch):
+            batch = chats[i:i + chat_history_batch]
+            frames = [chat.packed if binary else chat.frame for chat in batch]
+            self.fanout.send(websocket, frames, force=True, chat=True)
+
+    # init checks the credentials once and binds the socket to the member and channel, the
+    # frames after it only carry their action and payload
+    async def sync_chat(self, websocket, channel_id, alt_name, alt_key, since=0):
+        if not owns_channel(channel_id):
+            self.send(websocket, {"Error": "Channel is served by another worker, connect with ?channel_id="})
+            return
+        if not self.chat_manager.is_channel_member(channel_id, alt_name, alt_key):
+            self.send(websocket, {"Error": "Not a member of channel"})
+            return
+        await self.chat_manager.fault_in(channel_id)
+        # a reconnecting client gives the last seq it saw and only gets the missing tail
+        till_now_chats = self.chat_manager.chat_page(channel_id, since, chat_history_page_size)
+        chats = self.chat_manager.chat_log(channel_id)
+        # history snapshot and subscription happen together so no message is missed or repeated
+        self.active_connection[websocket]["index"] = chats.last_seq()
+        self.active_connection[websocket]["channel_id"] = channel_id
+        self.active_connection[websocket]["alt_name"] = alt_name
+        # chats of an open batch are in the snapshot already, they go out before this socket joins
+        self.flush_batch(channel_id)
+        self.fanout.subscribe(websocket, channel_id)
+        self.send(websocket, {"history": {
+            "first_seq": chats.first_seq(),
+            "last_seq": self.active_connection[websocket]["index"]
+        }})
+        self.send_history(websocket, till_now_chats)
+        if since:
+            revised = self.chat_manager.revised_since(channel_id, since)
+            if revised:
+                self.send_deltas(websocket, revised)
+        self.send(websocket, {"receipts": self.chat_manager.receipts(channel_id).snapshot()})
+
+    # somebody send chat message, it is delivered by deliver_chat once it is ordered
+    def post_chat(self, websocket, message):
+        connection = self.active_connection[websocket]
+        if connection.get("alt_name") is None:
+            self.send(websocket, {"Error": "Send init first"})
+            return
+        if not self.chat_manager.post_chat(connection["channel_id"], connection["alt_name"], message,
+                                           connection["connection"]):
+            self.send(websocket, {"Error": "Chat not stored, try again later"})
+
+    # hand a stored chat to the writer of every socket subscribed to the channel on this worker
+    def deliver_chat(self, channel_id, chat, connection=None):
+        websocket = self.connections.get(connection) if connection is not None else None
+        delivery = None
+        if metrics_enabled:
+            chat_messages_metric.inc((channel_id,))
+            delivery = FanoutDelivery(chat.stamp, chat_fanout_metric.observe)
+        packed = chat.packed if self.fanout.binary_writers else None
+        if chat_batch_window > 0:
+            self.queue_batch(channel_id, chat.frame, websocket, delivery, packed)
+        else:
+            self.fanout.broadcast(channel_id, chat.frame, exclude=websocket, delivery=delivery, packed=packed,
+                                  chat=True)
+        if websocket is not None:
+            # sender learns the seq of its own chat so its resume cursor stays right
+            self.send(websocket, {"ack": chat.seq})
+
+    # the first chat opens the window, it closes on the timer or when the batch is full
+    def queue_batch(self, channel_id, frame, websocket, delivery, packed=None):
+        batch = self.batches.get(channel_id)
+        if batch is None:
+            loop = asyncio.get_running_loop()
+            batch = self.batches[channel_id] = [
+                loop.time(), [], loop.call_later(chat_batch_window, self.flush_batch, channel_id)]
+        batch[1].append((frame, websocket, delivery, packed))
+        if len(batch[1]) >= chat_batch_max:
+            self.flush_batch(channel_id)
+
+    def flush_batch(self, channel_id):
+        batch = self.batches.pop(channel_id, None)
+        if batch is None:
+            return
+        started, items, timer = batch
+        timer.cancel()
+        if metrics_enabled:
+            chat_batch_size_metric.observe(len(items))
+            chat_batch_wait_metric.observe(asyncio.get_running_loop().time() - started)
+        self.fanout.broadcast_batch(channel_id, items)
+
+    # the current edit, delete and redact state of chats, the binary form uses the chat keys
+    def delta_frames(self, chats, binary):
+        deltas = [chat.delta() for chat in chats]
+        packed = pack({"deltas": [packed_fields(delta) for delta in deltas]}) if binary else None
+        return dumps({"deltas": deltas}), packed
+
+    def send_deltas(self, websocket, chats):
+        text, packed = self.delta_frames(chats, self.fanout.is_binary(websocket))
+        self.fanout.send(websocket, packed or text)
+
+    def deliver_delta(self, channel_id, chat):
+        # the chat itself may still be in an open batch, it has to go out first
+        self.flush_batch(channel_id)
+        text, packed = self.delta_frames([chat], self.fanout.binary_writers > 0)
+        self.fanout.broadcast(channel_id, text, packed=packed)
+
+    # edit, delete and redact by the member bound to the socket, addressed by seq
+    def correct_chat(self, websocket, action, seq, message=None):
+        connection = self.active_connection[websocket]
+        if connection.get("alt_name") is None:
+            self.send(websocket, {"Error": "Send init first"})
+            return
+        chat = self.chat_manager.correct_chat(connection["channel_id"], action, connection["alt_name"], seq, message)
+        if chat is None:
+            if not self.chat_manager.writable():
+                self.send(websocket, {"Error": "Chat not changed, try again later"})
+            else:
+                self.send(websocket, {"Error": "Cannot %s chat %s" % (action, seq)})
+            return
+        self.deliver_delta(connection["channel_id"], chat)
+
+    # a frame to every socket of the channel, in the format each of them speaks
+    def broadcast(self, channel_id, message):
+        packed = pack(message) if self.fanout.binary_writers else None
+        self.fanout.broadcast(channel_id, dumps(message), packed=packed)
+
+    # receipt acks of the member, what they moved goes out to the channel when the interval is over
+    def acknowledge(self, websocket, received=0, seen=0, seen_seqs=()):
+        connection = self.active_connection[websocket]
+        if connection.get("alt_name") is None:
+            self.send(websocket, {"Error": "Send init first"})
+            return
+        channel_id = connection["channel_id"]
+        moved = self.chat_manager.acknowledge(channel_id, connection["alt_name"], received, seen, seen_seqs)
+        if moved and channel_id not in self.receipt_timers:
+            self.receipt_timers[channel_id] = asyncio.get_running_loop().call_later(
+                chat_receipt_interval, self.flush_receipts, channel_id)
+
+    def flush_receipts(self, channel_id):
+        self.receipt_timers.pop(channel_id, None)
+        states = self.chat_manager.take_receipts(channel_id)
+        if states:
+            self.broadcast(channel_id, {"receipts": states})
+
+    def search(self, websocket, query):
+        connection = self.active_connection[websocket]
+        if connection.get("alt_name") is None:
+            self.send(websocket, {"Error": "Send init first"})
+            return
+        self.send(websocket, {"search": self.chat_manager.search_chats(connection["channel_id"], **query)})
+
+    def receipts_of(self, websocket, seq):
+        connection = self.active_connection[websocket]
+        if connection.get("alt_name") is None:
+            self.send(websocket, {"Error": "Send init first"})
+            return
+        self.send(websocket, {"receipts_of": self.chat_manager.receipts_of(connection["channel_id"], seq)})
+
+    def fetch_older(self, websocket, before, limit):
+        connection = self.active_connection[websocket]
+        if connection.get("alt_name") is None:
+            self.send(websocket, {"Error": "Send init first"})
+            return
+        limit = max(1, min(limit, chat_history_page_size))
+        older_chats = self.chat_manager.older_chats(connection["channel_id"], before, limit)
+        if self.fanout.is_binary(websocket):
+            self.fanout.send(websocket, map_header(1) + pack("older") + join_packed([chat.packed for chat in older_chats]))
         else:
-            # not initialized than somebody send chat message then next is check all the web socket related for
-            # this channel and send the corresponding message
-            chat_manager.store_chat(channel_id, alt_name, alt_pass, message)
-            self.active_connection[websocket]["index"] += 1
-            for ws in self.active_connection.keys():
-                if self.active_connection[ws]["channel_id"] == channel_id and ws != websocket:
-                    index = self.active_connection[ws]["index"]
-                    previous_sync_till_now = self.chat_manager.get_chat_list(channel_id, alt_name, alt_pass, index)
-                    self.active_connection[ws]["index"] = index + len(previous_sync_till_now)
-                    for chat_by_one in previous_sync_till_now:
-                        await ws.send_json(chat_by_one)
+            self.fanout.send(websocket, '{"older":' + join_frames([chat.frame for chat in older_chats]) + '}')
+
+    # Open batches and receipts go out, every socket is told to reconnect with its cursor and gets
+    # up to timeout seconds to take what is queued for it, then it is closed as restarting.
+    async def drain(self, timeout):
+        for channel_id in list(self.batches):
+            self.flush_batch(channel_id)
+        for channel_id, timer in list(self.receipt_timers.items()):
+            timer.cancel()
+            self.flush_receipts(channel_id)
+        for websocket in self.active_connection:
+            self.send(websocket, {"reconnect": {"retry_ms": random.randint(0, drain_reconnect_spread)}})
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.fanout.queue_depths()[0] and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        self.fanout.close_all(1012)
 
     def disconnect(self, websocket):
-        del self.active_connection[websocket]
+        self.fanout.disconnect(websocket)
+        connection = self.active_connection.pop(websocket, None)
+        if connection is not None:
+            self.connections.pop(connection["connection"], None)
 
 
 class VideoStreamingWebSocketManager:
 
-    def __init__(self, vc):
+    def __init__(self, vc, backplane):
         self.active_connection = {}
         self.stream_buffer = {}
+        self.stream_budget = StreamBudget(stream_process_bytes)
+        # channel -> ViewerQueue of every websocket viewer
+        self.channel_viewers = {}
         self.video_conference: VideoConference = vc
+        self.backplane = backplane
+        # channel -> {streamer: node} of the streamers live on other workers
+        self.remote_streamers = {}
+        # (channel, streamer) -> last sequence relayed into the local mirror, None until a keyframe
+        self.mirrors = {}
+        # channel -> streamer websockets, changed with active_connection in connect and disconnect
+        self.connections_by_channel = {}
+        # /broadcast_v2 responses streaming right now
+        self.http_viewers = 0
+        self.media_pipeline = media_pipeline
 
     def connect(self, websocket, channel_id, streamer_id):
         self.active_connection[websocket] = {
             "channel_id": channel_id,
-            "streamer_id": streamer_id
+            "streamer_id": streamer_id,
+            # recorder blobs are re-cut into one continuous webm stream per streamer
+            "parser": WebmStreamParser(stream_max_element, stream_max_pending)
         }
+        self.connections_by_channel.setdefault(channel_id, set()).add(websocket)
         if self.stream_buffer.get(channel_id) is None:
             self.stream_buffer[channel_id] = {}
 
     def is_any_streamer_alive_on_channel(self, channel_id):
-        for ws in self.active_connection.keys():
-            if self.active_connection[ws]["channel_id"] == channel_id:
-                return True
-        return False
+        return bool(self.connections_by_channel.get(channel_id))
 
     def get_live_streamers_on_channel(self, channel_id):
         # (c, l_) = self.sync_write_stream_buffer("ls_streamer", channel_id, None)
         # return c
-        if self.stream_buffer.get(channel_id) is not None:
-            return list(self.stream_buffer[channel_id].keys())
-        else:
-            return []
+        streamers = list(self.stream_buffer.get(channel_id, {}).keys())
+        for streamer_id in self.remote_streamers.get(channel_id, {}):
+            if streamer_id not in streamers:
+                streamers.append(streamer_id)
+        return streamers
 
     def get_my_ws_channel_streamer(self, ws):
         channel_id = self.active_connection[ws]["channel_id"]
@@ -314,160 +1142,779 @@ class VideoStreamingWebSocketManager:
         channel_id = self.active_connection[websocket]["channel_id"]
         streamer_id = self.active_connection[websocket]["streamer_id"]
         # self.sync_write_stream_buffer("chunk", channel_id, streamer_id, chunk)
-        self.stream_buffer[channel_id][streamer_id] = chunk
+        new_streamer = self.stream_buffer[channel_id].get(streamer_id) is None
+        if new_streamer:
+            self.stream_buffer[channel_id][streamer_id] = StreamPublication(
+                stream_ring_bytes, stream_ring_segments, stream_ring_max_age, budget=self.stream_budget,
+                name=streamer_id)
+            self.backplane.log(["live", channel_id, streamer_id])
+        publication = self.stream_buffer[channel_id][streamer_id]
+        parser = self.active_connection[websocket]["parser"]
+        if metrics_enabled:
+            stream_ingested_metric.inc((channel_id, streamer_id), len(chunk))
+        topic = media_topic(channel_id, streamer_id)
+        for unit in parser.feed(chunk):
+            if unit.kind == "init":
+                publication.set_init_header(unit.data, parser.mime)
+                if stream_relay_media:
+                    self.backplane.retain(topic, encode_media(
+                        viewer_frame_init, False, publication.sequence, streamer_id, parser.mime, unit.data))
+            else:
+                publication.publish(unit.data, unit.keyframe)
+                if unit.keyframe:
+                    self.media_pipeline.offer((channel_id, streamer_id), publication.init_header, unit.data)
+                if stream_relay_media:
+                    self.backplane.publish(topic, encode_media(
+                        viewer_frame_cluster, unit.keyframe, publication.sequence, streamer_id, "", unit.data))
+        if new_streamer:
+            for viewer in self.channel_viewers.get(channel_id, {}).values():
+                if viewer.exclude != streamer_id:
+                    viewer.attach(publication)
+            self.announce_streamers(channel_id)
         return True
 
-    def get_chunk_of_channel(self, channel, streamer):
-        while True:
-            if self.stream_buffer.get(channel) is None or self.stream_buffer[channel].get(streamer) is None:
-                # yield b"--frame--"
-                break
-            # frames = iio.imread(self.stream_buffer[channel][streamer], index=None, format_hint=".webm")
-            # delays = 1.0/float(len(frames))
-            # for frame in frames:
-            #    yield b"--frame\\r\\n" b"Content-Type: video/webm\r\r\r\r" + frame + b"\r\n"
-            yield self.stream_buffer[channel][streamer]
-            asyncio.sleep(1.0)
+    def announce_streamers(self, channel_id):
+        related_streamers = self.get_live_streamers_on_channel(channel_id)
+        for viewer in self.channel_viewers.get(channel_id, {}).values():
+            viewer.send_json({"streamer_count": len(related_streamers), "live_streamer": related_streamers})
+
+    # a streamer went live or offline on another worker
+    def apply_live_event(self, node, event):
+        channel_id = event[1]
+        streamer_id = event[2]
+        if event[0] == "live":
+            self.remote_streamers.setdefault(channel_id, {})[streamer_id] = node
+            if self.channel_viewers.get(channel_id):
+                self._mirror(channel_id, streamer_id)
+        else:
+            remote = self.remote_streamers.get(channel_id)
+            if remote is None or remote.pop(streamer_id, None) is None:
+                return
+            if not remote:
+                del self.remote_streamers[channel_id]
+            self._release_mirror(channel_id, streamer_id)
+        self.announce_streamers(channel_id)
+
+    # local publication fed from the backplane, viewers attach to it like to a local streamer
+    def _mirror(self, channel_id, streamer_id):
+        publication = self.stream_buffer.get(channel_id, {}).get(streamer_id)
+        if publication is not None:
+            return publication
+        publication = StreamPublication(
+            stream_ring_bytes, stream_ring_segments, stream_ring_max_age, budget=self.stream_budget,
+            name=streamer_id)
+        self.stream_buffer.setdefault(channel_id, {})[streamer_id] = publication
+        self.mirrors[(channel_id, streamer_id)] = None
+        self.backplane.subscribe(media_topic(channel_id, streamer_id))
+        for viewer in self.channel_viewers.get(channel_id, {}).values():
+            if viewer.exclude != streamer_id:
+                viewer.attach(publication)
+        return publication
+
+    def _release_mirror(self, channel_id, streamer_id):
+        if (channel_id, streamer_id) not in self.mirrors:
+            return
+        del self.mirrors[(channel_id, streamer_id)]
+        self.backplane.unsubscribe(media_topic(channel_id, streamer_id))
+        publication = self.stream_buffer[channel_id].pop(streamer_id, None)
+        if publication is not None:
+            publication.close()
+            self.media_pipeline.discard((channel_id, streamer_id))
+
+    def apply_media(self, topic, payload):
+        channel_id = topic.split("/", 2)[1]
+        kind, keyframe, sequence, streamer_id, mime, data = decode_media(payload)
+        key = (channel_id, streamer_id)
+        if key not in self.mirrors:
+            return
+        publication = self.stream_buffer[channel_id][streamer_id]
+        if kind == viewer_frame_init:
+            publication.set_init_header(data, mime)
+            return
+        # a gap means the broker dropped media for this worker, decoding resumes at a keyframe
+        if not keyframe and (self.mirrors[key] is None or sequence != self.mirrors[key] + 1):
+            self.mirrors[key] = None
+            return
+        self.mirrors[key] = sequence
+        publication.publish(data, keyframe)
+        if keyframe:
+            self.media_pipeline.offer(key, publication.init_header, data)
+
+    # one socket per viewer carries every streamer of the channel, exclude is the viewer's own stream
+    def connect_viewer(self, websocket, channel_id, exclude=None):
+        viewer = ViewerQueue(websocket, stream_viewer_segments, stream_viewer_bytes, exclude,
+                             served_over_websocket if metrics_enabled else None)
+        viewer.start()
+        for streamer_id in self.remote_streamers.get(channel_id, {}):
+            self._mirror(channel_id, streamer_id)
+        if self.channel_viewers.get(channel_id) is None:
+            self.channel_viewers[channel_id] = {}
+        self.channel_viewers[channel_id][websocket] = viewer
+        related_streamers = self.get_live_streamers_on_channel(channel_id)
+        viewer.send_json({"streamer_count": len(related_streamers), "live_streamer": related_streamers})
+        for streamer_id in related_streamers:
+            if streamer_id != exclude:
+                viewer.attach(self.stream_buffer[channel_id][streamer_id])
+
+    def disconnect_viewer(self, websocket, channel_id):
+        viewers = self.channel_viewers.get(channel_id)
+        if viewers is None or viewers.get(websocket) is None:
+            return
+        viewers.pop(websocket).stop()
+        if len(viewers) == 0:
+            del self.channel_viewers[channel_id]
+            for mirror_channel, streamer_id in list(self.mirrors):
+                if mirror_channel == channel_id and not self.stream_buffer[channel_id][streamer_id].viewers:
+                    self._release_mirror(channel_id, streamer_id)
+
+    def get_stream_stats(self, channel, streamer):
+        if self.stream_buffer.get(channel) is None or self.stream_buffer[channel].get(streamer) is None:
+            return None
+        return self.stream_buffer[channel][streamer].stats()
+
+    # viewers wait on the streamer publication and are woken for each new chunk
+    async def get_chunk_of_channel(self, channel, streamer):
+        if streamer in self.remote_streamers.get(channel, {}):
+            self._mirror(channel, streamer)
+        if self.stream_buffer.get(channel) is None or self.stream_buffer[channel].get(streamer) is None:
+            # yield b"--frame--"
+            return
+        # decoded frames are served by get_preview_of_channel, the media workers decode them
+        publication = self.stream_buffer[channel][streamer]
+        self.http_viewers += 1
+        try:
+            async for chunk in publication.subscribe():
+                if metrics_enabled:
+                    stream_served_metric.inc((streamer, "http"), len(chunk))
+                yield chunk
+        finally:
+            self.http_viewers -= 1
+            if (channel, streamer) in self.mirrors and not publication.viewers and not self.channel_viewers.get(channel):
+                self._release_mirror(channel, streamer)
+
+    # the thumbnail of a streamer whose media is on this worker, None when there is none
+    async def get_thumbnail(self, channel, streamer):
+        if self.stream_buffer.get(channel, {}).get(streamer) is None:
+            return None
+        return await self.media_pipeline.thumbnail((channel, streamer))
+
+    # the MJPEG feed of a streamer, every viewer shares the decodes of the media pipeline
+    async def get_preview_of_channel(self, channel, streamer):
+        if streamer in self.remote_streamers.get(channel, {}):
+            self._mirror(channel, streamer)
+        if self.stream_buffer.get(channel, {}).get(streamer) is None:
+            return
+        self.http_viewers += 1
+        try:
+            # closed here so the feed stops counting this viewer before the mirror check
+            async with contextlib.aclosing(self.media_pipeline.preview_feed((channel, streamer))) as parts:
+                async for part in parts:
+                    if metrics_enabled:
+                        stream_served_metric.inc((streamer, "preview"), len(part))
+                    yield part
+        finally:
+            self.http_viewers -= 1
+            if (channel, streamer) in self.mirrors:
+                publication = self.stream_buffer[channel][streamer]
+                preview = self.media_pipeline.previews.get((channel, streamer))
+                if (not publication.viewers and not self.channel_viewers.get(channel) and
+                        (preview is None or not preview.viewers)):
+                    self._release_mirror(channel, streamer)
 
     # This will automatically trigger when server or client close the connection through the exception
     def disconnect(self, websocket):
-        channel_id = self.active_connection[websocket]["channel_id"]
-        streamer_id = self.active_connection[websocket]["streamer_id"]
-        del self.stream_buffer[channel_id][streamer_id]
-        del self.active_connection[websocket]
-
-    # explicitly websocket close all the active connection
+        connection = self.active_connection.pop(websocket, None)
+        if connection is None:
+            return
+        channel_id = connection["channel_id"]
+        streamer_id = connection["streamer_id"]
+        publication = self.stream_buffer[channel_id].pop(streamer_id, None)
+        if publication is not None:
+            publication.close()
+            self.media_pipeline.discard((channel_id, streamer_id))
+            self.backplane.log(["offline", channel_id, streamer_id])
+            if stream_relay_media:
+                self.backplane.retain(media_topic(channel_id, streamer_id), b"")
+            self.announce_streamers(channel_id)
+        connections = self.connections_by_channel.get(channel_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
+                del self.connections_by_channel[channel_id]
+
+    # streamers and viewers are closed as restarting, each is cleaned up by its disconnect
+    def drain(self):
+        websockets = list(self.active_connection)
+        for viewers in self.channel_viewers.values():
+            websockets.extend(viewers)
+        for ws in websockets:
+            asyncio.ensure_future(ws.close(code=1012))
+
+    # explicitly websocket close all the active connection, each is cleaned up by its disconnect
     def end_all_stream_of_channel(self, channel_id, organiser, organiser_password):
-        if (self.video_conference.chat_manager.authenticate_alt_member(organiser, organiser_password)
-                and self.video_conference.channels[channel_id]["host"] == organiser):
-            for ws in self.active_connection.keys():
-                if self.active_connection[ws]["channel_id"] == channel_id:
-                    ws.close()
+        if (self.video_conference.channels.get(channel_id, {}).get("host") == organiser and
+                self.video_conference.chat_manager.authenticate_alt_member(organiser, organiser_password)):
+            for ws in list(self.connections_by_channel.get(channel_id, ())):
+                asyncio.ensure_future(ws.close())
             return True
         else:
             return False
 
+    def index_problems(self):
+        connections_by_channel = {}
+        for ws, connection in self.active_connection.items():
+            connections_by_channel.setdefault(connection["channel_id"], {})[ws] = True
+        return index_differences("streamer socket", connections_by_channel, self.connections_by_channel)
+
 
 class VideoConference:
     channels = {}
+    # host -> channel ids and member -> channel ids, only changed by _add_channel, _add_member and
+    # _remove_member
+    channels_by_host = {}
+    channels_by_member = {}
 
     def __init__(self, chat1_manager):
         self.chat_manager: ChatManager = chat1_manager
 
+    # rebuild state from a journal or backplane event
+    def apply_event(self, event):
+        action = event[0]
+        if action == "vc_channel":
+            if self.channels.get(event[1]) is None:
+                self._add_channel(event[1], event[2])
+            return
+        channel = self.channels.get(event[1])
+        if channel is None:
+            return
+        if action == "vc_member":
+            self._add_member(event[1], event[2])
+        elif action == "vc_remove":
+            self._remove_member(event[1], event[2])
+        elif action == "vc_stream":
+            if channel["streamers"].get(event[2]) is None:
+                channel["streamer_count"] += 1
+            channel["streamers"][event[2]] = event[3]
+
+    def snapshot_state(self):
+        return {channel_id: {"host": channel["host"], "members": list(channel["members"]),
+                             "streamer_count": channel["streamer_count"], "streamers": channel["streamers"]}
+                for channel_id, channel in self.channels.items()}
+
+    def restore_state(self, conferences):
+        for channel_id, saved in conferences.items():
+            self._add_channel(channel_id, saved["host"])
+            for member in saved["members"]:
+                self._add_member(channel_id, member)
+            self.channels[channel_id]["streamer_count"] = saved["streamer_count"]
+            self.channels[channel_id]["streamers"] = saved["streamers"]
+
     def create_channel(self, organiser, organiser_password):
+        if not self.chat_manager.writable():
+            return None
         if self.chat_manager.authenticate_alt_member(organiser, organiser_password):
-            channel_id = str(uuid.uuid4())
-            self.channels[channel_id] = {}
-            self.channels[channel_id]["host"] = organiser
-            self.channels[channel_id]["members"] = set()
-            self.channels[channel_id]["members"].add(organiser)
-            # this streamer count as per request join
-            self.channels[channel_id]["streamer_count"] = 0
-            self.channels[channel_id]["streamers"] = {}
+            channel_id = new_channel_id()
+            self._add_channel(channel_id, organiser)
+            self.chat_manager._journal("vc_channel", channel_id, organiser)
             return channel_id
         else:
             return None
 
+    # the channel and member maps and their indexes change together, here and in the member helpers
+    def _add_channel(self, channel_id, host):
+        # this streamer count as per request join
+        self.channels[channel_id] = {"host": host, "members": set(), "streamer_count": 0, "streamers": {}}
+        self.channels_by_host.setdefault(host, {})[channel_id] = True
+        self._add_member(channel_id, host)
+
+    def _add_member(self, channel_id, member):
+        self.channels[channel_id]["members"].add(member)
+        self.channels_by_member.setdefault(member, {})[channel_id] = True
+
+    def _remove_member(self, channel_id, member):
+        self.channels[channel_id]["members"].discard(member)
+        member_channels = self.channels_by_member.get(member)
+        if member_channels is not None:
+            member_channels.pop(channel_id, None)
+            if not member_channels:
+                del self.channels_by_member[member]
+
     def add_member(self, member, channel_id, organiser, organiser_password):
+        if not self.chat_manager.writable():
+            return False
         if (self.chat_manager.authenticate_alt_member(organiser, organiser_password)
                 and self.channels[channel_id]["host"] == organiser and
                 self.chat_manager.alt_member_list.get(member) is not None):
-            self.channels[channel_id]["members"].add(member)
+            self._add_member(channel_id, member)
+            self.chat_manager._journal("vc_member", channel_id, member)
             return True
         else:
             return False
 
     def remove_member(self, member, channel_id, organiser, organiser_password):
+        if not self.chat_manager.writable():
+            return False
         if (self.chat_manager.authenticate_alt_member(organiser, organiser_password)
                 and self.channels[channel_id]["host"] == organiser):
-            self.channels[channel_id]["members"].remove(member)
+            self._remove_member(channel_id, member)
+            self.chat_manager._journal("vc_remove", channel_id, member)
+            return True
+        else:
+            return False
 
     # only member can join stream would share authentication
     def request_stream_id(self, channel_id, member, member_password):
+        if not self.chat_manager.writable():
+            return None
         if (self.chat_manager.authenticate_alt_member(member, member_password) and
                 member in self.channels[channel_id]["members"]):
             self.channels[channel_id]["streamer_count"] += 1
             if self.channels[channel_id]["streamers"].get(member) is None:
                 stream_id = str(uuid.uuid4())
                 self.channels[channel_id]["streamers"][member] = stream_id
+                self.chat_manager._journal("vc_stream", channel_id, member, stream_id)
             return self.channels[channel_id]["streamers"][member]
         else:
             return None
 
     def get_admin_all_channel(self, host, host_key):
         admin_channels = []
-        print(self.channels, host, host_key)
-        for channel_id in self.channels.keys():
-            if (self.channels[channel_id]["host"] == host and
-                    self.chat_manager.alt_member_list.get(host) is not None and
-                    self.chat_manager.alt_member_list[host]["key"] == host_key):
-                admin_channels.append({
-                    "channel": channel_id,
-                    "open_for_all": False,
-                    "closed": False,
-                    "members": self.channels[channel_id]["members"]
-                })
-        print(admin_channels)
+        if not self.chat_manager.authenticate_alt_member(host, host_key):
+            return admin_channels
+        for channel_id in self.channels_by_host.get(host, ()):
+            admin_channels.append({
+                "channel": channel_id,
+                "open_for_all": False,
+                "closed": False,
+                "members": self.channels[channel_id]["members"]
+            })
         return admin_channels
 
-
+    def get_member_all_channel(self, member, member_key):
+        if not self.chat_manager.authenticate_alt_member(member, member_key):
+            return []
+        return list(self.channels_by_member.get(member, ()))
+
+    def index_problems(self):
+        channels_by_host = {}
+        channels_by_member = {}
+        for channel_id, channel in self.channels.items():
+            channels_by_host.setdefault(channel["host"], {})[channel_id] = True
+            for member in channel["members"]:
+                channels_by_member.setdefault(member, {})[channel_id] = True
+        return (index_differences("conference host", channels_by_host, self.channels_by_host) +
+                index_differences("conference member", channels_by_member, self.channels_by_member))
+
+
+if shard_index is not None:
+    # the shard owning a channel orders its chats, only the control plane is shared
+    backplane = SocketBackplane(backplane_host, backplane_port, backplane_node_id,
+                                local_actions=("chat", "edit", "delete", "redact", "receipts"),
+                                max_unsent=backplane_max_unsent)
+elif backplane_mode == "socket":
+    backplane = SocketBackplane(backplane_host, backplane_port, backplane_node_id, max_unsent=backplane_max_unsent)
+else:
+    backplane = InProcessBackplane(backplane_node_id)
+sessions = SessionTokens(session_secret, session_ttl)
 chat_manager = ChatManager()
+chat_manager.backplane = backplane
+chat_manager.sessions = sessions
+chat_manager.spill = ChannelSpill(os.path.join(channel_spill_dir, "chat-spill-%d" % os.getpid()))
+atexit.register(chat_manager.spill.close)
 video_conference = VideoConference(chat_manager)
 websocket_manager = WebsocketManager(chat_manager)
-stream_ws_manager = VideoStreamingWebSocketManager(video_conference)
+media_pipeline = MediaPipeline(media_workers, media_preview_interval, media_preview_width, media_preview_quality,
+                               media_preview_idle, media_queue_streamers, media_frame_max_age, media_start_method,
+                               media_render_metric.observe if metrics_enabled else None)
+stream_ws_manager = VideoStreamingWebSocketManager(video_conference, backplane)
+# sharded, every viewer of a channel is on the shard of its streamers and media stays local
+stream_relay_media = backplane.remote and shard_index is None
+
+
+def apply_state_event(event):
+    if event[0].startswith("vc_"):
+        video_conference.apply_event(event)
+    else:
+        chat_manager.apply_event(event)
+
+
+# journal replay, see ChatManager.apply_events
+def apply_state_events(events):
+    chat_events = []
+    for event in events:
+        if event[0].startswith("vc_"):
+            chat_manager.apply_events(chat_events)
+            chat_events = []
+            video_conference.apply_event(event)
+        else:
+            chat_events.append(event)
+    chat_manager.apply_events(chat_events)
+
+
+# channel -> chats and corrections from the backplane waiting for the channel to be faulted in
+faulting_channels = {}
+
+
+# events handed back by the backplane: ordered ones from any worker, the rest from the others.
+# Those of a spilled channel wait until its history was read in the threadpool.
+def apply_backplane_event(node, connection, event):
+    if event[0] in live_actions:
+        stream_ws_manager.apply_live_event(node, event)
+    elif event[0] == "chat" or event[0] in chat_correction_actions:
+        waiting = faulting_channels.get(event[1])
+        if waiting is None and chat_manager.is_spilled(event[1]):
+            waiting = faulting_channels[event[1]] = []
+            asyncio.get_running_loop().create_task(apply_after_fault(event[1]))
+        if waiting is not None:
+            waiting.append((node, connection, event))
+        else:
+            apply_chat_event(node, connection, event)
+    else:
+        apply_state_event(event)
+
+
+def apply_chat_event(node, connection, event):
+    if event[0] == "chat":
+        chat = chat_manager.record_chat(event)
+        if chat is not None:
+            websocket_manager.deliver_chat(event[1], chat, connection if node == backplane.node_id else None)
+    else:
+        # made on another worker, its subscribers here still get the delta
+        chat = chat_manager.apply_event(event)
+        if chat is not None:
+            websocket_manager.deliver_delta(event[1], chat)
+
+
+# the waiting events go in their order, before any newer one of the channel, also when the
+# history could not be read
+async def apply_after_fault(channel_id):
+    try:
+        await chat_manager.fault_in(channel_id)
+    except Exception as rrr:
+        log_event(logger, logging.ERROR, "channel_history_lost", channel=channel_id, error=repr(rrr))
+        chat_manager.lose_history(channel_id)
+    finally:
+        waiting = faulting_channels.pop(channel_id)
+    for node, connection, event in waiting:
+        apply_chat_event(node, connection, event)
+
+
+backplane.bind(apply_backplane_event, stream_ws_manager.apply_media)
+
+
+# channels with a socket or an open batch on this worker stay in memory, the cold rest is spilled
+async def sweep_channels():
+    while True:
+        await asyncio.sleep(channel_sweep_interval)
+        pinned = set(websocket_manager.fanout.channel_subscribers) | set(websocket_manager.batches)
+        try:
+            await chat_manager.spill_channels(pinned)
+        except OSError:
+            logger.exception("Exception capture on channel spill")
+
+
+# the maintained indexes against ones rebuilt from the state they index, empty when they agree
+def check_indexes():
+    return chat_manager.index_problems() + video_conference.index_problems() + stream_ws_manager.index_problems()
+
+
+def served_over_websocket(streamer_id, size):
+    stream_served_metric.inc((streamer_id, "ws"), size)
+
+
+def connection_counts():
+    return {
+        ("ws_v2",): len(websocket_manager.active_connection),
+        ("ws_video_v2",): len(stream_ws_manager.active_connection),
+        ("ws_video_view_v2",): sum(len(viewers) for viewers in stream_ws_manager.channel_viewers.values()),
+        ("broadcast_v2",): stream_ws_manager.http_viewers
+    }
+
+
+def chat_queue_depths():
+    total, deepest = websocket_manager.fanout.queue_depths()
+    return {("total",): total, ("max",): deepest}
+
+
+def viewer_queues():
+    return [viewer for viewers in stream_ws_manager.channel_viewers.values() for viewer in viewers.values()]
+
+
+def streamer_buffer_bytes():
+    return {(channel_id, streamer_id): publication.bytes
+            for channel_id, publications in stream_ws_manager.stream_buffer.items()
+            for streamer_id, publication in publications.items()}
+
+
+def channel_history(index):
+    return {(state,): values[index] for state, values in chat_manager.history_usage().items()}
+
+
+# requests of the sync routes and run_in_threadpool calls share this limiter, read on the event loop
+def threadpool_usage():
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    return {("busy",): limiter.borrowed_tokens, ("max",): limiter.total_tokens,
+            ("waiting",): limiter.statistics().tasks_waiting}
+
+
+metric_registry.gauge_function("connections", "Open connections per endpoint", connection_counts, ("endpoint",))
+metric_registry.gauge_function(
+    "chat_outbound_queue_frames", "Frames queued for /ws_v2 sockets, all of them and the fullest socket",
+    chat_queue_depths, ("queue",))
+metric_registry.gauge_function(
+    "chat_outbound_dropped_frames", "Frames dropped for the slow /ws_v2 sockets still connected",
+    lambda: sum(writer.dropped for writer in websocket_manager.fanout.writers.values()))
+metric_registry.gauge_function(
+    "stream_viewer_queue_bytes", "Bytes queued for /ws_video_view_v2 sockets",
+    lambda: sum(viewer.bytes for viewer in viewer_queues()))
+metric_registry.gauge_function(
+    "stream_viewer_dropped_segments", "Segments dropped for the slow viewers still connected",
+    lambda: sum(viewer.dropped for viewer in viewer_queues()))
+metric_registry.gauge_function("backplane_buffered_bytes", "Bytes waiting to go to the backplane broker",
+                               backplane.buffered)
+metric_registry.gauge_function("backplane_lost_events", "State events neither sent to the broker nor kept",
+                               lambda: backplane.lost)
+metric_registry.gauge_function("stream_buffer_bytes", "Bytes held by every stream ring of this process",
+                               lambda: stream_ws_manager.stream_budget.bytes)
+metric_registry.gauge_function("stream_buffer_streamer_bytes", "Bytes held by the stream ring of each streamer",
+                               streamer_buffer_bytes, ("channel", "streamer"))
+metric_registry.gauge_function("channels", "Channels with their history in memory and spilled to disk",
+                               lambda: channel_history(0), ("state",))
+metric_registry.gauge_function(
+    "channel_history_bytes", "Bytes of chat history and search index in memory, and spilled to disk",
+    lambda: channel_history(1), ("state",))
+metric_registry.gauge_function("channel_spills", "Channels written out of memory since start",
+                               lambda: chat_manager.spill.spills)
+metric_registry.gauge_function("channel_faults", "Spilled channels read back into memory since start",
+                               lambda: chat_manager.spill.faults)
+metric_registry.gauge_function(
+    "media_thumbnails", "Keyframes decoded into thumbnails, dropped as stale and failed since start",
+    lambda: {("rendered",): media_pipeline.rendered, ("dropped",): media_pipeline.dropped,
+             ("failed",): media_pipeline.failed}, ("outcome",))
+metric_registry.gauge_function("media_queue_streamers", "Streamers with a keyframe waiting for a media worker",
+                               lambda: len(media_pipeline.queue))
+metric_registry.gauge_function(
+    "journal_healthy", "1 while the journal takes appends, 0 once its writer failed or is too far behind",
+    lambda: int(chat_manager.writable()))
+metric_registry.gauge_function("journal_pending_bytes", "Bytes waiting for the journal writer",
+                               lambda: chat_manager.journal.pending_bytes if chat_manager.journal is not None else 0)
+metric_registry.gauge_function("threadpool_threads", "Worker threads busy, allowed and tasks waiting for one",
+                               threadpool_usage, ("state",))
+
+
+# with the socket backplane the broker holds the state of every worker and keeps the journal,
+# a shard keeps the chats of its own channels, the launcher process keeps nothing
+def journal_directory():
+    if chat_journal_dir and shard_index is not None:
+        return os.path.join(chat_journal_dir, "shard-%s" % shard_index)
+    if chat_journal_dir and not backplane.remote and server_workers == 1:
+        return chat_journal_dir
+    return None
+
+
+def state_snapshot_path():
+    if state_snapshot_dir:
+        directory = state_snapshot_dir if shard_index is None else os.path.join(state_snapshot_dir, "shard-%s" % shard_index)
+    else:
+        directory = journal_directory()
+    if directory is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, "state.snap")
+
+
+# The drain snapshot, used only when it was written by a clean shutdown and the journal still
+# ends where it ended then, i.e. nothing ran in between. It is read once: the file is renamed
+# right away so a later start never takes it again. Returns whether the state came from it.
+def restore_state(journal=None):
+    path = state_snapshot_path()
+    snapshot = read_snapshot(path) if path is not None else None
+    if snapshot is None:
+        return False
+    os.replace(path, path + ".consumed")
+    metadata, history = snapshot
+    journal_end = journal.end() if journal is not None else None
+    if not metadata.get("clean_shutdown") or metadata["journal"] != journal_end:
+        log_event(logger, logging.INFO, "state_snapshot_stale", path=path)
+        return False
+    chat_manager.restore_state(metadata, history)
+    video_conference.restore_state(metadata["conferences"])
+    return True
+
+
+# Written by the lifespan once the sockets are drained, after the journal committed everything
+# it had. The histories are encoded in the threadpool.
+async def write_state():
+    path = state_snapshot_path()
+    if path is None:
+        return
+    started = time.perf_counter()
+    journal_end = None
+    if chat_manager.journal is not None:
+        await run_in_threadpool(chat_manager.journal.close)
+        journal_end = chat_manager.journal.end()
+    metadata, histories = chat_manager.snapshot_state()
+    metadata["conferences"] = video_conference.snapshot_state()
+    metadata["journal"] = journal_end
+    # a journal that lost writes is behind the state, the next process replays it rather
+    metadata["clean_shutdown"] = chat_manager.journal is None or chat_manager.journal.healthy()
+    size = await run_in_threadpool(write_snapshot, path, metadata, histories)
+    log_event(logger, logging.INFO, "state_written", path=path, bytes=size, channels=len(histories),
+              seconds=round(time.perf_counter() - started, 3))
+
+
+# SIGTERM, the listeners are closed already: chat sockets get what is queued for them and are
+# told to reconnect, streams end. The state is written by the lifespan right after.
+async def drain():
+    log_event(logger, logging.INFO, "drain_started", chat_sockets=len(websocket_manager.active_connection),
+              stream_sockets=len(stream_ws_manager.active_connection))
+    stream_ws_manager.drain()
+    await websocket_manager.drain(drain_timeout)
+
+
+# The app with the state of this process loaded, from the drain snapshot or else the journal.
+# python endpoint.py serves it, or uvicorn endpoint:create_app --factory (without the drain).
+def create_app():
+    # LOG_LEVEL, LOG_LEVELS, LOG_SAMPLE and LOG_FORMAT are read here, see logs.configure_logging
+    configure_logging()
+    started = time.perf_counter()
+    # the previews need decoders the chat does not, without them they stay off
+    missing = missing_decoders() if media_pipeline.workers else []
+    if missing:
+        log_event(logger, logging.WARNING, "media_previews_off", missing=", ".join(missing))
+        media_pipeline.workers = 0
+    journal = None
+    directory = journal_directory()
+    if directory is not None:
+        journal = Journal(directory, chat_journal_commit_ms / 1000.0, chat_journal_segment_bytes,
+                          chat_journal_compact_segments, chat_log_max_count, chat_journal_segment_seconds,
+                          chat_journal_max_pending_bytes)
+    restored = restore_state(journal)
+    if journal is not None:
+        chat_manager.attach_journal(journal, apply_state_events, replay=not restored)
+        atexit.register(journal.close)
+    # what was loaded lives as long as the process, the garbage collector need not scan it again
+    gc.freeze()
+    log_event(logger, logging.INFO, "state_loaded", source="snapshot" if restored else "journal" if journal else "none",
+              channels=len(chat_manager.non_persistence_message_buffer),
+              seconds=round(time.perf_counter() - started, 3))
+    return app
+
+
+# who makes a call: the alt name of its session token, or the name and key fields it carries.
+# The key is checked in the threadpool and swapped for a session token, None when it is wrong.
+async def caller(body, name_field="alt_login_name", key_field="alt_login_pass"):
+    token = body.get("token")
+    if token is not None:
+        return sessions.verify(token), token
+    alt_name = body.get(name_field)
+    if type(alt_name) != str or not await run_in_threadpool(chat_manager.verify_alt_name, alt_name, body.get(key_field)):
+        return alt_name, None
+    return alt_name, sessions.issue(alt_name)
+
+
+# the search fields of a /ws_v2 frame or an http body, see ChatManager.search_chats
+def search_query(body):
+    return {
+        "query": str(body.get("query") or ""),
+        "sender": body.get("sender"),
+        "after": None if body.get("after") is None else float(body.get("after")),
+        "until": None if body.get("until") is None else float(body.get("until")),
+        "before": None if body.get("before") is None else int(body.get("before")),
+        "limit": int(body.get("limit") or 20)
+    }
 
 
 @app.websocket("/ws_v2")
 async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    websocket_manager.connect(websocket)
+    binary = chat_binary_subprotocol in websocket.scope.get("subprotocols", ())
+    await websocket.accept(subprotocol=chat_binary_subprotocol if binary else None)
+    websocket_manager.connect(websocket, binary)
+    receive, decode = (websocket.receive_bytes, unpack) if binary else (websocket.receive_text, loads)
     try:
         while True:
-            data = await websocket.receive_text()
-            data_json = json.loads(data)
-            print(data_json)
-            if data_json["action"] == "close":
-                await websocket.close()
-                websocket_manager.disconnect(websocket)
-                break
-            elif data_json["action"] == "init":
-                await websocket_manager.sync_chat(
-                    websocket, data_json["channel_id"], data_json["alt_name"], data_json["alt_pass"], True)
-            elif data_json["action"] == "continue":
-                await websocket_manager.sync_chat(
-                    websocket, data_json["channel_id"], data_json["alt_name"], data_json["alt_pass"], False,
-                    data_json["message"])
-            else:
-                await websocket.send_json({"Error": "Error"})
+            data = await receive()
+            try:
+                if not await handle_chat_frame(websocket, decode(data)):
+                    break
+            except (ValueError, KeyError, TypeError) as rrr:
+                # a frame that does not parse or lacks a field is answered, the socket stays open
+                log_event(logger, logging.DEBUG, "ws_bad_frame", endpoint="ws_v2", error=repr(rrr))
+                websocket_manager.send(websocket, {"Error": "Malformed frame"})
     except (WebSocketDisconnect, ConnectionClosed) as rrr:
-        print("Exception capture on websocket connection", rrr)
+        log_event(logger, logging.DEBUG, "ws_disconnect", endpoint="ws_v2", code=str(rrr))
+    except Exception:
+        logger.exception("Exception capture on ws_v2")
+        with contextlib.suppress(RuntimeError, ConnectionClosed):
+            await websocket.close(code=1011)
+    finally:
         websocket_manager.disconnect(websocket)
 
 
+# one decoded /ws_v2 frame, False once the client closed the socket
+async def handle_chat_frame(websocket, data_json):
+    # every frame at debug, LOG_SAMPLE=ws_frame=0.01 keeps a fraction of them
+    if logger.isEnabledFor(logging.DEBUG):
+        log_event(logger, logging.DEBUG, "ws_frame", frame=data_json)
+    if data_json["action"] == "close":
+        await websocket.close()
+        return False
+    elif data_json["action"] == "init":
+        alt_name, alt_key = await caller(data_json, "alt_name", "alt_pass")
+        await websocket_manager.sync_chat(
+            websocket, data_json["channel_id"], alt_name, alt_key, int(data_json.get("since") or 0))
+    elif data_json["action"] == "continue":
+        websocket_manager.post_chat(websocket, data_json["message"])
+    elif data_json["action"] == "fetch_older":
+        websocket_manager.fetch_older(
+            websocket, int(data_json["before"]), int(data_json.get("limit") or chat_history_page_size))
+    elif data_json["action"] == "receipt":
+        # received and seen are high-water marks, seen_seqs the chats seen out of order
+        websocket_manager.acknowledge(
+            websocket, int(data_json.get("received") or 0), int(data_json.get("seen") or 0),
+            [int(seq) for seq in (data_json.get("seen_seqs") or ())[:chat_history_page_size]])
+    elif data_json["action"] == "receipts_of":
+        websocket_manager.receipts_of(websocket, int(data_json["seq"]))
+    elif data_json["action"] == "search":
+        websocket_manager.search(websocket, search_query(data_json))
+    elif data_json["action"] in chat_correction_actions:
+        websocket_manager.correct_chat(
+            websocket, data_json["action"], int(data_json["seq"]), data_json.get("message"))
+    else:
+        websocket_manager.send(websocket, {"Error": "Error"})
+    return True
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    if not metrics_enabled:
+        return Response(status_code=404)
+    return PlainTextResponse(metric_registry.render(), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/ui_v2")
-def bot_ui(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "chat_ui_v2.template"), "r") as f:
-        initial_ui = Template(
-            f.read()).render(
-            proto=ws_protocol,
-            wss_port=os.environ["WSS_PORT"],
-            wss_host=os.environ["WSS_HOST"]
-        )
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+def bot_ui(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(
+        request, "chat_ui_v2.template", proto=ws_protocol, wss_port=os.environ["WSS_PORT"], wss_host=os.environ["WSS_HOST"])
 
 
 @app.post("/alt_manager")
 async def alt_manager(request: Request):
     body = await request.json()
-    # {initiate: True, persona: "", "bot_response": ""}
-    print(body, type(body))
+    log_event(logger, logging.INFO, "alt_manager", action=body.get("action"),
+              alt_name=body.get("alt_login_name"))
+    # keys are hashed in the threadpool, the event loop keeps serving the chats meanwhile
     if body.get("action") == "link":
-        return {"result": chat_manager.verify_alt_name(body.get("alt_login_name"), body.get("alt_login_pass"))}
+        alt_name = body.get("alt_login_name")
+        result = await run_in_threadpool(chat_manager.verify_alt_name, alt_name, body.get("alt_login_pass"))
+        # the token stands in for name and key in every later call and in the /ws_v2 init
+        return {"result": result, "token": sessions.issue(alt_name) if result else None}
     elif body.get("action") == "create":
-        return {"result": chat_manager.book_alt_name(body.get("alt_login_name"), body.get("alt_login_pass"))}
+        alt_key = body.get("alt_login_pass")
+        key_hash = None
+        if type(alt_key) == str:
+            key_hash = await run_in_threadpool(hash_key, alt_key, alt_key_hash_iterations)
+        return {"result": chat_manager.book_alt_name(body.get("alt_login_name"), alt_key, key_hash)}
     else:
         return {"result": False}
 
@@ -477,30 +1924,47 @@ async def channel_adminer(request: Request):
     body = await request.json()
     # {initiate: True, persona: "", "bot_response": ""}
     if body.get("action") == "create":
-        return {"channel_id": chat_manager.new_channel(
-            body.get("alt_login_name"), body.get("alt_login_pass"), body.get("channel_key"), body.get("open")
-        )}
+        alt_name, alt_key = await caller(body)
+        return {"channel_id": chat_manager.new_channel(alt_name, alt_key, body.get("channel_key"), body.get("open"))}
     elif body.get("action") == "joiner":
         if body.get("admin") is None:
-            return {"result": chat_manager.add_member_to_channel(
-                body.get("channel_id"), body.get("alt_login_name"), body.get("alt_login_pass")
-            )}
+            alt_name, alt_key = await caller(body)
+            return {"result": chat_manager.add_member_to_channel(body.get("channel_id"), alt_name, alt_key)}
         else:
+            admin, admin_key = await caller(body, "admin", "admin_key")
             return {"result": chat_manager.add_member_to_channel(
-                body.get("channel_id"), body.get("alt_login_name"), body.get("admin"), body.get("admin_key")
+                body.get("channel_id"), body.get("alt_login_name"), admin=admin, admin_key=admin_key
             )}
     elif body.get("action") == "open_for_all":
         return {"result": ""}
     elif body.get("action") == "add_member":
-        return {"result": chat_manager.add_member_to_channel(body.get("channel_id"), body.get("admin"), body.get("admin_key"))}
+        admin, admin_key = await caller(body, "admin", "admin_key")
+        return {"result": chat_manager.add_member_to_channel(
+            body.get("channel_id"), body.get("member"), admin=admin, admin_key=admin_key
+        )}
     elif body.get("action") == "close_channel":
         return {"result": ""}
+    elif body.get("action") == "member_channels":
+        alt_name, alt_key = await caller(body)
+        return {"result": chat_manager.get_member_all_channel(alt_name, alt_key)}
+    elif body.get("action") == "search":
+        # only the worker of the channel has its chats, the router finds it by ?channel_id=
+        if type(body.get("channel_id")) == str and not owns_channel(body.get("channel_id")):
+            return {"result": None, "Error": "Channel is served by another worker, send it with ?channel_id="}
+        alt_name, alt_key = await caller(body)
+        if chat_manager.is_channel_member(body.get("channel_id"), alt_name, alt_key):
+            await chat_manager.fault_in(body.get("channel_id"))
+        return {"result": chat_manager.get_search_chats(body.get("channel_id"), alt_name, alt_key, **search_query(body))}
+    elif body.get("action") == "receipts":
+        if type(body.get("channel_id")) == str and not owns_channel(body.get("channel_id")):
+            return {"result": None, "Error": "Channel is served by another worker, send it with ?channel_id="}
+        alt_name, alt_key = await caller(body)
+        return {"result": chat_manager.get_receipts_of(body.get("channel_id"), alt_name, alt_key, int(body.get("seq")))}
     elif body.get("action") == "fetch_admin_ui":
-        with open(os.path.join("ui", "channel_admin.template"), "r") as f:
-            initial_ui = Template(
-                f.read()).render(
-                channels=chat_manager.get_admin_all_channel(body.get("admin"), body.get("admin_key"))
-            )
+        admin, admin_key = await caller(body, "admin", "admin_key")
+        initial_ui = ui_pages.render(
+            "channel_admin.template", channels=chat_manager.get_admin_all_channel(admin, admin_key)
+        )
         return {"result": initial_ui}
     else:
         return {"result": None}
@@ -515,27 +1979,21 @@ async def websocket_video_endpoint(websocket: WebSocket):
             data = await websocket.receive_bytes()
             await websocket.send_bytes(data)
     except (WebSocketDisconnect, ConnectionClosed) as rrr:
-        print("Exception capture on websocket connection", rrr)
+        log_event(logger, logging.DEBUG, "ws_disconnect", endpoint="ws_video", code=str(rrr))
 
 
 @app.get("/video_ui_test")
-def video_ui(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "video_stream_test_ui.template"), "r") as f:
-        initial_ui = Template(
-            f.read()).render(
-            proto=ws_protocol,
-            wss_port=os.environ["WSS_PORT"],
-            wss_host=os.environ["WSS_HOST"]
-        )
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+def video_ui(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(
+        request, "video_stream_test_ui.template", proto=ws_protocol, wss_port=os.environ["WSS_PORT"], wss_host=os.environ["WSS_HOST"])
 
 
 # ================ Video/Audio Conference =======================
 @app.websocket("/ws_video_v2/{channel}/{streamer}")
 async def websocket_video_stream_endpoint(channel: str, streamer: str, websocket: WebSocket):
+    if len(streamer.encode("utf-8")) > max_streamer_id_bytes:
+        await websocket.close(code=1008)
+        return
     await websocket.accept()
     stream_ws_manager.connect(websocket, channel, streamer)
     try:
@@ -549,62 +2007,76 @@ async def websocket_video_stream_endpoint(channel: str, streamer: str, websocket
             await websocket.send_json(
                 {"streamer_count": len(related_streamers), "live_streamer": related_streamers})
     except (WebSocketDisconnect, ConnectionClosed) as rrr:
+        log_event(logger, logging.DEBUG, "ws_disconnect", endpoint="ws_video_v2", code=str(rrr))
+    except WebmError as rrr:
+        # the stream cannot be followed any further, the recorder has to start a new one
+        log_event(logger, logging.WARNING, "stream_rejected", channel_id=channel, streamer_id=streamer, error=str(rrr))
+        with contextlib.suppress(RuntimeError, ConnectionClosed):
+            await websocket.close(code=1007)
+    except Exception:
+        logger.exception("Exception capture on ws_video_v2")
+        with contextlib.suppress(RuntimeError, ConnectionClosed):
+            await websocket.close(code=1011)
+    finally:
         stream_ws_manager.disconnect(websocket)
-        print("Exception capture on websocket connection", rrr)
+
+
+@app.websocket("/ws_video_view_v2/{channel}")
+async def websocket_video_view_endpoint(channel: str, websocket: WebSocket, exclude: str = None):
+    await websocket.accept()
+    stream_ws_manager.connect_viewer(websocket, channel, exclude)
+    try:
+        while True:
+            # viewers only listen, this waits for the close
+            await websocket.receive_text()
+    except (WebSocketDisconnect, ConnectionClosed) as rrr:
+        log_event(logger, logging.DEBUG, "ws_disconnect", endpoint="ws_video_view_v2", code=str(rrr))
+    finally:
+        stream_ws_manager.disconnect_viewer(websocket, channel)
 
 
 @app.get("/conference_ui_v2")
-def conference_ui(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "video_chat_ui.template"), "r") as f:
-        initial_ui = Template(
-            f.read()).render(
-            proto=ws_protocol,
-            wss_port=os.environ["WSS_PORT"],
-            wss_host=os.environ["WSS_HOST"]
-        )
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+def conference_ui(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(
+        request, "video_chat_ui.template", proto=ws_protocol, wss_port=os.environ["WSS_PORT"], wss_host=os.environ["WSS_HOST"])
 
 
 @app.post("/conference_manage")
 async def conference_api(request: Request):
     body = await request.json()
+    alt_name, alt_key = await caller(body)
     # create channel
     # {initiate: True, persona: "", "bot_response": ""}
     if body.get("action") == "create_channel":
-        return {"channel_id": video_conference.create_channel(body.get("alt_login_name"), body.get("alt_login_pass"))}
+        return {"channel_id": video_conference.create_channel(alt_name, alt_key)}
 
     # request stream for a member of particular channel
     if body.get("action") == "request_stream":
-        return {"streaming_id": video_conference.request_stream_id(
-            body.get("channel_id"), body.get("alt_login_name"), body.get("alt_login_pass"))}
+        return {"streaming_id": video_conference.request_stream_id(body.get("channel_id"), alt_name, alt_key)}
 
     # add member to channel
     if body.get("action") == "add_member":
-        return {"result": video_conference.add_member(
-            body.get("member"), body.get("channel_id"), body.get("alt_login_name"), body.get("alt_login_pass"))}
+        return {"result": video_conference.add_member(body.get("member"), body.get("channel_id"), alt_name, alt_key)}
 
     # add member to channel
     if body.get("action") == "remove_member":
-        return {"result": video_conference.remove_member(
-            body.get("member"), body.get("channel_id"), body.get("alt_login_name"), body.get("alt_login_pass"))}
+        return {"result": video_conference.remove_member(body.get("member"), body.get("channel_id"), alt_name, alt_key)}
 
     # authenticate member
     # It is already provided by chat manager hence not required
 
     # end all stream
     if body.get("action") == "end_all_stream":
-        return {"result": stream_ws_manager.end_all_stream_of_channel(
-            body.get("channel_id"), body.get("alt_login_name"), body.get("alt_login_pass"))}
+        return {"result": stream_ws_manager.end_all_stream_of_channel(body.get("channel_id"), alt_name, alt_key)}
+
+    if body.get("action") == "member_channels":
+        return {"result": video_conference.get_member_all_channel(alt_name, alt_key)}
 
     if body.get("action") == "fetch_admin_ui":
-        with open(os.path.join("ui", "channel_admin.template"), "r") as f:
-            initial_ui = Template(
-                f.read()).render(
-                channels=video_conference.get_admin_all_channel(body.get("alt_login_name"), body.get("alt_login_pass"))
-            )
+        initial_ui = ui_pages.render(
+            "channel_admin.template",
+            channels=video_conference.get_admin_all_channel(alt_name, alt_key)
+        )
         return {"result": initial_ui}
 
     return {"result": None}
@@ -612,40 +2084,41 @@ async def conference_api(request: Request):
 
 @app.get("/broadcast_v2/{channel}/{streamer}")
 async def broadcaster_channel(channel: str, streamer: str):
-    chunk = await run_in_threadpool(stream_ws_manager.get_chunk_of_channel, channel, streamer)
-    return StreamingResponse(chunk, media_type="multipart/x-mixed-replace;boundary=frame")
+    chunk = stream_ws_manager.get_chunk_of_channel(channel, streamer)
+    return StreamingResponse(chunk, media_type="video/webm")
+
+
+@app.get("/broadcast_v2/{channel}/{streamer}/thumbnail")
+async def broadcaster_channel_thumbnail(channel: str, streamer: str):
+    jpeg = await stream_ws_manager.get_thumbnail(channel, streamer)
+    if jpeg is None:
+        return Response(status_code=404)
+    return Response(jpeg, media_type="image/jpeg", headers={"Cache-Control": "no-cache"})
+
+
+@app.get("/broadcast_v2/{channel}/{streamer}/preview")
+async def broadcaster_channel_preview(channel: str, streamer: str):
+    parts = stream_ws_manager.get_preview_of_channel(channel, streamer)
+    return StreamingResponse(parts, media_type="multipart/x-mixed-replace;boundary=" + preview_boundary.decode("ascii"))
+
+
+@app.get("/broadcast_v2/{channel}/{streamer}/stats")
+async def broadcaster_channel_stats(channel: str, streamer: str):
+    return {"result": stream_ws_manager.get_stream_stats(channel, streamer)}
 
 
 # ============= Video streaming behavior test====================
 # static video based ui to test browser client support the video player
 @app.get("/video_client_test")
-async def static_client_video_test(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "video_static_ui.template"), "r") as f:
-        initial_ui = Template(
-            f.read()).render(
-            proto=ws_protocol,
-            wss_port=os.environ["WSS_PORT"],
-            wss_host=os.environ["WSS_HOST"]
-        )
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+async def static_client_video_test(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(
+        request, "video_static_ui.template", proto=ws_protocol, wss_port=os.environ["WSS_PORT"], wss_host=os.environ["WSS_HOST"])
 
 
 @app.get("/video_sb_test")
-async def static_client_video_test(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "video_sb_ui.template"), "r") as f:
-        initial_ui = Template(
-            f.read()).render(
-            proto=ws_protocol,
-            wss_port=os.environ["WSS_PORT"],
-            wss_host=os.environ["WSS_HOST"]
-        )
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+async def static_client_video_test(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(
+        request, "video_sb_ui.template", proto=ws_protocol, wss_port=os.environ["WSS_PORT"], wss_host=os.environ["WSS_HOST"])
 
 
 # ============= (Deprecated) Old reply UI for chatbot design =================
@@ -662,23 +2135,16 @@ async def websocket_endpoint(websocket: WebSocket):
 
 
 @app.get("/ui")
-def bot_ui(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "chat_ui.template"), "r") as f:
-        initial_ui = Template(
-            f.read()).render(
-            data=[{"name": "Alice"}, {"name": "Bob"}, {"name": "Charlie"}],
-            wss_port=os.environ["WSS_PORT"]
-        )
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+def bot_ui(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(
+        request, "chat_ui.template", data=[{"name": "Alice"}, {"name": "Bob"}, {"name": "Charlie"}],
+        wss_port=os.environ["WSS_PORT"])
 
 
 @app.post("/bot")
 async def bot_query(request: Request):
     body = await request.json()
-    print(body, type(body))
+    log_event(logger, logging.DEBUG, "bot_query", body=body)
     # {query: "query"}
     return {"response": "Hello"}
 
@@ -687,7 +2153,7 @@ async def bot_query(request: Request):
 async def custom_next_query(request: Request):
     body = await request.json()
     # {initiate: True, persona: "", "bot_response": ""}
-    print(body, type(body))
+    log_event(logger, logging.DEBUG, "persona_query", body=body)
     if body.get("initiate"):
         return {"query": "hello"}
     else:
@@ -695,29 +2161,38 @@ async def custom_next_query(request: Request):
 
 
 @app.get("/persona_ui")
-def persona_ui(response_class=PlainTextResponse):
-    with open(os.path.join("ui", "persona_form.template"), "rb") as f:
-        initial_ui = f.read()
-        initial_ui = initial_ui
-    response = Response(content=initial_ui)
-    response.headers["content-type"] = "text/html"
-    return response
+def persona_ui(request: Request, response_class=PlainTextResponse):
+    return ui_pages.response(request, "persona_form.template", raw=True)
 
 
 @app.post("/create_agent")
 async def create_agent(request: Request):
     body = await request.json()
     # {name: "", "age": "", "role": "", "occupation": "", "needs": "", "behavior": ""}
-    print(body, type(body))
+    log_event(logger, logging.DEBUG, "create_agent", body=body)
     return {"message": "ok"}
 
 
 # ============== Start the server
-if os.environ.get("SSL") == "true":
-    # import ssl
-    # ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    # ssl_context.load_cert_chain(, keyfile=)
-    uvicorn.run(app, host="0.0.0.0", port=8000, ssl_certfile=os.path.join("cer", "main.cer"), ssl_keyfile=os.path.join(
-        "cer", "main.key"))
-else:
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+def main():
+    ssl_files = {}
+    if os.environ.get("SSL") == "true":
+        # import ssl
+        # ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        # ssl_context.load_cert_chain(, keyfile=)
+        ssl_files = {"ssl_certfile": os.path.join("cer", "main.cer"), "ssl_keyfile": os.path.join("cer", "main.key")}
+    if shard_index is not None:
+        # TLS is terminated by the router, a shard only gets plain connections
+        run_shard_worker(create_app(), os.environ["SHARD_SOCKET"], drain)
+    elif server_workers > 1:
+        configure_logging()
+        run_sharded(os.path.abspath(__file__), "0.0.0.0", server_port, server_workers, backplane_port,
+                    chat_journal_dir, drain_timeout=drain_timeout + 5, **ssl_files)
+    else:
+        # uvicorn logs through the root logger and its queue instead of its own handlers
+        DrainingServer(uvicorn.Config(create_app(), host="0.0.0.0", port=server_port, log_config=None, **ssl_files),
+                       drain).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import asyncio
+import logging
+from collections import deque
+from codec import join_frames, join_packed
+from logs import log_event
+
+logger = logging.getLogger("fanout")
+
+# What to do with a subscriber whose outbound queue is full
+#   drop_oldest: discard the oldest queued frame and keep the newest
+#   coalesce: fold the queued chats into array frames, disconnect once more than max_coalesced
+#     chats are queued or the frames that are not chats fill the queue on their own
+#   disconnect: close the slow socket, it can re-init later
+slow_consumer_policies = ["drop_oldest", "coalesce", "disconnect"]
+
+
+# A broadcast frame carrying the FanoutDelivery to report to once it is sent, it is a str (bytes
+# for the binary sockets) so the writers and join_frames treat it like any other frame.
+class TrackedFrame(str):
+    pass
+
+
+class TrackedPacked(bytes):
+    pass
+
+
+def tracked(frame, delivery):
+    frame = TrackedPacked(frame) if type(frame) is bytes else TrackedFrame(frame)
+    frame.delivery = delivery
+    return frame
+
+
+def frame_sent(frame):
+    if type(frame) is TrackedFrame or type(frame) is TrackedPacked:
+        frame.delivery.sent()
+
+
+# Items pushed to a writer are already encoded frames, text or for a binary socket bytes, or
+# lists of chat frames sent as one array frame. The queue holds (item, chat) pairs, only chats
+# are ever coalesced, the other frames (ack, history, receipts, deltas) keep their place.
+class ConnectionWriter:
+
+    def __init__(self, websocket, max_queue=256, policy="drop_oldest", binary=False, max_coalesced=1024):
+        if policy not in slow_consumer_policies:
+            raise ValueError("unknown slow consumer policy: %s" % policy)
+        self.websocket = websocket
+        self.binary = binary
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_coalesced = max_coalesced
+        self.queue = deque()
+        self.wakeup = asyncio.Event()
+        self.closed = False
+        self.dropped = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    # never awaits, so the sender loop is never held up by this socket
+    def push(self, item, force=False, chat=False):
+        if self.closed:
+            return False
+        if not force and len(self.queue) >= self.max_queue:
+            if self.policy == "drop_oldest":
+                self.queue.popleft()
+                self.dropped += 1
+            elif self.policy != "coalesce" or not self._coalesce():
+                self.dropped += len(self.queue) + 1
+                self.close(code=1008)
+                return False
+        self.queue.append((item, chat))
+        self.wakeup.set()
+        return True
+
+    # every run of queued chats becomes one array frame, False when that leaves more than
+    # max_coalesced chats queued or the queue still full
+    def _coalesce(self):
+        merged = deque()
+        chats = 0
+        for item, chat in self.queue:
+            if not chat:
+                merged.append((item, False))
+                continue
+            frames = item if type(item) == list else [item]
+            chats += len(frames)
+            if merged and merged[-1][1]:
+                merged[-1][0].extend(frames)
+            else:
+                # a copy, the list of a batch broadcast is shared by every subscriber
+                merged.append((list(frames), True))
+        if chats > self.max_coalesced or len(merged) >= self.max_queue:
+            return False
+        self.queue = merged
+        return True
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue and not self.closed:
+                    frame, _ = self.queue.popleft()
+                    if type(frame) == list:
+                        if self.binary:
+                            await self.websocket.send_bytes(join_packed(frame))
+                        else:
+                            await self.websocket.send_text(join_frames(frame))
+                        for item in frame:
+                            frame_sent(item)
+                    elif isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                        frame_sent(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+                        frame_sent(frame)
+        except asyncio.CancelledError:
+            pass
+        except Exception as rrr:
+            log_event(logger, logging.DEBUG, "ws_writer_closed", error=repr(rrr))
+            self.closed = True
+
+    def close(self, code=None):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.wakeup.set()
+        if code is not None:
+            asyncio.get_running_loop().create_task(self._close_socket(code))
+
+    async def _close_socket(self, code):
+        try:
+            await self.websocket.close(code=code)
+        except Exception as rrr:
+            log_event(logger, logging.DEBUG, "ws_close_failed", error=repr(rrr))
+
+    def stop(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+class ChannelFanout:
+
+    def __init__(self, max_queue=256, policy="drop_oldest", max_coalesced=1024):
+        self.max_queue = max_queue
+        self.policy = policy
+        self.max_coalesced = max_coalesced
+        self.writers = {}
+        self.channel_subscribers = {}
+        self.subscribed_channel = {}
+        # the broadcasts only need the packed frames while a binary socket is connected
+        self.binary_writers = 0
+
+    def connect(self, websocket, binary=False):
+        writer = ConnectionWriter(websocket, self.max_queue, self.policy, binary, self.max_coalesced)
+        writer.start()
+        self.writers[websocket] = writer
+        if binary:
+            self.binary_writers += 1
+        return writer
+
+    def is_binary(self, websocket):
+        writer = self.writers.get(websocket)
+        return writer is not None and writer.binary
+
+    def subscribe(self, websocket, channel_id):
+        self.unsubscribe(websocket)
+        if self.channel_subscribers.get(channel_id) is None:
+            self.channel_subscribers[channel_id] = set()
+        self.channel_subscribers[channel_id].add(websocket)
+        self.subscribed_channel[websocket] = channel_id
+
+    def unsubscribe(self, websocket):
+        channel_id = self.subscribed_channel.pop(websocket, None)
+        if channel_id is None:
+            return
+        subscribers = self.channel_subscribers.get(channel_id)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if len(subscribers) == 0:
+                del self.channel_subscribers[channel_id]
+
+    def subscribers(self, channel_id):
+        return self.channel_subscribers.get(channel_id, ())
+
+    def send(self, websocket, item, force=False, chat=False):
+        writer = self.writers.get(websocket)
+        if writer is None:
+            return False
+        return writer.push(item, force, chat)
+
+    # cost depends on the channel size only, every push is non-blocking, the binary sockets get
+    # packed instead of item. chat marks a chat frame, the only kind a slow socket may coalesce.
+    def broadcast(self, channel_id, item, exclude=None, delivery=None, packed=None, chat=False):
+        if delivery is not None:
+            item = tracked(item, delivery)
+            if packed is not None:
+                packed = tracked(packed, delivery)
+        delivered = 0
+        for ws in self.channel_subscribers.get(channel_id, ()):
+            writer = self.writers[ws]
+            if ws is not exclude and writer.push(packed if writer.binary else item, chat=chat):
+                delivered += 1
+        if delivery is not None:
+            # no writer runs before this returns, so none can report before pending is set
+            delivery.pending += delivered
+        return delivered
+
+    # A window of chats as one array frame per subscriber, items are (frame, exclude, delivery,
+    # packed) and a subscriber does not get the frames it is excluded from, i.e. its own chats.
+    def broadcast_batch(self, channel_id, items):
+        if len(items) == 1:
+            frame, exclude, delivery, packed = items[0]
+            return self.broadcast(channel_id, frame, exclude, delivery, packed, chat=True)
+        frames = []
+        packed_frames = []
+        excluded = {}
+        for position, (frame, exclude, delivery, packed) in enumerate(items):
+            if delivery is not None:
+                frame = tracked(frame, delivery)
+                if packed is not None:
+                    packed = tracked(packed, delivery)
+            frames.append(frame)
+            packed_frames.append(packed)
+            if exclude is not None:
+                excluded.setdefault(exclude, set()).add(position)
+        delivered = 0
+        for ws in self.channel_subscribers.get(channel_id, ()):
+            writer = self.writers[ws]
+            own = excluded.get(ws)
+            if own is None:
+                if writer.push(packed_frames if writer.binary else frames, chat=True):
+                    delivered += 1
+                continue
+            batch = [frame for position, frame in enumerate(packed_frames if writer.binary else frames)
+                     if position not in own]
+            if batch and writer.push(batch, chat=True):
+                for frame in batch:
+                    if hasattr(frame, "delivery"):
+                        frame.delivery.pending += 1
+        for frame in frames:
+            if type(frame) is TrackedFrame:
+                frame.delivery.pending += delivered
+        return delivered
+
+    # queued frames of every writer and of the fullest one
+    def queue_depths(self):
+        total = 0
+        deepest = 0
+        for writer in self.writers.values():
+            depth = len(writer.queue)
+            total += depth
+            deepest = max(deepest, depth)
+        return total, deepest
+
+    # every socket closed with code, e.g. 1012 when the server restarts
+    def close_all(self, code):
+        for writer in self.writers.values():
+            writer.close(code)
+
+    def disconnect(self, websocket):
+        self.unsubscribe(websocket)
+        writer = self.writers.pop(websocket, None)
+        if writer is not None:
+            if writer.binary:
+                self.binary_writers -= 1
+            writer.stop()
@@ -0,0 +1,372 @@
+import os
+import gc
+import mmap
+import zlib
+import struct
+import time
+import logging
+import threading
+from collections import OrderedDict
+from codec import dumps, loads
+
+logger = logging.getLogger("journal")
+
+# every record is <payload length><crc32 of payload><json payload>
+record_header = struct.Struct("<II")
+segment_prefix = "journal-"
+segment_suffix = ".log"
+snapshot_prefix = "snapshot-"
+snapshot_suffix = ".snap"
+
+
+def segment_name(segment_id):
+    return "%s%012d%s" % (segment_prefix, segment_id, segment_suffix)
+
+
+def snapshot_name(segment_id):
+    return "%s%012d%s" % (snapshot_prefix, segment_id, snapshot_suffix)
+
+
+def encode_record(event):
+    payload = dumps(event).encode("utf-8")
+    return record_header.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+class JournalError(Exception):
+    pass
+
+
+# Reads records of one file through mmap, stops at the first torn or corrupt record
+# and returns how many bytes were valid so a crashed tail can be cut off. With batch_size
+# apply gets lists of up to that many events instead of one event at a time.
+def read_records(path, apply, batch_size=0):
+    size = os.path.getsize(path)
+    if size == 0:
+        return 0
+    batch = []
+    # locals, this loop runs once per record of the journal
+    unpack_from = record_header.unpack_from
+    crc32 = zlib.crc32
+    header_size = record_header.size
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            offset = 0
+            while offset + header_size <= size:
+                length, crc = unpack_from(mm, offset)
+                end = offset + header_size + length
+                if end > size:
+                    break
+                payload = mm[offset + header_size:end]
+                if crc32(payload) != crc:
+                    break
+                if batch_size:
+                    batch.append(loads(payload))
+                    if len(batch) == batch_size:
+                        apply(batch)
+                        batch = []
+                else:
+                    apply(loads(payload))
+                offset = end
+    if batch:
+        apply(batch)
+    return offset
+
+
+# Folds events into the smallest list of events that rebuilds the same state,
+# chats beyond max_count per channel are dropped the same way the channel log does.
+class JournalState:
+
+    def __init__(self, max_count=0):
+        self.max_count = max_count
+        self.alts = OrderedDict()
+        self.channels = OrderedDict()
+        self.conferences = OrderedDict()
+
+    def apply(self, event):
+        action = event[0]
+        if action == "alt":
+            self.alts[event[1]] = event[2]
+        elif action == "channel":
+            if event[1] not in self.channels:
+                self.channels[event[1]] = {
+                    "admin": event[2], "channel_key": event[3], "open_for_all": event[4],
+                    "closed": False, "members": [event[2]], "chats": OrderedDict()}
+        elif action.startswith("vc_"):
+            self._apply_conference(event)
+        elif event[1] not in self.channels:
+            return
+        elif action == "member":
+            if event[2] not in self.channels[event[1]]["members"]:
+                self.channels[event[1]]["members"].append(event[2])
+        elif action == "open":
+            self.channels[event[1]]["open_for_all"] = True
+        elif action == "close":
+            self.channels[event[1]]["closed"] = True
+        elif action == "chat":
+            chats = self.channels[event[1]]["chats"]
+            chats[event[2]] = [event, None, None, None]
+            if self.max_count and len(chats) > self.max_count:
+                chats.popitem(last=False)
+        elif action == "receipts":
+            # each event holds the whole receipt state of the members in it
+            self.channels[event[1]].setdefault("receipts", {}).update(event[2])
+        elif action in ("edit", "delete", "redact"):
+            chat = self.channels[event[1]]["chats"].get(event[2])
+            if chat is not None:
+                if action == "edit":
+                    chat[1] = event
+                elif action == "delete":
+                    chat[2] = event
+                else:
+                    # the text is gone from the snapshot, the original and its edits alike
+                    chat[0] = chat[0][:4] + [""] + chat[0][5:]
+                    chat[1] = None
+                    chat[3] = event
+
+    # video conference channels, their members and the stream id handed to each member
+    def _apply_conference(self, event):
+        action = event[0]
+        if action == "vc_channel":
+            if event[1] not in self.conferences:
+                self.conferences[event[1]] = {"host": event[2], "members": [event[2]], "streamers": OrderedDict()}
+            return
+        conference = self.conferences.get(event[1])
+        if conference is None:
+            return
+        if action == "vc_member":
+            if event[2] not in conference["members"]:
+                conference["members"].append(event[2])
+        elif action == "vc_remove":
+            if event[2] in conference["members"]:
+                conference["members"].remove(event[2])
+        elif action == "vc_stream":
+            conference["streamers"][event[2]] = event[3]
+
+    def events(self):
+        for alt_name, key in self.alts.items():
+            yield ["alt", alt_name, key]
+        for channel_id, channel in self.channels.items():
+            yield ["channel", channel_id, channel["admin"], channel["channel_key"], channel["open_for_all"]]
+            for member in channel["members"]:
+                yield ["member", channel_id, member]
+            if channel["closed"]:
+                yield ["close", channel_id]
+            for chat in channel["chats"].values():
+                for event in chat:
+                    if event is not None:
+                        yield event
+            if channel.get("receipts"):
+                yield ["receipts", channel_id, channel["receipts"]]
+        for channel_id, conference in self.conferences.items():
+            yield ["vc_channel", channel_id, conference["host"]]
+            for member in conference["members"]:
+                yield ["vc_member", channel_id, member]
+            for member, stream_id in conference["streamers"].items():
+                yield ["vc_stream", channel_id, member, stream_id]
+
+
+# Segmented append-only journal. append() only queues the encoded record, a writer thread
+# group-commits everything queued with one write and one fsync. A segment is closed once it
+# holds segment_bytes or is segment_seconds old, and once compact_segments are closed, e.g.
+# by restarts which always open a new one, they are folded into a snapshot by a compaction
+# thread. Replay reads the snapshot and the segments after it. When a write fails the writer
+# stops and error is set, from then on and while more than max_pending_bytes wait for the
+# writer append raises JournalError.
+class Journal:
+
+    def __init__(self, directory, commit_interval=0.005, segment_bytes=64 * 1024 * 1024,
+                 compact_segments=4, max_count=0, segment_seconds=3600, max_pending_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.compact_segments = compact_segments
+        self.max_count = max_count
+        self.max_pending_bytes = max_pending_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        # set when an append was refused for the backlog, until the writer caught up on half of it
+        self.backlogged = False
+        self.condition = threading.Condition()
+        self.closed = False
+        self.error = None
+        self.file = None
+        self.segment_id = 0
+        self.segment_size = 0
+        self.segment_opened = 0
+        self.compacting = False
+        self.writer = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _list(self, prefix, suffix):
+        ids = []
+        for name in os.listdir(self.directory):
+            if name.startswith(prefix) and name.endswith(suffix):
+                ids.append(int(name[len(prefix):-len(suffix)]))
+        return sorted(ids)
+
+    def segments(self):
+        return self._list(segment_prefix, segment_suffix)
+
+    def snapshots(self):
+        return self._list(snapshot_prefix, snapshot_suffix)
+
+    # feeds apply with the events that rebuild the state: the latest snapshot then every
+    # segment not folded into it, in lists of batch_size events when it is given. The garbage
+    # collector is off meanwhile, the objects replay creates live on and scanning them again and
+    # again costs more than the replay itself.
+    def replay(self, apply, batch_size=0):
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._replay(apply, batch_size)
+        finally:
+            if collecting:
+                gc.enable()
+
+    def _replay(self, apply, batch_size):
+        snapshots = self.snapshots()
+        covered = -1
+        if snapshots:
+            covered = snapshots[-1]
+            read_records(os.path.join(self.directory, snapshot_name(covered)), apply, batch_size)
+        for segment_id in self.segments():
+            if segment_id <= covered:
+                continue
+            path = os.path.join(self.directory, segment_name(segment_id))
+            valid = read_records(path, apply, batch_size)
+            if valid != os.path.getsize(path):
+                logger.warning("Journal truncating torn tail of %s at %d", path, valid)
+                with open(path, "r+b") as f:
+                    f.truncate(valid)
+
+    # [segment id, size] of the last segment on disk, what a state written now has seen
+    def end(self):
+        segments = self.segments()
+        if not segments:
+            return [0, 0]
+        return [segments[-1], os.path.getsize(os.path.join(self.directory, segment_name(segments[-1])))]
+
+    def start(self):
+        segments = self.segments()
+        snapshots = self.snapshots()
+        last = max(segments[-1] if segments else 0, snapshots[-1] if snapshots else 0)
+        # always write into a fresh segment, older ones are closed
+        self._open_segment(last + 1)
+        self._compact_closed()
+        self.writer = threading.Thread(target=self._run, name="journal-writer", daemon=True)
+        self.writer.start()
+
+    def _open_segment(self, segment_id):
+        if self.file is not None:
+            self.file.close()
+        self.segment_id = segment_id
+        self.file = open(os.path.join(self.directory, segment_name(segment_id)), "ab")
+        self.segment_size = self.file.tell()
+        self.segment_opened = time.monotonic()
+
+    # False once the writer failed or while it is too far behind, appends are refused then
+    def healthy(self):
+        return self.error is None and not self.backlogged
+
+    # called from the event loop, never touches the disk
+    def append(self, event):
+        record = encode_record(event)
+        with self.condition:
+            if self.error is not None:
+                raise JournalError("journal writer failed: %r" % self.error)
+            if self.pending_bytes + len(record) > self.max_pending_bytes:
+                self.backlogged = True
+                raise JournalError("journal writer is %d bytes behind" % self.pending_bytes)
+            self.pending.append(record)
+            self.pending_bytes += len(record)
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if self.closed and not self.pending:
+                    return
+            # let a group of appends gather before paying for the fsync
+            if self.commit_interval and not self.closed:
+                time.sleep(self.commit_interval)
+            with self.condition:
+                batch = self.pending
+                self.pending = []
+            try:
+                self._commit(batch)
+            except Exception as rrr:
+                # e.g. the disk is full, what is on disk stays a valid prefix, nothing is written after it
+                logger.exception("Exception capture on journal writer")
+                with self.condition:
+                    self.error = rrr
+                    self.pending = []
+                    self.pending_bytes = 0
+                return
+            with self.condition:
+                self.pending_bytes -= sum(len(record) for record in batch)
+                if self.pending_bytes <= self.max_pending_bytes // 2:
+                    self.backlogged = False
+
+    def _commit(self, batch):
+        data = b"".join(batch)
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.segment_size += len(data)
+        if self.segment_size >= self.segment_bytes or (
+                self.segment_seconds and time.monotonic() - self.segment_opened >= self.segment_seconds):
+            self._open_segment(self.segment_id + 1)
+            self._compact_closed()
+
+    def _compact_closed(self):
+        closed_segments = [i for i in self.segments() if i < self.segment_id]
+        if len(closed_segments) >= self.compact_segments and not self.compacting:
+            self.compacting = True
+            threading.Thread(target=self.compact, args=(closed_segments[-1],),
+                             name="journal-compact", daemon=True).start()
+
+    # fold the previous snapshot and every segment up to upto into a new snapshot
+    def compact(self, upto):
+        try:
+            state = JournalState(self.max_count)
+            snapshots = self.snapshots()
+            if snapshots:
+                read_records(os.path.join(self.directory, snapshot_name(snapshots[-1])), state.apply)
+            for segment_id in self.segments():
+                if segment_id <= upto:
+                    read_records(os.path.join(self.directory, segment_name(segment_id)), state.apply)
+            temp_path = os.path.join(self.directory, snapshot_name(upto) + ".tmp")
+            with open(temp_path, "wb") as f:
+                batch = []
+                for event in state.events():
+                    batch.append(encode_record(event))
+                    if len(batch) >= 4096:
+                        f.write(b"".join(batch))
+                        batch = []
+                f.write(b"".join(batch))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, os.path.join(self.directory, snapshot_name(upto)))
+            for segment_id in self.segments():
+                if segment_id <= upto:
+                    os.remove(os.path.join(self.directory, segment_name(segment_id)))
+            for snapshot_id in self.snapshots():
+                if snapshot_id < upto:
+                    os.remove(os.path.join(self.directory, snapshot_name(snapshot_id)))
+        except Exception:
+            logger.exception("Exception capture on journal compaction")
+        finally:
+            self.compacting = False
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.writer is not None:
+            self.writer.join()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
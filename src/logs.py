@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import random
+import logging
+import logging.handlers
+
+# field names whose values never reach the log output
+secret_fields = {"alt_pass", "alt_login_pass", "admin_key", "channel_key", "token", "password", "organiser_password"}
+# event name -> fraction of its records kept, for the high volume events
+sample_rates = {}
+
+
+def redact(value):
+    if type(value) is dict:
+        return {key: "***" if key in secret_fields else redact(item) for key, item in value.items()}
+    if type(value) in (list, tuple):
+        return type(value)(redact(item) for item in value)
+    return value
+
+
+# One structured record: an event name and its fields. The level check comes first so a
+# disabled event costs a cached lookup, sampled events are then kept with their rate.
+def log_event(logger, level, event, **fields):
+    if not logger.isEnabledFor(level):
+        return
+    rate = sample_rates.get(event)
+    if rate is not None and random.random() >= rate:
+        return
+    logger.log(level, event, extra={"fields": fields})
+
+
+# Runs in the thread that logs: the record is made safe to hand to the writer thread here, the
+# secrets are taken out and the message is rendered, the formatting happens over there.
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        if record.args:
+            record.args = redact(record.args)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.fields = redact(fields)
+        return record
+
+    # a full queue drops the record instead of holding up the event loop
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + ".%03dZ" % record.msecs,
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.msg
+        }
+        for key, value in (getattr(record, "fields", None) or {}).items():
+            entry.setdefault(key, value)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join("%s=%s" % (key, value) for key, value in fields.items())
+        return text
+
+
+# "name=value,name=value" of an environment variable
+def parse_pairs(text):
+    pairs = {}
+    for part in (text or "").split(","):
+        name, _, value = part.partition("=")
+        if name.strip() and value.strip():
+            pairs[name.strip()] = value.strip()
+    return pairs
+
+
+# Every record of the process goes through one bounded queue, a listener thread drains it to
+# stdout. LOG_LEVEL is the root level, LOG_LEVELS sets single loggers (e.g.
+# "endpoint=DEBUG,uvicorn.access=WARNING"), LOG_SAMPLE keeps a fraction of an event
+# (e.g. "ws_frame=0.01") and LOG_FORMAT is json or text.
+def configure_logging():
+    root = logging.getLogger()
+    root.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+    for name, level in parse_pairs(os.environ.get("LOG_LEVELS")).items():
+        logging.getLogger(name).setLevel(level.upper())
+    for event, rate in parse_pairs(os.environ.get("LOG_SAMPLE")).items():
+        sample_rates[event] = float(rate)
+    output = logging.StreamHandler(sys.stdout)
+    if os.environ.get("LOG_FORMAT", "json") == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(TextFormatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    handler = RedactingQueueHandler(queue.Queue(int(os.environ.get("LOG_QUEUE_SIZE", "10000"))))
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    atexit.register(listener.stop)
+    return handler
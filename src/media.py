@@ -0,0 +1,233 @@
+import io
+import time
+import asyncio
+import logging
+import contextlib
+import functools
+import collections
+import importlib.util
+import multiprocessing
+import concurrent.futures
+
+logger = logging.getLogger("media")
+
+preview_boundary = b"frame"
+
+
+# Runs in a media worker process: the first frame of a keyframe cluster, decoded with the init
+# header of its stream, as a JPEG at most max_width wide. The decoders are imported here so only
+# the workers load them.
+def render_thumbnail(init_header, cluster, max_width, quality):
+    import imageio.v3 as iio
+    from PIL import Image
+    image = Image.fromarray(iio.imread(init_header + cluster, index=0, extension=".webm"))
+    if image.width > max_width:
+        image = image.resize((max_width, max(1, image.height * max_width // image.width)), Image.BILINEAR)
+    output = io.BytesIO()
+    image.convert("RGB").save(output, "JPEG", quality=quality)
+    return output.getvalue()
+
+
+# what render_thumbnail needs and is not installed, checked once at startup. imageio reads WebM
+# through its ffmpeg plugin or through pyav.
+def missing_decoders():
+    missing = [name for name in ("imageio", "PIL") if importlib.util.find_spec(name) is None]
+    if importlib.util.find_spec("imageio_ffmpeg") is None and importlib.util.find_spec("av") is None:
+        missing.append("imageio_ffmpeg or av")
+    return missing
+
+
+def preview_part(jpeg):
+    return (b"--" + preview_boundary + b"\r\nContent-Type: image/jpeg\r\nContent-Length: " +
+            str(len(jpeg)).encode("ascii") + b"\r\n\r\n" + jpeg + b"\r\n")
+
+
+# The thumbnail of one streamer: the newest JPEG every viewer shares, the keyframe waiting to be
+# decoded and the latest one seen, kept so a first request is answered without waiting for
+# the next keyframe.
+class StreamPreview:
+
+    def __init__(self):
+        self.jpeg = None
+        self.rendered_at = 0
+        self.pending = None
+        self.latest = None
+        self.offered_at = float("-inf")
+        self.wanted_until = 0
+        self.viewers = 0
+        self.closed = False
+        self.updated = asyncio.Event()
+
+    def _wake(self):
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def wanted(self, now):
+        return self.viewers > 0 or now < self.wanted_until
+
+
+# Thumbnails and MJPEG previews of the live streams, decoded in a pool of worker processes so
+# neither the event loop nor the threadpool ever decodes video. Only streamers somebody looked
+# at within idle seconds are decoded, at most one keyframe every interval seconds each. A
+# streamer has at most one keyframe waiting, a newer one replaces it, and at most max_queue
+# streamers wait; anything replaced, pushed out or older than max_age when a worker frees up is
+# dropped. Only as many decodes as there are workers are in flight, the pool never queues.
+# Workers are not forked from the server, which has threads running: they come from a fork
+# server that imports the main module once, or are spawned.
+class MediaPipeline:
+
+    def __init__(self, workers=1, interval=1.0, max_width=320, quality=70, idle=30, max_queue=64, max_age=5,
+                 start_method="forkserver", observe=None):
+        self.workers = workers
+        self.interval = interval
+        self.max_width = max_width
+        self.quality = quality
+        self.idle = idle
+        self.max_queue = max_queue
+        self.max_age = max_age
+        self.start_method = start_method
+        self.observe = observe
+        self.executor = None
+        # (channel, streamer) -> StreamPreview
+        self.previews = {}
+        # keys of the previews with a pending keyframe, the longest waiting first
+        self.queue = collections.OrderedDict()
+        self.running = 0
+        self.rendered = 0
+        self.dropped = 0
+        self.failed = 0
+
+    # a keyframe cluster the streamer just published, init_header is the one of its publication
+    def offer(self, key, init_header, cluster):
+        if not self.workers or init_header is None:
+            return
+        preview = self.previews.get(key)
+        if preview is None:
+            preview = self.previews[key] = StreamPreview()
+        now = time.monotonic()
+        preview.latest = (init_header, cluster)
+        if now - preview.offered_at < self.interval or not preview.wanted(now):
+            return
+        self._enqueue(key, preview, now)
+
+    def _enqueue(self, key, preview, now):
+        preview.offered_at = now
+        if preview.pending is not None:
+            self.dropped += 1
+        preview.pending = preview.latest + (now,)
+        if key not in self.queue:
+            self.queue[key] = True
+            if len(self.queue) > self.max_queue:
+                oldest, _ = self.queue.popitem(last=False)
+                self.previews[oldest].pending = None
+                self.dropped += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.running < self.workers and self.queue:
+            key, _ = self.queue.popitem(last=False)
+            preview = self.previews.get(key)
+            if preview is None or preview.pending is None:
+                continue
+            init_header, cluster, offered_at = preview.pending
+            preview.pending = None
+            if now - offered_at > self.max_age:
+                self.dropped += 1
+                continue
+            if self.executor is None:
+                context = multiprocessing.get_context(self.start_method)
+                if self.start_method == "forkserver":
+                    context.set_forkserver_preload(["__main__", "media"])
+                self.executor = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context)
+            self.running += 1
+            future = self.executor.submit(render_thumbnail, init_header, cluster, self.max_width, self.quality)
+            future.add_done_callback(functools.partial(self._finished, asyncio.get_running_loop(), key, offered_at))
+
+    # in the thread of the pool, the loop is gone when a decode ends after the server stopped
+    def _finished(self, loop, key, offered_at, future):
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(self._done, key, offered_at, future)
+
+    def _done(self, key, offered_at, future):
+        self.running -= 1
+        try:
+            jpeg = future.result()
+        except concurrent.futures.BrokenExecutor:
+            # a worker died, the next keyframe starts a new pool
+            logger.exception("Exception capture on media worker")
+            self.close()
+            self.failed += 1
+            jpeg = None
+        except Exception:
+            logger.exception("Exception capture on thumbnail decode")
+            self.failed += 1
+            jpeg = None
+        preview = self.previews.get(key)
+        if jpeg is not None and preview is not None:
+            preview.jpeg = jpeg
+            preview.rendered_at = time.time()
+            self.rendered += 1
+            if self.observe is not None:
+                self.observe(time.monotonic() - offered_at)
+            preview._wake()
+        self._dispatch()
+
+    # marks a live streamer as wanted, decoding its latest keyframe right away when it has no
+    # thumbnail yet
+    def request(self, key):
+        if not self.workers:
+            return None
+        preview = self.previews.get(key)
+        if preview is None:
+            preview = self.previews[key] = StreamPreview()
+        now = time.monotonic()
+        # nobody wanted it for a while, the thumbnail it has is stale
+        stale = preview.jpeg is None or not preview.wanted(now)
+        preview.wanted_until = now + self.idle
+        if stale and preview.pending is None and preview.latest is not None and key not in self.queue:
+            self._enqueue(key, preview, now)
+        return preview
+
+    # the cached thumbnail, waiting up to timeout seconds for a fresh one when it has none or
+    # only one from before the last idle period
+    async def thumbnail(self, key, timeout=5):
+        preview = self.request(key)
+        if preview is None:
+            return None
+        if (preview.jpeg is None or time.time() - preview.rendered_at > self.idle) and not preview.closed:
+            try:
+                await asyncio.wait_for(preview.updated.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return preview.jpeg
+
+    # multipart/x-mixed-replace parts, a new one whenever the shared thumbnail changes
+    async def preview_feed(self, key):
+        preview = self.request(key)
+        if preview is None:
+            return
+        preview.viewers += 1
+        try:
+            while not preview.closed:
+                # taken before the part goes out so a thumbnail rendered meanwhile is not missed
+                updated = preview.updated
+                if preview.jpeg is not None:
+                    yield preview_part(preview.jpeg)
+                await updated.wait()
+        finally:
+            preview.viewers -= 1
+
+    # the streamer went offline, its feeds end
+    def discard(self, key):
+        preview = self.previews.pop(key, None)
+        if preview is not None:
+            preview.closed = True
+            preview.pending = None
+            self.queue.pop(key, None)
+            preview._wake()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,152 @@
+import time
+import bisect
+import asyncio
+
+# seconds, from well under a millisecond up to a stalled socket
+latency_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(labels, key, extra=""):
+    pairs = ['%s="%s"' % (label, escape(value)) for label, value in zip(labels, key)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Metrics are plain dicts keyed by the tuple of label values, recording one is a dict update
+# and everything else happens when /metrics is scraped.
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, key=(), amount=1):
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name + label_text(self.labels, key), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, key=()):
+        self.values[key] = value
+
+    def dec(self, key=(), amount=1):
+        self.values[key] = self.values.get(key, 0) - amount
+
+
+# a gauge read when scraped, collect returns a number or a dict of label values -> number
+class GaugeFunction:
+    kind = "gauge"
+
+    def __init__(self, name, description, collect, labels=()):
+        self.name = name
+        self.description = description
+        self.collect = collect
+        self.labels = labels
+
+    def samples(self):
+        values = self.collect()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for key, value in values.items():
+            yield self.name + label_text(self.labels, key), value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=latency_buckets, labels=()):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.labels = labels
+        # label values -> [count per bucket and one for +Inf, sum]
+        self.values = {}
+
+    def observe(self, value, key=()):
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + "_bucket" + label_text(self.labels, key, 'le="%s"' % bound), cumulative
+            cumulative += counts[-1]
+            yield self.name + "_bucket" + label_text(self.labels, key, 'le="+Inf"'), cumulative
+            yield self.name + "_sum" + label_text(self.labels, key), total
+            yield self.name + "_count" + label_text(self.labels, key), cumulative
+
+
+class MetricRegistry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.add(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.add(Gauge(name, description, labels))
+
+    def gauge_function(self, name, description, collect, labels=()):
+        return self.add(GaugeFunction(name, description, collect, labels))
+
+    def histogram(self, name, description, buckets=latency_buckets, labels=()):
+        return self.add(Histogram(name, description, buckets, labels))
+
+    # prometheus text exposition format 0.0.4
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.description))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+
+# how late the loop wakes up from a sleep, i.e. how long callbacks held it
+async def watch_loop_lag(histogram, gauge, interval=0.5):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        histogram.observe(lag)
+        gauge.set(lag)
+
+
+# Handed along with a broadcast frame, the writer of each subscriber reports when it sent it and
+# the time from the chat being stored to the last send is observed.
+class FanoutDelivery:
+
+    def __init__(self, stamp, observe):
+        self.stamp = stamp
+        self.observe = observe
+        self.pending = 0
+
+    def sent(self):
+        self.pending -= 1
+        if self.pending == 0:
+            self.observe(time.time() - self.stamp)
@@ -0,0 +1,98 @@
+import os
+import gzip
+import hashlib
+from fastapi import Response
+from jinja2 import Environment, FileSystemLoader
+
+# brotli is optional, pages are only offered with gzip when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class CachedPage:
+
+    def __init__(self, body, media_type, mtime):
+        self.media_type = media_type
+        self.mtime = mtime
+        tag = hashlib.sha256(body).hexdigest()[:32]
+        # a strong etag names one exact representation, so every encoding has its own
+        self.encodings = {None: (body, '"%s"' % tag), "gzip": (gzip.compress(body, 9, mtime=0), '"%s-gz"' % tag)}
+        if brotli is not None:
+            self.encodings["br"] = (brotli.compress(body, quality=11), '"%s-br"' % tag)
+
+    def etags(self):
+        return {etag: encoding for encoding, (body, etag) in self.encodings.items()}
+
+
+# Every template is compiled once at startup, pages whose context is fixed for the process are
+# rendered once and kept with their gzip and brotli encodings and strong etags. In dev mode
+# the template file mtime is checked on each request and a changed file is compiled and
+# rendered again.
+class PageCache:
+
+    def __init__(self, folder, dev=False):
+        self.folder = folder
+        self.dev = dev
+        self.environment = Environment(loader=FileSystemLoader(folder), auto_reload=dev, cache_size=-1)
+        self.pages = {}
+        for name in os.listdir(folder):
+            if name.endswith(".template"):
+                self.environment.get_template(name)
+
+    def _mtime(self, name):
+        return os.stat(os.path.join(self.folder, name)).st_mtime_ns
+
+    # a template rendered with its own context, e.g. the admin channel listing
+    def render(self, name, **context):
+        return self.environment.get_template(name).render(**context)
+
+    # raw pages are served as they are on disk, the others rendered with the context of the first call
+    def page(self, name, raw=False, **context):
+        page = self.pages.get(name)
+        if page is not None and not (self.dev and page.mtime != self._mtime(name)):
+            return page
+        mtime = self._mtime(name)
+        if raw:
+            with open(os.path.join(self.folder, name), "rb") as f:
+                body = f.read()
+        else:
+            body = self.render(name, **context).encode("utf-8")
+        page = CachedPage(body, "text/html", mtime)
+        self.pages[name] = page
+        return page
+
+    def response(self, request, name, raw=False, **context):
+        page = self.page(name, raw, **context)
+        headers = {"vary": "Accept-Encoding", "cache-control": "no-cache"}
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            etags = page.etags()
+            for etag in if_none_match.split(","):
+                etag = etag.strip()
+                if etag.startswith("W/"):
+                    etag = etag[2:]
+                if etag in etags:
+                    headers["etag"] = etag
+                    return Response(status_code=304, headers=headers)
+        encoding = accepted_encoding(request.headers.get("accept-encoding", ""), page.encodings)
+        body, etag = page.encodings[encoding]
+        headers["etag"] = etag
+        if encoding is not None:
+            headers["content-encoding"] = encoding
+        return Response(content=body, media_type=page.media_type, headers=headers)
+
+
+# best encoding the client takes, brotli first, None for identity
+def accepted_encoding(accept_encoding, encodings):
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        coding, _, parameters = part.strip().partition(";")
+        if parameters.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        accepted.add(coding.strip())
+    for encoding in ("br", "gzip"):
+        if encoding in encodings and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
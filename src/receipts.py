@@ -0,0 +1,115 @@
+receipt_kinds = ("received", "seen")
+# seqs acknowledged out of order are kept this far above the mark, further ones are ignored
+max_exception_span = 4096
+
+
+# Read and delivery receipts of one channel. Members get dense ordinals in the order they join,
+# per kind and ordinal there is a high-water mark (every seq up to it is acknowledged) and an
+# int bitmap of the seqs above it acknowledged out of order, bit i being seq mark + 1 + i.
+# Memory is O(members) whatever the number of chats, "who has seen seq" is a pass over the
+# members and never over the chats.
+class ChannelReceipts:
+
+    def __init__(self):
+        self.ordinals = {}
+        self.members = []
+        self.marks = {kind: [] for kind in receipt_kinds}
+        self.exceptions = {kind: [] for kind in receipt_kinds}
+        # ordinals with an acknowledgement not yet taken by take_changed
+        self.changed = set()
+
+    def add_member(self, member):
+        ordinal = self.ordinals.get(member)
+        if ordinal is None:
+            ordinal = self.ordinals[member] = len(self.members)
+            self.members.append(member)
+            for kind in receipt_kinds:
+                self.marks[kind].append(0)
+                self.exceptions[kind].append(0)
+        return ordinal
+
+    def _settle(self, kind, ordinal, mark, bits):
+        # the seqs right above the mark fold into it
+        run = (~bits & (bits + 1)).bit_length() - 1
+        self.marks[kind][ordinal] = mark + run
+        self.exceptions[kind][ordinal] = bits >> run
+        self.changed.add(ordinal)
+
+    # every seq up to seq, e.g. the newest chat on screen
+    def ack_upto(self, ordinal, kind, seq):
+        mark = self.marks[kind][ordinal]
+        if seq <= mark:
+            return False
+        self._settle(kind, ordinal, seq, self.exceptions[kind][ordinal] >> (seq - mark))
+        return True
+
+    # a single seq, e.g. a chat opened out of order
+    def ack_one(self, ordinal, kind, seq):
+        mark = self.marks[kind][ordinal]
+        bits = self.exceptions[kind][ordinal]
+        offset = seq - mark - 1
+        if offset < 0 or offset >= max_exception_span or bits >> offset & 1:
+            return False
+        self._settle(kind, ordinal, mark, bits | 1 << offset)
+        return True
+
+    # seen implies received, returns whether anything moved
+    def acknowledge(self, member, received=0, seen=0, seen_seqs=()):
+        ordinal = self.ordinals.get(member)
+        if ordinal is None:
+            return False
+        changed = False
+        for seq in (received, seen):
+            changed = self.ack_upto(ordinal, "received", seq) or changed
+        changed = self.ack_upto(ordinal, "seen", seen) or changed
+        for seq in seen_seqs:
+            changed = self.ack_one(ordinal, "received", seq) or changed
+            changed = self.ack_one(ordinal, "seen", seq) or changed
+        return changed
+
+    def has_acked(self, ordinal, kind, seq):
+        mark = self.marks[kind][ordinal]
+        return seq <= mark or bool(self.exceptions[kind][ordinal] >> (seq - mark - 1) & 1)
+
+    def acked_by(self, kind, seq):
+        return [member for ordinal, member in enumerate(self.members) if self.has_acked(ordinal, kind, seq)]
+
+    # [mark, out of order seqs...] of a member
+    def state(self, ordinal, kind):
+        mark = self.marks[kind][ordinal]
+        bits = self.exceptions[kind][ordinal]
+        extra = []
+        offset = 0
+        while bits:
+            if bits & 1:
+                extra.append(mark + 1 + offset)
+            bits >>= 1
+            offset += 1
+        return [mark] + extra
+
+    # member -> {kind: [mark, out of order seqs...]}, the frame and journal form of receipts
+    def snapshot(self, ordinals=None):
+        if ordinals is None:
+            ordinals = range(len(self.members))
+        return {self.members[ordinal]: {kind: self.state(ordinal, kind) for kind in receipt_kinds}
+                for ordinal in ordinals}
+
+    def take_changed(self):
+        changed = self.changed
+        self.changed = set()
+        return self.snapshot(sorted(changed))
+
+    # a snapshot written elsewhere, the states in it replace the ones here
+    def restore(self, states):
+        for member, kinds in states.items():
+            ordinal = self.add_member(member)
+            for kind, state in kinds.items():
+                if kind not in self.marks or not state:
+                    continue
+                mark = state[0]
+                bits = 0
+                for seq in state[1:]:
+                    if 0 <= seq - mark - 1 < max_exception_span:
+                        bits |= 1 << (seq - mark - 1)
+                self.marks[kind][ordinal] = mark
+                self.exceptions[kind][ordinal] = bits
@@ -0,0 +1,177 @@
+import re
+import array
+import bisect
+import heapq
+
+token_pattern = re.compile(r"\w+")
+# longer words are cut, a chat contributes at most this many distinct tokens
+max_token_length = 32
+max_tokens_per_chat = 64
+# a prefix matching more tokens of the vocabulary than this only filters, it never drives a query
+max_prefix_tokens = 64
+# seqs the chat log trimmed are pruned from the index once this many have gone
+prune_step = 4096
+# rough bytes of one token besides its postings, the string, its dict entry and array header
+token_overhead = 120
+# senders are indexed as tokens too, this prefix keeps them apart from the words
+sender_prefix = "\x01"
+
+
+def descending(postings, start, stop):
+    for position in range(stop - 1, start - 1, -1):
+        yield postings[position]
+
+
+def tokenize(text):
+    tokens = {}
+    for token in token_pattern.findall(text.lower()):
+        tokens[token[:max_token_length]] = True
+        if len(tokens) == max_tokens_per_chat:
+            break
+    return list(tokens)
+
+
+# Inverted index of the chats of one channel: a sorted vocabulary and for every token the seqs
+# of the chats holding it, ascending. Chats come in seq order so indexing one appends, an edit
+# removes the seq from the old tokens and inserts it for the new ones, a delete or redaction only
+# removes it. Memory is bounded by max_postings: past it the oldest seqs are dropped from every
+# token and floor tells from which seq on the index is complete.
+class ChannelSearchIndex:
+
+    def __init__(self, max_postings=2000000):
+        self.max_postings = max_postings
+        self.vocabulary = []
+        self.postings = {}
+        self.count = 0
+        self.floor = 1
+
+    def _add_token(self, token, seq):
+        postings = self.postings.get(token)
+        if postings is None:
+            postings = self.postings[token] = array.array("q")
+            bisect.insort(self.vocabulary, token)
+        if not postings or postings[-1] < seq:
+            postings.append(seq)
+        else:
+            position = bisect.bisect_left(postings, seq)
+            if position < len(postings) and postings[position] == seq:
+                return
+            postings.insert(position, seq)
+        self.count += 1
+
+    def _remove_token(self, token, seq):
+        postings = self.postings.get(token)
+        if postings is None:
+            return
+        position = bisect.bisect_left(postings, seq)
+        if position < len(postings) and postings[position] == seq:
+            del postings[position]
+            self.count -= 1
+            if not postings:
+                self._drop_token(token)
+
+    def _drop_token(self, token):
+        del self.postings[token]
+        del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+    # first_seq is the oldest chat the log still has
+    def add(self, chat, first_seq=1):
+        if chat.seq < self.floor or chat.deleted or chat.redacted:
+            return
+        for token in tokenize(chat.message):
+            self._add_token(token, chat.seq)
+        self._add_token(sender_prefix + chat.sender, chat.seq)
+        if self.count > self.max_postings:
+            self.prune(max(first_seq, self.floor + max(1, (chat.seq - self.floor) // 10)))
+        elif first_seq - self.floor >= prune_step:
+            self.prune(first_seq)
+
+    # called with the chat as it was before an edit, delete or redaction
+    def remove(self, chat):
+        if chat.seq < self.floor:
+            return
+        for token in tokenize(chat.message):
+            self._remove_token(token, chat.seq)
+        self._remove_token(sender_prefix + chat.sender, chat.seq)
+
+    # forget every seq under floor, e.g. the oldest tenth when the index is full or what the
+    # chat log trimmed
+    def prune(self, floor):
+        if floor <= self.floor:
+            return
+        self.floor = floor
+        for token in list(self.postings):
+            postings = self.postings[token]
+            cut = bisect.bisect_left(postings, floor)
+            if cut:
+                del postings[:cut]
+                self.count -= cut
+                if not postings:
+                    self._drop_token(token)
+
+    # the tokens starting with prefix, None when there are too many of them
+    def expand(self, prefix):
+        start = bisect.bisect_left(self.vocabulary, prefix)
+        tokens = []
+        for token in self.vocabulary[start:start + max_prefix_tokens + 1]:
+            if not token.startswith(prefix):
+                return tokens
+            tokens.append(token)
+        return tokens if len(tokens) <= max_prefix_tokens else None
+
+    def footprint(self):
+        # postings are 8 byte seqs
+        return self.count * 8 + len(self.vocabulary) * token_overhead
+
+    def size(self, tokens):
+        return sum(len(self.postings[token]) for token in tokens)
+
+    # seqs of the tokens below before, newest first and without repeats
+    def candidates(self, tokens, low, before):
+        runs = []
+        for token in tokens:
+            postings = self.postings[token]
+            start = bisect.bisect_left(postings, low)
+            stop = bisect.bisect_left(postings, before)
+            runs.append(descending(postings, start, stop))
+        last = None
+        for seq in heapq.merge(*runs, reverse=True):
+            if seq != last:
+                last = seq
+                yield seq
+
+    # Chats matching every term as a prefix and the other filters, newest first from before
+    # on. The rarest term drives, without one that can every seq in range is a candidate. Every
+    # candidate is checked against its chat, the scan stops at limit results or max_scan
+    # candidates and next_before carries on from there.
+    def search(self, chats, terms, sender=None, low=1, before=None, limit=20, max_scan=5000):
+        before = chats.next_seq if before is None else min(before, chats.next_seq)
+        low = max(low, self.floor, chats.first_seq())
+        expanded = [self.expand(term) for term in terms]
+        if sender is not None:
+            expanded.append([sender_prefix + sender] if sender_prefix + sender in self.postings else [])
+        expanded = [tokens for tokens in expanded if tokens is not None]
+        if expanded:
+            driver = min(expanded, key=self.size)
+            seqs = self.candidates(driver, low, before)
+        else:
+            seqs = iter(range(before - 1, low - 1, -1))
+        results = []
+        scanned = 0
+        next_before = None
+        for seq in seqs:
+            if scanned == max_scan or len(results) == limit:
+                next_before = seq + 1
+                break
+            scanned += 1
+            chat = chats.get(seq)
+            if chat is None or chat.deleted or chat.redacted:
+                continue
+            if sender is not None and chat.sender != sender:
+                continue
+            if terms:
+                tokens = tokenize(chat.message)
+                if not all(any(token.startswith(term) for token in tokens) for term in terms):
+                    continue
+            results.append(chat)
+        return results, next_before
@@ -0,0 +1,78 @@
+import hmac
+import time
+import base64
+import hashlib
+import secrets
+
+key_hash_prefix = "pbkdf2_sha256"
+
+
+def hash_key(key, iterations=100000, salt=None):
+    salt = salt or secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", key.encode("utf-8"), salt.encode("utf-8"), iterations)
+    return "%s$%d$%s$%s" % (key_hash_prefix, iterations, salt, digest.hex())
+
+
+# stored is a hash_key result, or a plain key of an alt name journaled before keys were hashed
+def verify_key(key, stored):
+    if not isinstance(key, str) or not isinstance(stored, str):
+        return False
+    if not stored.startswith(key_hash_prefix + "$"):
+        return hmac.compare_digest(key.encode("utf-8"), stored.encode("utf-8"))
+    prefix, iterations, salt, digest = stored.split("$")
+    return hmac.compare_digest(hash_key(key, int(iterations), salt), stored)
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+# Stateless session tokens: the alt name and an expiry signed with a secret shared by every
+# worker, so any of them can check a token without asking the one that issued it. A token is
+# checked with the secret once, after that it is a dict lookup until it expires.
+class SessionTokens:
+
+    def __init__(self, secret, ttl=86400, max_verified=65536):
+        self.secret = secret.encode("utf-8")
+        self.ttl = ttl
+        self.max_verified = max_verified
+        # token -> (alt_name, expires)
+        self.verified = {}
+
+    def _sign(self, payload):
+        return b64encode(hmac.new(self.secret, payload.encode("ascii"), hashlib.sha256).digest()[:16])
+
+    def issue(self, alt_name):
+        payload = "%s.%x" % (b64encode(alt_name.encode("utf-8")), int(time.time()) + self.ttl)
+        return payload + "." + self._sign(payload)
+
+    # alt name the token was issued to, None when it is forged, malformed or expired
+    def verify(self, token):
+        if not isinstance(token, str):
+            return None
+        known = self.verified.get(token)
+        now = time.time()
+        if known is not None:
+            if known[1] > now:
+                return known[0]
+            del self.verified[token]
+            return None
+        payload, _, signature = token.rpartition(".")
+        try:
+            if not payload or not hmac.compare_digest(signature, self._sign(payload)):
+                return None
+            name, expires = payload.split(".")
+            alt_name = b64decode(name).decode("utf-8")
+            expires = int(expires, 16)
+        except (ValueError, TypeError):
+            return None
+        if expires <= now:
+            return None
+        if len(self.verified) >= self.max_verified:
+            self.verified.clear()
+        self.verified[token] = (alt_name, expires)
+        return alt_name
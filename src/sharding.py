@@ -0,0 +1,303 @@
+import os
+import sys
+import time
+import socket
+import bisect
+import signal
+import logging
+import asyncio
+import hashlib
+import subprocess
+from urllib.parse import parse_qs
+import uvicorn
+
+logger = logging.getLogger("sharding")
+
+# paths whose next segment is the channel, every other request can name it with ?channel_id=
+channel_paths = ("/ws_video_v2/", "/ws_video_view_v2/", "/broadcast_v2/")
+
+
+def channel_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+# Consistent hashing of channel ids onto workers, every worker owns replicas points of the
+# ring so a change of the worker count only moves about 1/count of the channels.
+class ShardRing:
+
+    def __init__(self, count, replicas=128):
+        self.count = count
+        points = sorted((channel_hash("%d-%d" % (shard, replica)), shard)
+                        for shard in range(count) for replica in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.shards = [point[1] for point in points]
+
+    def shard(self, channel_id):
+        position = bisect.bisect(self.hashes, channel_hash(channel_id))
+        return self.shards[position % len(self.shards)]
+
+
+# channel named by an HTTP request line, None when it names none
+def request_channel(request_line):
+    parts = request_line.split(b" ")
+    if len(parts) < 2:
+        return None
+    path, _, query = parts[1].decode("latin-1").partition("?")
+    for prefix in channel_paths:
+        if path.startswith(prefix):
+            return path[len(prefix):].split("/", 1)[0] or None
+    return parse_qs(query).get("channel_id", [None])[0]
+
+
+async def wait_readable(loop, sock, timeout):
+    ready = loop.create_future()
+
+    def wake():
+        if not ready.done():
+            ready.set_result(None)
+
+    loop.add_reader(sock.fileno(), wake)
+    try:
+        await asyncio.wait_for(ready, timeout)
+    finally:
+        loop.remove_reader(sock.fileno())
+
+
+async def pipe(reader, writer):
+    try:
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            writer.write(data)
+            await writer.drain()
+    except OSError:
+        pass
+    finally:
+        writer.close()
+
+
+# Accepts every client connection, reads which channel it is for and hands the socket itself
+# to the worker owning that channel (SCM_RIGHTS over a unix socket), so after the handoff the
+# router is out of the data path. Requests without a channel go round robin. With TLS the
+# router has to terminate it to see the path, it then relays the plain bytes through a
+# socketpair whose other end is handed off the same way.
+class ShardRouter:
+
+    def __init__(self, ring, handoff_paths, ssl_context=None, peek_timeout=10):
+        self.ring = ring
+        self.handoff_paths = handoff_paths
+        self.ssl_context = ssl_context
+        self.peek_timeout = peek_timeout
+        self.handoffs = []
+        self.next_shard = 0
+
+    def connect_workers(self, timeout=60):
+        deadline = time.time() + timeout
+        for path in self.handoff_paths:
+            while True:
+                try:
+                    handoff = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    handoff.connect(path)
+                    self.handoffs.append(handoff)
+                    break
+                except OSError:
+                    handoff.close()
+                    if time.time() > deadline:
+                        raise
+                    time.sleep(0.1)
+
+    def _shard(self, request_line):
+        channel_id = request_channel(request_line) if request_line else None
+        if channel_id is not None:
+            return self.ring.shard(channel_id)
+        self.next_shard = (self.next_shard + 1) % self.ring.count
+        return self.next_shard
+
+    def _hand_off(self, shard, connection):
+        socket.send_fds(self.handoffs[shard], [b"c"], [connection.fileno()])
+        connection.close()
+
+    async def serve(self, host, port):
+        if self.ssl_context is not None:
+            server = await asyncio.start_server(self._relay, host, port, ssl=self.ssl_context)
+            async with server:
+                await server.serve_forever()
+        loop = asyncio.get_running_loop()
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((host, port))
+        listener.listen(1024)
+        listener.setblocking(False)
+        while True:
+            connection, address = await loop.sock_accept(listener)
+            loop.create_task(self._route(loop, connection))
+
+    # the request line is only peeked, the worker reads the request from the start
+    async def _route(self, loop, connection):
+        try:
+            request_line = None
+            deadline = loop.time() + self.peek_timeout
+            while loop.time() < deadline:
+                await wait_readable(loop, connection, self.peek_timeout)
+                data = connection.recv(2048, socket.MSG_PEEK)
+                if not data:
+                    connection.close()
+                    return
+                end = data.find(b"\r\n")
+                if end >= 0 or len(data) == 2048:
+                    request_line = data[:end] if end >= 0 else data
+                    break
+                await asyncio.sleep(0.005)
+            self._hand_off(self._shard(request_line), connection)
+        except Exception as rrr:
+            logger.warning("Exception capture on shard router: %r", rrr)
+            connection.close()
+
+    async def _relay(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readuntil(b"\r\n"), self.peek_timeout)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, OSError):
+            writer.close()
+            return
+        near, far = socket.socketpair()
+        self._hand_off(self._shard(request_line[:-2]), far)
+        worker_reader, worker_writer = await asyncio.open_connection(sock=near)
+        worker_writer.write(request_line)
+        await asyncio.gather(pipe(reader, worker_writer), pipe(worker_reader, writer))
+
+
+# A uvicorn server running drain between closing its listeners and closing the connections,
+# so the app winds the open ones down itself first. uvicorn runs it on SIGTERM and SIGINT.
+class DrainingServer(uvicorn.Server):
+
+    def __init__(self, config, drain=None):
+        super().__init__(config)
+        self.drain = drain
+
+    async def shutdown(self, sockets=None):
+        for server in self.servers:
+            server.close()
+        if self.drain is not None and not self.force_exit:
+            await self.drain()
+        await super().shutdown(sockets)
+
+
+# One shard: a normal uvicorn server (listening on a unix socket of its own) that also serves
+# every connection the router hands to it.
+class ShardWorker:
+
+    def __init__(self, config, handoff_path, drain=None):
+        self.server = DrainingServer(config, self._drain)
+        self.handoff_path = handoff_path
+        self.drain = drain
+        self.receiver = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.receiver = asyncio.get_running_loop().create_task(self._receive())
+        try:
+            await self.server.serve()
+        finally:
+            self.receiver.cancel()
+
+    # no more connections from the router while the app drains
+    async def _drain(self):
+        self.receiver.cancel()
+        if self.drain is not None:
+            await self.drain()
+
+    def _protocol(self):
+        config = self.server.config
+        return config.http_protocol_class(
+            config=config, server_state=self.server.server_state, app_state=self.server.lifespan.state)
+
+    async def _receive(self):
+        loop = asyncio.get_running_loop()
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+        if os.path.exists(self.handoff_path):
+            os.remove(self.handoff_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.handoff_path)
+        listener.listen(1)
+        listener.setblocking(False)
+        while True:
+            router, address = await loop.sock_accept(listener)
+            loop.create_task(self._handoffs(loop, router))
+
+    async def _handoffs(self, loop, router):
+        while True:
+            await wait_readable(loop, router, None)
+            try:
+                message, fds, flags, address = socket.recv_fds(router, 256, 256)
+            except BlockingIOError:
+                continue
+            if not message and not fds:
+                router.close()
+                return
+            for fd in fds:
+                connection = socket.socket(fileno=fd)
+                connection.setblocking(False)
+                await loop.connect_accepted_socket(self._protocol, connection)
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("nothing listening on port %d" % port)
+
+
+# Multi process launch: the backplane broker, one worker process per shard running script
+# again with SHARD_INDEX set, and the router in this process.
+def run_sharded(script, host, port, workers, backplane_port, journal_dir=None, ssl_certfile=None,
+                ssl_keyfile=None, socket_dir=None, drain_timeout=10):
+    socket_dir = socket_dir or os.environ.get("SHARD_SOCKET_DIR") or "/tmp"
+    handoff_paths = [os.path.join(socket_dir, "chat-shard-%d-%d.sock" % (os.getpid(), i)) for i in range(workers)]
+    broker_command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "backplane.py"),
+                      "--port", str(backplane_port)]
+    if journal_dir:
+        broker_command += ["--journal-dir", os.path.join(journal_dir, "broker")]
+    processes = [subprocess.Popen(broker_command)]
+    wait_for_port(backplane_port)
+    for i in range(workers):
+        processes.append(subprocess.Popen([sys.executable, script], env=dict(
+            os.environ, SHARD_INDEX=str(i), SHARD_SOCKET=handoff_paths[i],
+            BACKPLANE="socket", BACKPLANE_PORT=str(backplane_port), BACKPLANE_NODE_ID="shard-%d" % i)))
+
+    def stop(signum, frame):
+        for process in processes:
+            process.terminate()
+        # the shards drain their sockets and write their state before they exit
+        for process in processes:
+            try:
+                process.wait(drain_timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    ssl_context = None
+    if ssl_certfile:
+        import ssl
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(ssl_certfile, ssl_keyfile)
+    router = ShardRouter(ShardRing(workers), handoff_paths, ssl_context)
+    try:
+        router.connect_workers()
+        asyncio.run(router.serve(host, port))
+    finally:
+        for process in processes:
+            process.terminate()
+
+
+def run_shard_worker(app, handoff_path, drain=None):
+    ShardWorker(uvicorn.Config(app, uds=handoff_path + ".http", log_config=None), handoff_path, drain).run()
@@ -0,0 +1,60 @@
+import os
+import zlib
+import struct
+from codec import dumps, loads
+
+# <magic><metadata length><crc32 of metadata><json metadata><history blobs>
+snapshot_header = struct.Struct("<4sII")
+snapshot_magic = b"CSS1"
+
+
+# The state of a process written when it drains. metadata is json, histories maps a channel id
+# to a callable returning the compressed history of the channel (the blob of its spill file),
+# called here so the encoding happens in the thread writing. The offset and length of every blob
+# go into the metadata under "histories".
+def write_snapshot(path, metadata, histories):
+    blobs = []
+    offsets = {}
+    offset = 0
+    for channel_id, history in histories.items():
+        blob = history()
+        offsets[channel_id] = [offset, len(blob)]
+        blobs.append(blob)
+        offset += len(blob)
+    payload = dumps(dict(metadata, histories=offsets)).encode("utf-8")
+    temp_path = path + ".tmp"
+    with open(temp_path, "wb") as f:
+        f.write(snapshot_header.pack(snapshot_magic, len(payload), zlib.crc32(payload)))
+        f.write(payload)
+        for blob in blobs:
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+    return snapshot_header.size + len(payload) + offset
+
+
+# the metadata and a function giving the history blob of a channel, None when the file is
+# missing or not a whole snapshot
+def read_snapshot(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < snapshot_header.size:
+        return None
+    magic, length, crc = snapshot_header.unpack_from(data)
+    start = snapshot_header.size
+    payload = data[start:start + length]
+    if magic != snapshot_magic or len(payload) != length or zlib.crc32(payload) != crc:
+        return None
+    metadata = loads(payload)
+    start += length
+    if start + sum(size for offset, size in metadata["histories"].values()) > len(data):
+        return None
+
+    def history(channel_id):
+        offset, size = metadata["histories"][channel_id]
+        return data[start + offset:start + offset + size]
+
+    return metadata, history
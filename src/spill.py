@@ -0,0 +1,106 @@
+import os
+import zlib
+import time
+import shutil
+import collections
+from codec import dumps, loads
+
+spill_suffix = ".hist"
+
+
+# The history of a channel as written to disk: its chats as ChatMessage.row lists, the next seq
+# (kept when every chat was trimmed) and the revisions, zlib compressed json. records are taken
+# on the event loop, encoding them is safe in another thread.
+def encode_history(records, next_seq, revisions):
+    history = {"next_seq": next_seq, "rows": [record.row() for record in records], "revisions": revisions}
+    return zlib.compress(dumps(history).encode("utf-8"), 1)
+
+
+def decode_history(data):
+    return loads(zlib.decompress(data))
+
+
+# Cold channel histories on disk, one file per channel, and the recency of every channel with
+# its history in memory. A file stays once its channel is faulted back in, while the channel
+# does not change spilling it again only drops the memory. The files are a cache of what the
+# journal holds, the folder belongs to this process and goes with it.
+class ChannelSpill:
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        # channel id -> monotonic time of the last access, least recent first
+        self.recency = collections.OrderedDict()
+        # channel id -> (version of the channel written, bytes on disk)
+        self.files = {}
+        self.disk_bytes = 0
+        self.spills = 0
+        self.faults = 0
+
+    def touch(self, channel_id):
+        self.recency[channel_id] = time.monotonic()
+        self.recency.move_to_end(channel_id)
+
+    # the channel goes out at the next sweep unless it is used before, e.g. once it is closed
+    def expire(self, channel_id):
+        if channel_id in self.recency:
+            self.recency[channel_id] = float("-inf")
+            self.recency.move_to_end(channel_id, last=False)
+
+    def path(self, channel_id):
+        return os.path.join(self.folder, channel_id + spill_suffix)
+
+    def is_current(self, channel_id, version):
+        return self.files.get(channel_id, (None, 0))[0] == version
+
+    # runs in the threadpool, returns the bytes written
+    def write(self, channel_id, records, next_seq, revisions):
+        data = encode_history(records, next_seq, revisions)
+        path = self.path(channel_id)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+        return len(data)
+
+    def stored(self, channel_id, version, size):
+        self.disk_bytes += size - self.files.get(channel_id, (None, 0))[1]
+        self.files[channel_id] = (version, size)
+
+    def evicted(self, channel_id):
+        self.recency.pop(channel_id, None)
+        self.spills += 1
+
+    def read(self, channel_id):
+        return decode_history(self.blob(channel_id))
+
+    def blob(self, channel_id):
+        with open(self.path(channel_id), "rb") as f:
+            return f.read()
+
+    # a history blob from elsewhere, e.g. the drain snapshot, becomes the file of the channel
+    def install(self, channel_id, blob, version=0):
+        path = self.path(channel_id)
+        with open(path, "wb") as f:
+            f.write(blob)
+        self.stored(channel_id, version, len(blob))
+
+    # Channels to write out, least recently used first: the ones idle for longer than idle
+    # seconds, then more until the resident bytes fit the budget. sizes holds the resident bytes
+    # of every channel in memory, pinned channels are in use and stay.
+    def cold(self, sizes, budget=0, idle=0, pinned=()):
+        now = time.monotonic()
+        resident = sum(sizes.values())
+        chosen = []
+        for channel_id, accessed in self.recency.items():
+            if channel_id in pinned or channel_id not in sizes:
+                continue
+            if (idle and now - accessed > idle) or (budget and resident > budget):
+                chosen.append(channel_id)
+                resident -= sizes[channel_id]
+            else:
+                # the ones after it were used more recently still
+                break
+        return chosen
+
+    def close(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,302 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from codec import dumps
+
+logger = logging.getLogger("stream_buffer")
+
+# binary viewer frame: <kind><streamer id length><streamer id><payload>
+viewer_frame_init = 0
+viewer_frame_cluster = 1
+# the length of the streamer id is one byte of the viewer frame, longer ids are refused at ingest
+max_streamer_id_bytes = 255
+
+
+class StreamSegment:
+    __slots__ = ("sequence", "data", "stamp", "keyframe")
+
+    def __init__(self, sequence, data, stamp, keyframe):
+        self.sequence = sequence
+        self.data = data
+        self.stamp = stamp
+        self.keyframe = keyframe
+
+
+# Byte accounting shared by every publication of the process, when the total goes over
+# max_bytes the oldest segment of the largest ring is evicted first. Like expire() it leaves
+# every ring its newest segment, the total can go over by at most one segment per streamer.
+class StreamBudget:
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.publications = set()
+
+    def enforce(self):
+        while self.max_bytes and self.bytes > self.max_bytes:
+            largest = max((p for p in self.publications if len(p.segments) > 1), key=lambda p: p.bytes, default=None)
+            if largest is None:
+                break
+            largest.evict_oldest()
+
+
+# One per live streamer: a bounded ring of the recent segments plus the init header kept on
+# the side. publish() wakes the viewers waiting in subscribe(), idle viewers just sit on an
+# event and cost nothing.
+class StreamPublication:
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_segments=64, max_age=30, slice_size=64 * 1024,
+                 budget=None, name=""):
+        self.name = name
+        self.mime = "video/webm"
+        self.max_bytes = max_bytes
+        self.max_segments = max_segments
+        self.max_age = max_age
+        self.slice_size = slice_size
+        self.budget = budget
+        self.segments = deque()
+        self.bytes = 0
+        self.init_header = None
+        self.sequence = 0
+        self.evicted = 0
+        self.viewers = {}
+        # websocket viewers, segments are pushed to them instead of being pulled
+        self.listeners = set()
+        self.closed = False
+        self.updated = asyncio.Event()
+        if budget is not None:
+            budget.publications.add(self)
+
+    def _wake(self):
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    # the init segment (EBML header and Tracks) every viewer needs before the first cluster
+    def set_init_header(self, init_header, mime=None):
+        self.init_header = init_header
+        if mime is not None:
+            self.mime = mime
+        self._wake()
+        for listener in self.listeners:
+            listener.offer_init(self)
+
+    def publish(self, chunk, keyframe=False):
+        now = time.time()
+        self.sequence += 1
+        segment = StreamSegment(self.sequence, chunk, now, keyframe)
+        self.segments.append(segment)
+        self._account(len(chunk))
+        self.expire(now)
+        if self.budget is not None:
+            self.budget.enforce()
+        self._wake()
+        for listener in self.listeners:
+            listener.offer(self, segment)
+
+    def _account(self, size):
+        self.bytes += size
+        if self.budget is not None:
+            self.budget.bytes += size
+
+    def evict_oldest(self):
+        segment = self.segments.popleft()
+        self._account(-len(segment.data))
+        self.evicted += 1
+
+    # drop what is over the per streamer budget or older than max_age, the newest segment stays
+    def expire(self, now=None):
+        if now is None:
+            now = time.time()
+        while len(self.segments) > 1 and (
+                (self.max_bytes and self.bytes > self.max_bytes) or
+                (self.max_segments and len(self.segments) > self.max_segments) or
+                (self.max_age and now - self.segments[0].stamp > self.max_age)):
+            self.evict_oldest()
+
+    def close(self):
+        self.closed = True
+        while self.segments:
+            self.evict_oldest()
+        if self.budget is not None:
+            self.budget.publications.discard(self)
+        for listener in list(self.listeners):
+            listener.detach(self)
+        self._wake()
+
+    def stats(self):
+        now = time.time()
+        lags = [self.sequence - last for last in self.viewers.values()]
+        return {
+            "depth": len(self.segments),
+            "bytes": self.bytes,
+            "init_header_bytes": len(self.init_header) if self.init_header is not None else 0,
+            "sequence": self.sequence,
+            "evicted": self.evicted,
+            "oldest_age": now - self.segments[0].stamp if self.segments else 0,
+            "viewers": len(self.viewers),
+            "max_viewer_lag": max(lags, default=0)
+        }
+
+    def _slices(self, data):
+        view = memoryview(data)
+        for start in range(0, len(view), self.slice_size):
+            yield view[start:start + self.slice_size]
+
+    # init header then the segments from the newest keyframe on, what a new viewer starts with
+    def bootstrap(self):
+        start = self._start_sequence()
+        return [segment for segment in self.segments if segment.sequence > start]
+
+    # sequence just before the newest segment a decoder can start from
+    def _start_sequence(self):
+        for segment in reversed(self.segments):
+            if segment.keyframe:
+                return segment.sequence - 1
+        return self.sequence - 1 if self.sequence else 0
+
+    # A viewer gets the init header, then starts at the newest keyframe segment and gets every
+    # newer segment exactly once. A viewer that falls behind the ring skips to the oldest
+    # segment still retained.
+    async def subscribe(self):
+        viewer = object()
+        last = self._start_sequence()
+        self.viewers[viewer] = last
+        try:
+            # a publication mirrored from another worker gets its init header a moment later
+            while self.init_header is None and not self.closed:
+                await self.updated.wait()
+            if self.init_header is not None:
+                for view in self._slices(self.init_header):
+                    yield view
+            while not self.closed:
+                if self.sequence == last:
+                    await self.updated.wait()
+                    continue
+                pending = [segment for segment in self.segments if segment.sequence > last]
+                last = self.sequence
+                for segment in pending:
+                    for view in self._slices(segment.data):
+                        yield view
+                    self.viewers[viewer] = segment.sequence
+        finally:
+            self.viewers.pop(viewer, None)
+
+
+# Send side of one /ws_video_view_v2 socket, every streamer of the channel is multiplexed on it.
+# The queue is bounded by segments and bytes. When a segment does not fit it is dropped whole
+# and that streamer is skipped until its next keyframe cluster, so a slow link only costs its
+# own viewer some frames and never grows server memory. Json and init frames are never dropped,
+# they may take up to twice the bounds; a viewer that does not take even those is closed.
+class ViewerQueue:
+
+    def __init__(self, websocket, max_segments=32, max_bytes=4 * 1024 * 1024, exclude=None, served=None):
+        self.websocket = websocket
+        # called with the streamer and size of every segment sent, for the metrics
+        self.served = served
+        # the viewer's own stream, never sent back to it
+        self.exclude = exclude
+        self.max_segments = max_segments
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.bytes = 0
+        self.publications = set()
+        self.resync = set()
+        self.dropped = 0
+        self.closed = False
+        self.overflowed = False
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def attach(self, publication):
+        if self.closed:
+            return
+        self.publications.add(publication)
+        publication.listeners.add(self)
+        if publication.init_header is not None:
+            self.offer_init(publication)
+            for segment in publication.bootstrap():
+                self.offer(publication, segment)
+
+    def detach(self, publication):
+        self.publications.discard(publication)
+        publication.listeners.discard(self)
+        self.resync.discard(publication.name)
+
+    def send_json(self, message):
+        self._push_control(None, None, dumps(message))
+
+    # init segments are never dropped, a viewer can not decode anything without them
+    def offer_init(self, publication):
+        self.send_json({"init": publication.name, "mime": publication.mime})
+        self._push_control(publication.name, viewer_frame_init, publication.init_header)
+
+    def offer(self, publication, segment):
+        if self.closed:
+            return
+        name = publication.name
+        if name in self.resync and not segment.keyframe:
+            self.dropped += 1
+            return
+        if len(self.queue) >= self.max_segments or self.bytes + len(segment.data) > self.max_bytes:
+            self.dropped += 1
+            self.resync.add(name)
+            return
+        self.resync.discard(name)
+        self._push(name, viewer_frame_cluster, segment.data)
+
+    def _push(self, name, kind, data):
+        self.queue.append((name, kind, data))
+        self.bytes += len(data)
+        self.wakeup.set()
+
+    def _push_control(self, name, kind, data):
+        if self.closed:
+            return
+        if len(self.queue) >= 2 * self.max_segments or self.bytes + len(data) > 2 * self.max_bytes:
+            self.overflowed = True
+            self.closed = True
+            self.wakeup.set()
+            return
+        self._push(name, kind, data)
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue and not self.closed:
+                    name, kind, data = self.queue.popleft()
+                    self.bytes -= len(data)
+                    if name is None:
+                        await self.websocket.send_text(data)
+                        continue
+                    streamer = name.encode("utf-8")
+                    await self.websocket.send_bytes(bytes((kind, len(streamer))) + streamer + data)
+                    if self.served is not None:
+                        self.served(name, len(data))
+            if self.overflowed:
+                await self.websocket.close(code=1008)
+        except asyncio.CancelledError:
+            pass
+        except Exception as rrr:
+            logger.debug("Exception capture on viewer writer: %r", rrr)
+        finally:
+            # publishers stop offering to a writer that is gone
+            self.closed = True
+            for publication in list(self.publications):
+                self.detach(publication)
+            self.queue.clear()
+            self.bytes = 0
+
+    def stop(self):
+        self.closed = True
+        for publication in list(self.publications):
+            self.detach(publication)
+        self.queue.clear()
+        self.bytes = 0
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
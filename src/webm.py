@@ -0,0 +1,311 @@
+import struct
+
+
+# EBML element ids, kept with their length marker bits as they appear on the wire
+ebml_id = 0x1A45DFA3
+segment_id = 0x18538067
+info_id = 0x1549A966
+duration_id = 0x4489
+tracks_id = 0x1654AE6B
+track_entry_id = 0xAE
+track_number_id = 0xD7
+track_type_id = 0x83
+codec_id = 0x86
+cluster_id = 0x1F43B675
+timecode_id = 0xE7
+simple_block_id = 0xA3
+block_group_id = 0xA0
+block_id = 0xA1
+reference_block_id = 0xFB
+cluster_children = {timecode_id, simple_block_id, block_group_id, 0xA7, 0xAB, 0xA5}
+video_track_type = 1
+# matroska codec ids to the codecs parameter MediaSource wants
+mse_codecs = {
+    "V_VP8": "vp8",
+    "V_VP9": "vp9",
+    "V_AV1": "av01.0.04M.08",
+    "V_MPEG4/ISO/AVC": "avc1.42E01E",
+    "A_OPUS": "opus",
+    "A_VORBIS": "vorbis"
+}
+
+unknown_size = b"\x01\xff\xff\xff\xff\xff\xff\xff"
+segment_header = b"\x18\x53\x80\x67" + unknown_size
+cluster_header = b"\x1f\x43\xb6\x75" + unknown_size
+
+
+# every way the input can be malformed, the stream it came from cannot be followed any further
+class WebmError(ValueError):
+    pass
+
+
+# (value, length) of the variable length integer at position, None when it is not complete yet
+def read_vint(buffer, position, keep_marker=False):
+    if position >= len(buffer):
+        return None
+    first = buffer[position]
+    if first == 0:
+        raise WebmError("invalid EBML variable length integer at %d" % position)
+    length = 1
+    mask = 0x80
+    while not first & mask:
+        mask >>= 1
+        length += 1
+    if position + length > len(buffer):
+        return None
+    value = first if keep_marker else first & (mask - 1)
+    for i in range(1, length):
+        value = (value << 8) | buffer[position + i]
+    return value, length
+
+
+# (id, size, header length) of the element at position, size is None for unknown size
+def read_element_header(buffer, position):
+    element_id = read_vint(buffer, position, True)
+    if element_id is None:
+        return None
+    size = read_vint(buffer, position + element_id[1])
+    if size is None:
+        return None
+    value, length = size
+    if value == (1 << (7 * length)) - 1:
+        value = None
+    return element_id[0], value, element_id[1] + length
+
+
+# (id, size, header length) of a child inside an element that is complete in buffer
+def read_child_header(buffer, position, end):
+    header = read_element_header(buffer, position)
+    if header is None or header[1] is None or position + header[2] + header[1] > end:
+        raise WebmError("truncated EBML element at %d" % position)
+    return header
+
+
+def read_uint(buffer, start, end):
+    value = 0
+    for i in range(start, end):
+        value = (value << 8) | buffer[i]
+    return value
+
+
+def size_vint(size):
+    return struct.pack(">Q", size | (1 << 56))
+
+
+def timecode_element(timecode):
+    return b"\xe7\x88" + struct.pack(">Q", max(timecode, 0))
+
+
+class WebmUnit:
+    __slots__ = ("kind", "data", "keyframe", "timecode")
+
+    def __init__(self, kind, data, keyframe=False, timecode=0):
+        self.kind = kind
+        self.data = data
+        self.keyframe = keyframe
+        self.timecode = timecode
+
+
+class OpenCluster:
+    __slots__ = ("end", "timecode", "parts", "keyframe")
+
+    def __init__(self, end):
+        self.end = end
+        self.timecode = None
+        self.parts = []
+        self.keyframe = None
+
+
+# Incremental WebM splitter for the recorder uploads. Bytes are pushed with feed() in pieces
+# of any size and come back as "init" units (EBML header, Segment, Info, Tracks) and "cluster"
+# units, without decoding any media. Every blob the recorder restarts with is folded into one
+# continuous stream: the init unit is only emitted again when the tracks change, Segment and
+# Cluster sizes are rewritten to unknown and cluster timecodes are shifted so they keep going
+# up across blobs. A cluster still open at the end of a feed is emitted with what it has and
+# continues in a new cluster with the same timecode, so nothing waits for the next upload.
+# Malformed input, an element over max_element bytes or more than max_pending bytes waiting for
+# the rest of an element raise WebmError, the stream is not followed any further.
+class WebmStreamParser:
+
+    def __init__(self, max_element=16 * 1024 * 1024, max_pending=32 * 1024 * 1024):
+        self.max_element = max_element
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.position = 0
+        # absolute offset of buffer[0] in the input
+        self.consumed = 0
+        self.ebml_header = None
+        self.info = None
+        self.init = None
+        self.video_track = None
+        self.mime = "video/webm"
+        self.cluster = None
+        self.blob_offset = 0
+        self.last_time = None
+        self.last_delta = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def feed(self, data):
+        self.buffer += data
+        self.bytes_in += len(data)
+        units = []
+        try:
+            while self._step(units):
+                pass
+        except (IndexError, struct.error) as rrr:
+            raise WebmError("malformed webm input: %r" % rrr) from rrr
+        if len(self.buffer) - self.position > self.max_pending:
+            raise WebmError("%d bytes pending, over the limit" % (len(self.buffer) - self.position))
+        if self.cluster is not None:
+            self._emit_cluster(units)
+        del self.buffer[:self.position]
+        self.consumed += self.position
+        self.position = 0
+        for unit in units:
+            self.bytes_out += len(unit.data)
+        return units
+
+    def _absolute(self):
+        return self.consumed + self.position
+
+    def _step(self, units):
+        if self.cluster is not None and self.cluster.end is not None and self._absolute() >= self.cluster.end:
+            self._close_cluster(units)
+        header = read_element_header(self.buffer, self.position)
+        if header is None:
+            return False
+        element_id, size, header_length = header
+        body = self.position + header_length
+
+        if element_id == segment_id:
+            # step into the segment, its children are read one by one
+            self.position = body
+            return True
+        if element_id == cluster_id:
+            self._close_cluster(units)
+            self.cluster = OpenCluster(None if size is None else self._absolute() + header_length + size)
+            self.position = body
+            return True
+        if size is None:
+            raise WebmError("unknown size element %x at %d" % (element_id, self._absolute()))
+        if header_length + size > self.max_element:
+            raise WebmError("element %x of %d bytes over the limit" % (element_id, size))
+        if body + size > len(self.buffer):
+            return False
+        end = body + size
+
+        if self.cluster is not None and element_id in cluster_children:
+            self._cluster_child(element_id, body, end)
+        else:
+            self._close_cluster(units)
+            if element_id == ebml_id:
+                self._new_blob()
+                self.ebml_header = bytes(self.buffer[self.position:end])
+            elif element_id == info_id:
+                self.info = self._live_info(body, end)
+            elif element_id == tracks_id:
+                self._tracks(bytes(self.buffer[self.position:end]), units)
+            # SeekHead, Cues, Tags and Void point into the original blob and are dropped
+        self.position = end
+        return True
+
+    def _new_blob(self):
+        # the recorder restarted, its timecodes begin at zero again
+        if self.last_time is not None:
+            self.blob_offset = self.last_time + max(self.last_delta, 1)
+
+    # the Duration of one finished blob would end playback of the whole stream, leave it out
+    def _live_info(self, body, end):
+        children = []
+        child = body
+        while child < end:
+            child_id, child_size, child_header = read_child_header(self.buffer, child, end)
+            if child_id != duration_id:
+                children.append(bytes(self.buffer[child:child + child_header + child_size]))
+            child += child_header + child_size
+        children = b"".join(children)
+        return b"\x15\x49\xa9\x66" + size_vint(len(children)) + children
+
+    def _tracks(self, tracks, units):
+        self.video_track = None
+        codecs = []
+        position = read_child_header(tracks, 0, len(tracks))[2]
+        while position < len(tracks):
+            element_id, size, header_length = read_child_header(tracks, position, len(tracks))
+            if element_id == track_entry_id:
+                number = kind = None
+                child = position + header_length
+                entry_end = child + size
+                while child < entry_end:
+                    child_id, child_size, child_header = read_child_header(tracks, child, entry_end)
+                    if child_id == track_number_id:
+                        number = read_uint(tracks, child + child_header, child + child_header + child_size)
+                    elif child_id == track_type_id:
+                        kind = read_uint(tracks, child + child_header, child + child_header + child_size)
+                    elif child_id == codec_id:
+                        name = tracks[child + child_header:child + child_header + child_size].decode("ascii", "ignore")
+                        if mse_codecs.get(name.rstrip("\x00")) is not None:
+                            codecs.append(mse_codecs[name.rstrip("\x00")])
+                    child += child_header + child_size
+                if kind == video_track_type and self.video_track is None:
+                    self.video_track = number
+            position += header_length + size
+        if codecs:
+            self.mime = 'video/webm; codecs="%s"' % ",".join(codecs)
+        init = (self.ebml_header or b"") + segment_header + (self.info or b"") + tracks
+        if init != self.init:
+            self.init = init
+            units.append(WebmUnit("init", init))
+
+    def _cluster_child(self, element_id, body, end):
+        cluster = self.cluster
+        if element_id == timecode_id:
+            cluster.timecode = read_uint(self.buffer, body, end) + self.blob_offset
+            return
+        if cluster.timecode is None or element_id not in (simple_block_id, block_group_id):
+            return
+        block_body = body
+        keyframe = False
+        if element_id == block_group_id:
+            keyframe = True
+            child = body
+            while child < end:
+                child_id, child_size, child_header = read_child_header(self.buffer, child, end)
+                if child_id == block_id:
+                    block_body = child + child_header
+                elif child_id == reference_block_id:
+                    keyframe = False
+                child += child_header + child_size
+        # track number, 16 bit relative timecode and flags
+        track = read_vint(self.buffer, block_body)
+        if track is None or block_body + track[1] + 3 > end:
+            raise WebmError("truncated block at %d" % block_body)
+        track, track_length = track
+        relative = struct.unpack_from(">h", self.buffer, block_body + track_length)[0]
+        if element_id == simple_block_id:
+            keyframe = bool(self.buffer[block_body + track_length + 2] & 0x80)
+        if self.video_track is None or track == self.video_track:
+            if cluster.keyframe is None:
+                cluster.keyframe = keyframe
+            block_time = cluster.timecode + relative
+            if self.last_time is not None and block_time > self.last_time:
+                self.last_delta = block_time - self.last_time
+            if self.last_time is None or block_time > self.last_time:
+                self.last_time = block_time
+        cluster.parts.append(bytes(self.buffer[self.position:end]))
+
+    def _emit_cluster(self, units):
+        cluster = self.cluster
+        if not cluster.parts:
+            return
+        data = cluster_header + timecode_element(cluster.timecode) + b"".join(cluster.parts)
+        units.append(WebmUnit("cluster", data, bool(cluster.keyframe), cluster.timecode))
+        cluster.parts = []
+        # what follows in the same cluster starts a new one, its own first block decides
+        cluster.keyframe = None
+
+    def _close_cluster(self, units):
+        if self.cluster is not None:
+            self._emit_cluster(units)
+            self.cluster = None
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+# the server modules import each other as top level modules, like uvicorn runs them from src
+src_folder = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+sys.path.insert(0, src_folder)
+
+
+# The server module, imported from src since it reads res/ when it is imported. Its module level
+# state is shared by the tests using it, see fresh_chat_manager in the tests that change it.
+@pytest.fixture(scope="session")
+def endpoint():
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(src_folder)
+        patch.setenv("ALT_KEY_HASH_ITERATIONS", "1000")
+        import endpoint
+    return endpoint
@@ -0,0 +1,57 @@
+import asyncio
+
+from backplane import SocketBackplane, BackplaneBroker
+
+
+def worker(port, node_id, events, **options):
+    backplane = SocketBackplane("127.0.0.1", port, node_id, reconnect_delay=0.01, **options)
+    backplane.bind(lambda node, connection, event: events.append(event), lambda topic, payload: None)
+    return backplane
+
+
+def test_unsent_state_events_follow_the_reconnect():
+    async def run():
+        broker = BackplaneBroker()
+        server = await asyncio.start_server(broker.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        seen = []
+        other = worker(port, "other", seen)
+        await other.start()
+        offline = worker(port, "offline", [])
+        # the broker is not reached yet
+        assert offline.log(["alt", "alice", "hash"])
+        assert not offline.log(["chat", "channel", None, "alice", "hi", "now", 1.0])
+        assert seen == []
+        await offline.start()
+        for _ in range(100):
+            if seen:
+                break
+            await asyncio.sleep(0.01)
+        await offline.close()
+        await other.close()
+        server.close()
+        return seen, offline
+
+    seen, offline = asyncio.run(run())
+    assert seen == [["alt", "alice", "hash"]]
+    assert not offline.unsent and offline.lost == 0
+
+
+def test_unsent_is_bounded():
+    backplane = worker(1, "node", [], max_unsent=2)
+    assert backplane.log(["member", "channel", "bob"])
+    assert backplane.log(["member", "channel", "carol"])
+    assert not backplane.log(["member", "channel", "dave"])
+    assert not backplane.log(["live", "channel", "streamer"])
+    assert len(backplane.unsent) == 2
+    assert backplane.lost == 2
+
+
+def test_local_actions_stay_on_the_worker():
+    events = []
+    backplane = worker(1, "node", events, local_actions=("chat", "redact", "receipts"))
+    assert backplane.log(["chat", "channel", None, "alice", "hi", "now", 1.0])
+    assert backplane.log(["redact", "channel", 1, "alice"])
+    assert backplane.log(["receipts", "channel", {}])
+    assert events == [["chat", "channel", None, "alice", "hi", "now", 1.0]]
+    assert not backplane.unsent
@@ -0,0 +1,62 @@
+from chat_log import ChannelLog
+
+
+def rows(start, stop):
+    return [(seq, "alice", "message %d" % seq, "2026-10-18 00:00:00", float(seq)) for seq in range(start, stop)]
+
+
+def test_seqs_and_lookup():
+    chats = ChannelLog(segment_size=4)
+    for seq, sender, message, time_str, stamp in rows(1, 11):
+        assert chats.append(sender, message, time_str, stamp).seq == seq
+    assert (chats.first_seq(), chats.last_seq(), len(chats)) == (1, 10, 10)
+    assert chats.get(7).message == "message 7"
+    assert [chat.seq for chat in chats.since(8)] == [9, 10]
+    assert [chat.seq for chat in chats.range(3, 6)] == [3, 4, 5]
+    assert chats.get(11) is None
+
+
+def test_retention_trims_the_head():
+    chats = ChannelLog(max_count=5, segment_size=4)
+    chats.extend(rows(1, 13))
+    assert (chats.first_seq(), chats.last_seq()) == (8, 12)
+    assert chats.get(7) is None and chats.get(8).seq == 8
+    assert chats.bytes == sum(chat.size for chat in chats.range(8, 13))
+
+
+def test_extend_matches_append():
+    appended = ChannelLog(segment_size=4)
+    for seq, sender, message, time_str, stamp in rows(1, 11):
+        appended.append(sender, message, time_str, stamp, seq)
+    extended = ChannelLog(segment_size=4)
+    extended.extend(rows(1, 6))
+    extended.extend(rows(6, 11))
+    assert [chat.frame for chat in extended.range(1, 11)] == [chat.frame for chat in appended.range(1, 11)]
+    assert (extended.next_seq, extended.count, extended.bytes) == (appended.next_seq, appended.count, appended.bytes)
+
+
+def test_frame_follows_changes():
+    chats = ChannelLog()
+    chat = chats.append("alice", "hello", "2026-10-18 00:00:00", 1.0)
+    assert '"message":"hello"' in chat.frame
+    chat.message = "changed"
+    chat.edited = True
+    chats.update(chat)
+    assert '"message":"changed"' in chat.frame and '"edited":true' in chat.frame
+
+
+def test_given_seq_jumps_the_gap():
+    chats = ChannelLog(max_count=5, segment_size=4)
+    chats.extend(rows(1, 3))
+    chats.extend(rows(5, 6) + rows(9, 11))
+    assert [chat.seq for chat in chats.range(1, 11)] == [1, 2, 5, 9, 10]
+    assert (chats.last_seq(), len(chats), chats.missing) == (10, 5, 5)
+    assert chats.get(3) is None and chats.get(9).message == "message 9"
+    assert chats.seq_at_time(3.0) == 3 and chats.seq_at_time(6.0) == 6
+    assert [chat.seq for chat in chats.since(2)] == [5, 9, 10]
+    # retention counts chats, not the seqs skipped, and never leaves a skipped seq first
+    chats.append("alice", "message 11", "2026-10-18 00:00:00", 11.0, 11)
+    assert (chats.first_seq(), len(chats), chats.missing) == (2, 5, 5)
+    chats.append("alice", "message 12", "2026-10-18 00:00:00", 12.0)
+    assert (chats.first_seq(), len(chats), chats.missing) == (5, 5, 3)
+    assert chats.bytes == sum(chat.size for chat in chats.range(5, 13))
@@ -0,0 +1,194 @@
+import asyncio
+import functools
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+
+
+# ChatManager and VideoConference keep their maps on the class, the server has one of each;
+# every test gets maps of its own
+def new_chat_manager(endpoint, monkeypatch, spill_folder):
+    chat_manager = endpoint.ChatManager()
+    chat_manager.non_persistence_message_buffer = {}
+    chat_manager.alt_member_list = {}
+    chat_manager.channels_by_admin = {}
+    chat_manager.channels_by_member = {}
+    chat_manager.backplane = endpoint.backplane
+    chat_manager.sessions = endpoint.sessions
+    chat_manager.spill = endpoint.ChannelSpill(str(spill_folder))
+    monkeypatch.setattr(endpoint, "chat_manager", chat_manager)
+    video_conference = endpoint.VideoConference(chat_manager)
+    video_conference.channels = {}
+    video_conference.channels_by_host = {}
+    video_conference.channels_by_member = {}
+    monkeypatch.setattr(endpoint, "video_conference", video_conference)
+    return chat_manager
+
+
+# a chat manager with an alt "alice" and a channel of hers, drain snapshots go to tmp_path
+@pytest.fixture
+def chat_manager(endpoint, monkeypatch, tmp_path):
+    monkeypatch.setattr(endpoint, "state_snapshot_dir", str(tmp_path / "state"))
+    chat_manager = new_chat_manager(endpoint, monkeypatch, tmp_path / "spill")
+    chat_manager.book_alt_name("alice", "alice-key")
+    chat_manager.new_channel("alice", endpoint.sessions.issue("alice"), "channel-key")
+    return chat_manager
+
+
+def channel_of(chat_manager):
+    return next(iter(chat_manager.non_persistence_message_buffer))
+
+
+def post(chat_manager, channel_id, count, sender="alice"):
+    for i in range(count):
+        chat_manager.record_chat(["chat", channel_id, None, sender, "message %d" % i, "2026-10-18 00:00:00", 1.0])
+
+
+def test_snapshot_is_restored_once(endpoint, chat_manager, monkeypatch, tmp_path):
+    asyncio.run(endpoint.write_state())
+    restarted = new_chat_manager(endpoint, monkeypatch, tmp_path / "restarted")
+    assert endpoint.restore_state()
+    assert list(restarted.alt_member_list) == ["alice"]
+    assert list(restarted.non_persistence_message_buffer) == list(chat_manager.non_persistence_message_buffer)
+    # the process ended without a drain, the snapshot is behind what it did
+    new_chat_manager(endpoint, monkeypatch, tmp_path / "crashed")
+    assert not endpoint.restore_state()
+
+
+def test_snapshot_without_clean_shutdown_is_stale(endpoint, chat_manager, monkeypatch, tmp_path):
+    asyncio.run(endpoint.write_state())
+    path = endpoint.state_snapshot_path()
+    metadata, history = endpoint.read_snapshot(path)
+    histories = {channel_id: functools.partial(history, channel_id) for channel_id in metadata["histories"]}
+    metadata = {key: value for key, value in metadata.items() if key not in ("histories", "clean_shutdown")}
+    endpoint.write_snapshot(path, metadata, histories)
+    restarted = new_chat_manager(endpoint, monkeypatch, tmp_path / "restarted")
+    assert not endpoint.restore_state()
+    assert not restarted.non_persistence_message_buffer
+
+
+def test_caller_swaps_a_key_for_a_token(endpoint, chat_manager):
+    alt_name, token = asyncio.run(endpoint.caller({"alt_login_name": "alice", "alt_login_pass": "alice-key"}))
+    assert alt_name == "alice" and chat_manager.authenticate_alt_member("alice", token)
+    assert asyncio.run(endpoint.caller({"token": token})) == ("alice", token)
+    assert asyncio.run(endpoint.caller({"alt_login_name": "alice", "alt_login_pass": "wrong-key"})) == ("alice", None)
+    # the raw key is no credential of its own
+    assert not chat_manager.authenticate_alt_member("alice", "alice-key")
+    assert not chat_manager.authenticate_alt_member("alice", endpoint.sessions.issue("bob"))
+
+
+def test_resume_cursor(chat_manager):
+    channel_id = channel_of(chat_manager)
+    post(chat_manager, channel_id, 6)
+    assert [chat.seq for chat in chat_manager.chat_page(channel_id, since=4)] == [5, 6]
+    # a client far behind only gets the newest page
+    assert [chat.seq for chat in chat_manager.chat_page(channel_id, since=0, limit=2)] == [5, 6]
+    chat_manager.correct_chat(channel_id, "edit", "alice", 2, "changed")
+    post(chat_manager, channel_id, 1)
+    # seen before the edit, so its delta is due; seen after it, the history has the edit already
+    assert [chat.message for chat in chat_manager.revised_since(channel_id, 6)] == ["changed"]
+    assert chat_manager.revised_since(channel_id, 7) == []
+
+
+def test_indexes_follow_the_state(endpoint, chat_manager):
+    channel_id = channel_of(chat_manager)
+    chat_manager.book_alt_name("bob", "bob-key-1")
+    assert chat_manager.add_member_to_channel(channel_id, "bob", admin="alice",
+                                              admin_key=endpoint.sessions.issue("alice"))
+    chat_manager.apply_event(["channel", "replayed", "bob", "key", False])
+    chat_manager.apply_event(["member", "replayed", "alice"])
+    conference_id = endpoint.video_conference.create_channel("alice", endpoint.sessions.issue("alice"))
+    assert endpoint.video_conference.add_member("bob", conference_id, "alice", endpoint.sessions.issue("alice"))
+    assert endpoint.check_indexes() == []
+    assert set(chat_manager.get_member_all_channel("bob", endpoint.sessions.issue("bob"))) == {channel_id, "replayed"}
+    endpoint.video_conference.remove_member("bob", conference_id, "alice", endpoint.sessions.issue("alice"))
+    assert endpoint.check_indexes() == []
+    # an index changed behind the helpers' back is reported
+    del chat_manager.channels_by_member["bob"][channel_id]
+    assert endpoint.check_indexes() == ["chat member index of 'bob': missing [%r], extra []" % channel_id]
+
+
+def test_backplane_chats_wait_for_a_spilled_channel(endpoint, chat_manager, monkeypatch):
+    channel_id = channel_of(chat_manager)
+    post(chat_manager, channel_id, 3)
+    monkeypatch.setattr(endpoint, "channel_idle_seconds", 1e-9)
+
+    async def run():
+        # never used since it was created, it goes cold all the same
+        await chat_manager.spill_channels()
+        assert chat_manager.is_spilled(channel_id)
+        for message in ("from", "another worker"):
+            endpoint.apply_backplane_event("other", None, ["chat", channel_id, None, "alice", message,
+                                                           "2026-10-18 00:00:00", 2.0])
+        # nothing was read on the loop, the chats wait for the threadpool
+        assert chat_manager.is_spilled(channel_id) and len(endpoint.faulting_channels[channel_id]) == 2
+        while channel_id in endpoint.faulting_channels:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    assert [chat.message for chat in chat_manager.chat_page(channel_id, since=3)] == ["from", "another worker"]
+
+
+def test_state_stays_put_while_the_journal_refuses(endpoint, chat_manager, tmp_path):
+    channel_id = channel_of(chat_manager)
+    post(chat_manager, channel_id, 1)
+    # never started, the writer failed before the first append
+    chat_manager.journal = endpoint.Journal(str(tmp_path / "journal"), 0)
+    chat_manager.journal.error = OSError("disk full")
+    token = endpoint.sessions.issue("alice")
+    assert not chat_manager.book_alt_name("bob", "bob-key-1")
+    assert chat_manager.new_channel("alice", token, "channel-key") is None
+    assert not chat_manager.close_the_channel(channel_id, "alice", token)
+    assert chat_manager.correct_chat(channel_id, "edit", "alice", 1, "changed") is None
+    assert endpoint.video_conference.create_channel("alice", token) is None
+    assert list(chat_manager.alt_member_list) == ["alice"]
+    assert list(chat_manager.non_persistence_message_buffer) == [channel_id]
+    assert not chat_manager.non_persistence_message_buffer[channel_id]["closed"]
+    assert chat_manager.chat_log(channel_id).get(1).message == "message 0"
+    assert endpoint.video_conference.channels == {}
+    assert chat_manager.journal.pending == []
+
+
+def test_malformed_frames_are_answered(endpoint):
+    client = TestClient(endpoint.app)
+    with client.websocket_connect("/ws_v2") as websocket:
+        for frame in ("not json", "[]", '{"action": "fetch_older"}', '{"action": "receipts_of", "seq": "x"}'):
+            websocket.send_text(frame)
+            assert websocket.receive_json() == {"Error": "Malformed frame"}
+        websocket.send_text('{"action": "close"}')
+    # the socket is let go however it ended
+    assert endpoint.websocket_manager.active_connection == {}
+
+
+def test_channel_reads_stay_on_the_worker_of_the_channel(endpoint, chat_manager, monkeypatch):
+    channel_id = channel_of(chat_manager)
+    token = endpoint.sessions.issue("alice")
+    ring = endpoint.ShardRing(2)
+    client = TestClient(endpoint.app)
+    for action in ("search", "receipts"):
+        body = {"action": action, "channel_id": channel_id, "token": token, "query": "message", "seq": 1}
+        monkeypatch.setattr(endpoint, "shard_ring", ring)
+        monkeypatch.setattr(endpoint, "shard_index", str(1 - ring.shard(channel_id)))
+        assert "Error" in client.post("/channel_adminer", json=body).json()
+        monkeypatch.setattr(endpoint, "shard_index", str(ring.shard(channel_id)))
+        assert "Error" not in client.post("/channel_adminer", json=body).json()
+
+
+def test_backplane_chats_survive_a_lost_spill_file(endpoint, chat_manager, monkeypatch):
+    channel_id = channel_of(chat_manager)
+    post(chat_manager, channel_id, 3)
+    chat_manager.acknowledge(channel_id, "alice", received=3)
+    monkeypatch.setattr(endpoint, "channel_idle_seconds", 1e-9)
+
+    async def run():
+        await chat_manager.spill_channels()
+        os.remove(chat_manager.spill.path(channel_id))
+        endpoint.apply_backplane_event("other", None, ["chat", channel_id, None, "alice", "after",
+                                                       "2026-10-18 00:00:00", 2.0])
+        while channel_id in endpoint.faulting_channels:
+            await asyncio.sleep(0.01)
+
+    asyncio.run(run())
+    # the history is gone, the chat that waited for it is not and keeps a seq of its own
+    assert [(chat.seq, chat.message) for chat in chat_manager.chat_page(channel_id)] == [(4, "after")]
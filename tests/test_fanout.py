@@ -0,0 +1,105 @@
+import asyncio
+
+from fanout import ConnectionWriter, ChannelFanout
+
+
+class StalledSocket:
+
+    def __init__(self):
+        self.sent = []
+        self.closed = None
+        self.release = asyncio.Event()
+
+    async def send_text(self, text):
+        await self.release.wait()
+        self.sent.append(text)
+
+    async def send_bytes(self, data):
+        await self.release.wait()
+        self.sent.append(data)
+
+    async def close(self, code=None):
+        self.closed = code
+
+
+def run(coroutine):
+    return asyncio.run(coroutine())
+
+
+def test_drop_oldest_keeps_the_newest():
+    async def scenario():
+        writer = ConnectionWriter(StalledSocket(), max_queue=3, policy="drop_oldest")
+        for i in range(5):
+            writer.push('{"seq":%d}' % i, chat=True)
+        assert [item for item, chat in writer.queue] == ['{"seq":2}', '{"seq":3}', '{"seq":4}']
+        assert writer.dropped == 2
+    run(scenario)
+
+
+def test_disconnect_closes_the_slow_socket():
+    async def scenario():
+        socket = StalledSocket()
+        writer = ConnectionWriter(socket, max_queue=2, policy="disconnect")
+        assert writer.push("a") and writer.push("b")
+        assert not writer.push("c")
+        await asyncio.sleep(0)
+        assert writer.closed and socket.closed == 1008
+    run(scenario)
+
+
+def test_coalesce_merges_chats_and_keeps_control_frames():
+    async def scenario():
+        socket = StalledSocket()
+        writer = ConnectionWriter(socket, max_queue=4, policy="coalesce", max_coalesced=100)
+        writer.start()
+        writer.push('{"seq":1}', chat=True)
+        writer.push('{"ack":1}')
+        writer.push('{"seq":2}', chat=True)
+        writer.push(['{"seq":3}', '{"seq":4}'], chat=True)
+        writer.push('{"seq":5}', chat=True)
+        assert [item for item, chat in writer.queue] == [
+            ['{"seq":1}'], '{"ack":1}', ['{"seq":2}', '{"seq":3}', '{"seq":4}'], '{"seq":5}']
+        socket.release.set()
+        await asyncio.sleep(0.01)
+        assert socket.sent == ['[{"seq":1}]', '{"ack":1}', '[{"seq":2},{"seq":3},{"seq":4}]', '{"seq":5}']
+        writer.stop()
+    run(scenario)
+
+
+def test_coalesce_is_bounded():
+    async def scenario():
+        socket = StalledSocket()
+        writer = ConnectionWriter(socket, max_queue=4, policy="coalesce", max_coalesced=10)
+        pushed = 0
+        while writer.push('{"seq":%d}' % pushed, chat=True):
+            pushed += 1
+        assert pushed <= 14
+        await asyncio.sleep(0)
+        assert socket.closed == 1008
+
+        # frames that are not chats are never merged, once they fill the queue it is a disconnect
+        socket = StalledSocket()
+        writer = ConnectionWriter(socket, max_queue=4, policy="coalesce", max_coalesced=10)
+        assert all(writer.push('{"receipts":{}}') for _ in range(4))
+        assert not writer.push('{"receipts":{}}')
+    run(scenario)
+
+
+def test_coalesce_does_not_change_a_shared_batch():
+    async def scenario():
+        fanout = ChannelFanout(max_queue=2, policy="coalesce")
+        first = fanout.connect(StalledSocket())
+        second = fanout.connect(StalledSocket())
+        fanout.subscribe(first.websocket, "c")
+        fanout.subscribe(second.websocket, "c")
+        batch = [('{"seq":1}', None, None, None), ('{"seq":2}', None, None, None)]
+        fanout.broadcast_batch("c", batch)
+        fanout.broadcast_batch("c", batch)
+        fanout.broadcast("c", '{"seq":3}', chat=True)
+        assert [item for item, chat in first.queue] == [['{"seq":1}', '{"seq":2}', '{"seq":1}', '{"seq":2}'],
+                                                        '{"seq":3}']
+        assert [item for item, chat in second.queue][0] == first.queue[0][0]
+        assert first.queue[0][0] is not second.queue[0][0]
+        fanout.disconnect(first.websocket)
+        fanout.disconnect(second.websocket)
+    run(scenario)
@@ -0,0 +1,108 @@
+import os
+import time
+import errno
+
+import pytest
+
+from journal import Journal, JournalError, JournalState, segment_name
+
+
+def chat(channel_id, seq, message):
+    return ["chat", channel_id, seq, "alice", message, "2026-10-18 00:00:00", 1.0]
+
+
+def write(directory, events, **options):
+    journal = Journal(str(directory), 0, **options)
+    journal.start()
+    for event in events:
+        journal.append(event)
+    journal.close()
+    return journal
+
+
+def replayed(directory, batch_size=0):
+    events = []
+    Journal(str(directory)).replay(events.extend if batch_size else events.append, batch_size)
+    return events
+
+
+def test_replay_returns_what_was_appended(tmp_path):
+    events = [["alt", "alice", "key"], ["channel", "c", "alice", "k", True]] + [chat("c", i, "m%d" % i)
+                                                                                for i in range(1, 101)]
+    write(tmp_path, events)
+    assert replayed(tmp_path) == events
+    assert replayed(tmp_path, batch_size=7) == events
+
+
+def test_torn_tail_is_cut_off(tmp_path):
+    write(tmp_path, [chat("c", 1, "kept")])
+    path = os.path.join(str(tmp_path), segment_name(1))
+    size = os.path.getsize(path)
+    with open(path, "ab") as f:
+        f.write(b"\x10\x00\x00\x00torn")
+    assert replayed(tmp_path) == [chat("c", 1, "kept")]
+    assert os.path.getsize(path) == size
+
+
+def test_restarts_get_compacted(tmp_path):
+    events = [["alt", "alice", "key"], ["channel", "c", "alice", "k", True]]
+    # every start opens a new segment, however little each one holds
+    for i in range(1, 6):
+        events.append(chat("c", i, "m%d" % i))
+        write(tmp_path, events[-1:] if i > 1 else events, compact_segments=3)
+    deadline = time.time() + 5
+    while not any(name.endswith(".snap") for name in os.listdir(str(tmp_path))) and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    names = os.listdir(str(tmp_path))
+    assert any(name.endswith(".snap") for name in names)
+    assert len([name for name in names if name.endswith(".log")]) < 5
+    state = JournalState()
+    for event in replayed(tmp_path):
+        state.apply(event)
+    assert [event[2] for event in state.events() if event[0] == "chat"] == [1, 2, 3, 4, 5]
+
+
+def test_old_segment_is_closed(tmp_path):
+    journal = Journal(str(tmp_path), 0, segment_seconds=0.05)
+    journal.start()
+    journal.append(chat("c", 1, "first"))
+    time.sleep(0.1)
+    journal.append(chat("c", 2, "second"))
+    time.sleep(0.05)
+    journal.close()
+    assert len(journal.segments()) >= 2
+    assert [event[2] for event in replayed(tmp_path)] == [1, 2]
+
+
+class FullDisk:
+
+    def write(self, data):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    def close(self):
+        pass
+
+
+def test_writer_failure_refuses_appends(tmp_path):
+    journal = Journal(str(tmp_path), 0)
+    journal.start()
+    journal.file = FullDisk()
+    journal.append(chat("c", 1, "lost"))
+    journal.writer.join(5)
+    assert not journal.writer.is_alive()
+    assert not journal.healthy()
+    assert isinstance(journal.error, OSError)
+    with pytest.raises(JournalError):
+        journal.append(chat("c", 2, "refused"))
+    journal.close()
+
+
+def test_pending_is_bounded(tmp_path):
+    # not started, nothing takes the records
+    journal = Journal(str(tmp_path), 0, max_pending_bytes=1000)
+    with pytest.raises(JournalError):
+        for i in range(100):
+            journal.append(chat("c", i, "x" * 20))
+    assert journal.pending_bytes <= 1000
+    assert not journal.healthy()
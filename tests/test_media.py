@@ -0,0 +1,23 @@
+import asyncio
+import concurrent.futures
+import importlib.util
+
+import media
+from media import MediaPipeline
+
+
+def test_decode_ending_after_the_loop_closed():
+    loop = asyncio.new_event_loop()
+    loop.close()
+    pipeline = MediaPipeline()
+    future = concurrent.futures.Future()
+    future.set_result(b"jpeg")
+    pipeline._finished(loop, ("channel", "streamer"), 0, future)
+    assert pipeline.rendered == 0
+
+
+def test_missing_decoders(monkeypatch):
+    find_spec = importlib.util.find_spec
+    absent = ("av", "imageio_ffmpeg", "PIL")
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: None if name in absent else find_spec(name))
+    assert media.missing_decoders() == ["PIL", "imageio_ffmpeg or av"]
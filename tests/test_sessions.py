@@ -0,0 +1,48 @@
+import time
+
+from sessions import SessionTokens, hash_key, verify_key
+
+
+def test_token_names_its_alt():
+    sessions = SessionTokens("secret")
+    token = sessions.issue("alice")
+    assert sessions.verify(token) == "alice"
+    # the second check is the cached one
+    assert sessions.verify(token) == "alice"
+
+
+def test_token_from_another_secret_is_refused():
+    token = SessionTokens("secret").issue("alice")
+    assert SessionTokens("other").verify(token) is None
+
+
+def test_tampered_and_malformed_tokens_are_refused():
+    sessions = SessionTokens("secret")
+    token = sessions.issue("alice")
+    forged = SessionTokens("secret").issue("mallory").split(".")[0] + token[token.index("."):]
+    assert sessions.verify(forged) is None
+    assert sessions.verify("") is None
+    assert sessions.verify("a.b.c") is None
+    assert sessions.verify(None) is None
+    assert sessions.verify(42) is None
+
+
+def test_token_expires():
+    sessions = SessionTokens("secret", ttl=-1)
+    assert sessions.verify(sessions.issue("alice")) is None
+    sessions = SessionTokens("secret", ttl=1)
+    token = sessions.issue("alice")
+    assert sessions.verify(token) == "alice"
+    sessions.verified[token] = ("alice", time.time() - 1)
+    assert sessions.verify(token) is None
+
+
+def test_key_hash():
+    stored = hash_key("password", iterations=1000)
+    assert stored.startswith("pbkdf2_sha256$1000$")
+    assert verify_key("password", stored)
+    assert not verify_key("Password", stored)
+    assert not verify_key(None, stored)
+    # alt names journaled before keys were hashed keep their plain key
+    assert verify_key("plain", "plain")
+    assert not verify_key("other", "plain")
@@ -0,0 +1,105 @@
+import asyncio
+
+from stream_buffer import StreamPublication, StreamBudget, ViewerQueue
+
+
+class Socket:
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.sent = []
+        self.closed = None
+
+    async def send_text(self, data):
+        self.sent.append(data)
+
+    async def send_bytes(self, data):
+        if self.fail:
+            raise ConnectionError("gone")
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+def test_ring_is_bounded_and_keeps_the_newest():
+    publication = StreamPublication(max_bytes=100, max_segments=3, max_age=0)
+    for i in range(10):
+        publication.publish(bytes(10), keyframe=i % 5 == 0)
+    assert [segment.sequence for segment in publication.segments] == [8, 9, 10]
+    assert publication.bytes == 30 and publication.evicted == 7
+    publication.publish(bytes(500))
+    assert [segment.sequence for segment in publication.segments] == [11]
+
+
+def test_budget_over_one_segment_keeps_the_published_one():
+    budget = StreamBudget(max_bytes=50)
+    publication = StreamPublication(max_bytes=0, max_segments=0, max_age=0, budget=budget)
+    publication.publish(bytes(100), keyframe=True)
+    assert len(publication.segments) == 1
+    publication.publish(bytes(100))
+    assert [segment.sequence for segment in publication.segments] == [2]
+    assert budget.bytes == 100
+
+
+def test_budget_evicts_from_the_largest_ring_first():
+    budget = StreamBudget(max_bytes=100)
+    large = StreamPublication(max_bytes=0, max_segments=0, max_age=0, budget=budget)
+    small = StreamPublication(max_bytes=0, max_segments=0, max_age=0, budget=budget)
+    for _ in range(4):
+        large.publish(bytes(20))
+    small.publish(bytes(10))
+    small.publish(bytes(20))
+    assert budget.bytes <= 100
+    assert len(small.segments) == 2 and len(large.segments) == 3
+    large.close()
+    small.close()
+    assert budget.bytes == 0 and not budget.publications
+
+
+def test_viewer_bootstrap_is_bounded():
+    async def run():
+        publication = StreamPublication(max_segments=0, max_bytes=0, max_age=0, name="streamer")
+        publication.set_init_header(b"init")
+        for i in range(10):
+            publication.publish(bytes(10), keyframe=i == 0)
+        viewer = ViewerQueue(Socket(), max_segments=4, max_bytes=1000)
+        viewer.attach(publication)
+        return viewer
+
+    viewer = asyncio.run(run())
+    # the init json and header, then the clusters that fit
+    assert len(viewer.queue) == 4 and viewer.dropped == 8
+    assert "streamer" in viewer.resync
+
+
+def test_viewer_that_takes_nothing_is_closed():
+    async def run():
+        websocket = Socket()
+        viewer = ViewerQueue(websocket, max_segments=2, max_bytes=1000)
+        for i in range(5):
+            viewer.send_json({"streamer_count": i})
+        assert viewer.closed and len(viewer.queue) == 4
+        viewer.start()
+        await viewer.task
+        return websocket, viewer
+
+    websocket, viewer = asyncio.run(run())
+    assert websocket.closed == 1008 and websocket.sent == []
+    assert not viewer.queue and viewer.bytes == 0
+
+
+def test_dead_viewer_is_detached():
+    async def run():
+        publication = StreamPublication(name="streamer")
+        viewer = ViewerQueue(Socket(fail=True))
+        viewer.start()
+        publication.set_init_header(b"init")
+        viewer.attach(publication)
+        await viewer.task
+        publication.publish(bytes(10), keyframe=True)
+        return publication, viewer
+
+    publication, viewer = asyncio.run(run())
+    assert viewer.closed and not publication.listeners and not viewer.publications
+    assert not viewer.queue and viewer.bytes == 0
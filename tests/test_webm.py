@@ -0,0 +1,71 @@
+import os
+import random
+
+import pytest
+
+import webm
+from webm import WebmStreamParser, WebmError, read_element_header, cluster_id
+
+with open(os.path.join(os.path.dirname(webm.__file__), "res", "chunk_mov.webm"), "rb") as f:
+    recording = f.read()
+
+
+def test_recording_splits_into_init_and_clusters():
+    parser = WebmStreamParser()
+    units = parser.feed(recording)
+    assert units[0].kind == "init"
+    assert parser.mime.startswith("video/webm")
+    clusters = [unit for unit in units if unit.kind == "cluster"]
+    assert clusters and clusters[0].keyframe
+    for unit in clusters:
+        assert read_element_header(unit.data, 0)[:2] == (cluster_id, None)
+
+
+def test_pieces_give_the_same_stream_as_one_feed():
+    whole = WebmStreamParser().feed(recording)
+    parser = WebmStreamParser()
+    pieces = []
+    for start in range(0, len(recording), 1000):
+        pieces.extend(parser.feed(recording[start:start + 1000]))
+    assert b"".join(unit.data for unit in pieces if unit.kind == "init") == whole[0].data
+    assert [unit.timecode for unit in pieces if unit.kind == "cluster"][0] == whole[1].timecode
+
+
+def test_restarted_recorder_keeps_one_stream():
+    parser = WebmStreamParser()
+    first = parser.feed(recording)
+    second = parser.feed(recording)
+    # same tracks, the init header is not sent again and timecodes keep going up
+    assert all(unit.kind == "cluster" for unit in second)
+    assert second[0].timecode > max(unit.timecode for unit in first if unit.kind == "cluster")
+
+
+def test_corrupt_input_only_raises_webm_error():
+    rng = random.Random(1)
+    for _ in range(300):
+        data = bytearray(recording)
+        for _ in range(rng.randint(1, 20)):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        parser = WebmStreamParser(max_element=1 << 20, max_pending=2 << 20)
+        try:
+            for start in range(0, len(data), 4096):
+                parser.feed(bytes(data[start:start + 4096]))
+        except WebmError:
+            pass
+
+
+def test_huge_element_is_rejected():
+    parser = WebmStreamParser(max_element=1 << 20)
+    with pytest.raises(WebmError):
+        # EBML header declaring 64 GiB
+        parser.feed(b"\x1a\x45\xdf\xa3\x01\x00\x00\x10\x00\x00\x00\x00")
+
+
+def test_pending_bytes_are_bounded():
+    parser = WebmStreamParser(max_element=1 << 20, max_pending=1000)
+    parser.feed(b"\x1a\x45\xdf\xa3\x83\x42\x86\x81")
+    with pytest.raises(WebmError):
+        # a 64 KiB SeekHead arriving in pieces
+        parser.feed(b"\x11\x4d\x9b\x74\x41\x00")
+        for _ in range(10):
+            parser.feed(bytes(200))